@@ -22,7 +22,7 @@ def debug_task(self):
 app.conf.beat_schedule = {
     'check_transcription_status_every_2_minutes': {
         'task': 'zapp.tasks.schedule_transcription_checks',  # Полный путь к задаче
-        'schedule': 60.0,  # Интервал в секундах (1 минуту)
+        'schedule': float(settings.S2T_POLL_INTERVAL),  # 1 минута, при включённых колбэках — страховочный опрос раз в 10 минут
     },
     "update_deal_statuses_daily": {
         "task": "zapp.tasks.update_deal_statuses",
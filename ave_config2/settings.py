@@ -134,6 +134,97 @@ CELERY_TASK_REJECT_ON_WORKER_LOST = True
 CELERY_TASK_ACKS_ON_FAILURE_OR_TIMEOUT = True
 CELERY_TASK_SOFT_TIME_LIMIT = 150     # мягкий таймаут (уберёт залипшие HTTP)
 
+# Кэш (Redis) — используется для кэша организаций и других служебных данных
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/2',
+    }
+}
+ORGANIZATION_CACHE_TTL = 3600         # сек, в Redis
+ORGANIZATION_LOCAL_CACHE_TTL = 30     # сек, в памяти процесса
+
+# Справочник статусов amoCRM: после TTL обновляется в фоне, устаревший отдаётся не дольше MAX_AGE
+AMO_STATUS_CACHE_TTL = 3600
+AMO_STATUS_CACHE_MAX_AGE = 7 * 24 * 3600
+AMO_STATUS_UNKNOWN_REFRESH_INTERVAL = 60
+
+# Статусы сделок приходят вебхуками (lead_status/, lead_update_b24/); у организаций, присылавших их
+# за это число дней, ночная сверка берёт только сделки, статус которых не сверяли дольше этого срока
+DEAL_STATUS_RECONCILE_DAYS = 3
+
+# Redis для служебных данных интеграций (метрики HTTP, лимиты запросов)
+REDIS_URL = 'redis://localhost:6379/3'
+
+# Общий HTTP-клиент интеграций: таймауты (подключение, чтение) и размеры пулов соединений
+HTTP_CLIENT_TIMEOUT = (10, 60)
+HTTP_POOL_HOSTS = 50
+HTTP_POOL_SIZE = 20
+
+# Лимиты запросов к CRM на аккаунт, общие для всех воркеров: (запросов в секунду, размер всплеска)
+AMOCRM_RATE_LIMIT = (7, 7)
+BITRIX24_RATE_LIMIT = (2, 50)
+# Сколько секунд задача ждёт токен, прежде чем уйти на повтор
+RATE_LIMIT_MAX_WAIT = 30
+
+# Асинхронный приём вебхуков (get_call_async/, get_call_b24_async/ под ASGI): очередь в REDIS_URL,
+# которую разбирает manage.py consume_webhooks — пачками до BATCH_SIZE, опрос пустой очереди раз в POLL_INTERVAL сек
+WEBHOOK_QUEUE_KEY = 'webhooks:incoming'
+WEBHOOK_QUEUE_BATCH_SIZE = 200
+WEBHOOK_QUEUE_POLL_INTERVAL = 0.3
+
+# Сколько секунд помним принятый вебхук (note_id amoCRM / CALL_ID Bitrix24), чтобы отбрасывать повторные доставки
+WEBHOOK_DEDUP_TTL = 24 * 3600
+
+# Опрос статусов Speech2Text: размер пачки и число параллельных запросов
+S2T_POLL_CHUNK_SIZE = 100
+S2T_POLL_CONCURRENCY = 10
+S2T_POLL_LEASE_TIMEOUT = 600          # сек, после которых взятая в опрос строка считается потерянной и опрашивается снова
+
+# Колбэк Speech2Text о завершении распознавания (например, 'https://plus-script.ru/s2t_callback/').
+# Колбэки включаются, только если заданы и адрес, и токен; иначе результаты получаются опросом раз в минуту.
+S2T_CALLBACK_URL = None
+S2T_CALLBACK_TOKEN = ''
+S2T_CALLBACK_GRACE_PERIOD = 600       # сек без колбэка, после которых задачу опрашивает страховочный проход
+S2T_POLL_INTERVAL = 600 if S2T_CALLBACK_URL and S2T_CALLBACK_TOKEN else 60
+
+# Кэш транскрибаций: запись, уже распознанная в организации, не отправляется в Speech2Text повторно
+S2T_TRANSCRIPT_CACHE = True
+
+# Кэш ответов нейросети: тот же промпт для той же транскрибации не отправляется в Fireworks повторно
+LLM_RESPONSE_CACHE = True
+# Максимум записей в кэше ответов, при превышении вытесняются давно не использованные
+LLM_RESPONSE_CACHE_MAX_ENTRIES = 10000
+
+# Пул соединений с Fireworks: клиент создаётся один раз на API-ключ в каждом процессе
+TMODEL_MAX_CONNECTIONS = 20
+TMODEL_MAX_KEEPALIVE = 10
+TMODEL_KEEPALIVE_EXPIRY = 120  # сек
+# HTTP/2 (используется, если установлен пакет h2)
+TMODEL_HTTP2 = True
+# Потоковый ответ нейросети: оценки критериев сохраняются, не дожидаясь конца ответа
+TMODEL_STREAMING = True
+
+# Бюджет токенов запроса к нейросети: длинная транскрибация пересказывается частями (map-reduce)
+TMODEL_MAX_PROMPT_TOKENS = 60000
+TMODEL_CHUNK_TOKENS = 12000
+TMODEL_CHUNK_CONCURRENCY = 4
+
+# Недельный анализ (ошибки, факторы, инсайты): размер пачки звонков и число параллельных запросов
+WEEKLY_BATCH_SIZE = 20
+WEEKLY_LLM_CONCURRENCY = 4
+# Повторы пачки при 429 и начальная задержка (сек), задержка удваивается с каждым повтором
+WEEKLY_LLM_MAX_RETRIES = 5
+WEEKLY_LLM_BACKOFF = 2
+# После стольких ночных запусков без ответа пачка пропускается, и отметка отчёта сдвигается дальше неё
+WEEKLY_BATCH_MAX_ATTEMPTS = 3
+# Сколько секунд недельный анализ ждёт транскрибацию нового звонка, прежде чем пропустить его
+WEEKLY_TRANSCRIPT_GRACE = 24 * 3600
+# Сколько звонков за раз читается из БД при сборе транскрибаций недели
+WEEKLY_TRANSCRIPT_CHUNK_SIZE = 500
+# Виды недельного анализа, которые ночная задача запускает за один проход: "errors", "factors", "insights"
+WEEKLY_ANALYSIS_KINDS = ["errors", "factors"]
+
 DEFAULT_ORGANIZATION_PROMPT = """
 Ты тренер по продажам. Оцени диалог от 1 до 5 по следующим критериям. 
 
@@ -161,3 +252,4 @@ DEFAULT_ORGANIZATION_PROMPT = """
 8. Обратная связь: (тут перечисляются примеры диалогов и рекомендации по их улучшению)
 
 """
+
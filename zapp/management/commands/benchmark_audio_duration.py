@@ -0,0 +1,89 @@
+import os, tempfile, time, wave
+from django.core.management.base import BaseCommand
+from pydub import AudioSegment
+from zapp.services.pydub import FileRangeReader, probe_audio_duration
+
+
+class CountingFileReader(FileRangeReader):
+    """
+    FileRangeReader, который считает прочитанные байты.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.bytes_read = 0
+
+    def read(self, offset, length):
+        data = super().read(offset, length)
+        self.bytes_read += len(data)
+        return data
+
+
+def create_wav_fixture(directory, minutes=20, sample_rate=8000):
+    """
+    Создаёт WAV-файл с тишиной заданной длины (моно, 16 бит).
+    """
+    path = os.path.join(directory, f"fixture_{minutes}min.wav")
+    frame = b"\x00\x00" * sample_rate
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        for _ in range(minutes * 60):
+            f.writeframes(frame)
+    return path
+
+
+def create_mp3_fixture(directory, minutes=20):
+    """
+    Создаёт CBR MP3 с тишиной заданной длины: кадры MPEG-1 Layer III, 128 кбит/с, 48 кГц, моно.
+    Кадры с нулевыми данными декодируются как тишина, поэтому кодер не нужен.
+    """
+    path = os.path.join(directory, f"fixture_{minutes}min.mp3")
+    # 1152 сэмпла на кадр при 48 кГц — 24 мс; при 128 кбит/с кадр ровно 384 байта, без padding
+    frame = b"\xff\xfb\x94\xc0" + b"\x00" * 380
+    with open(path, "wb") as f:
+        f.write(frame * (minutes * 60 * 1000 // 24))
+    return path
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает определение длительности по заголовкам с полным декодированием pydub на локальных файлах'
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="*", help="Пути к аудиофайлам (mp3, wav, ogg)")
+        parser.add_argument("--repeat", type=int, default=3, help="Количество повторов для каждого файла")
+
+    def handle(self, *args, **options):
+        files = options["files"]
+        repeat = options["repeat"]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if not files:
+                files = [create_wav_fixture(tmp_dir), create_mp3_fixture(tmp_dir)]
+                self.stdout.write(f"Файлы не указаны, созданы тестовые WAV и MP3: {', '.join(files)}")
+
+            for path in files:
+                size = os.path.getsize(path)
+
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    reader = CountingFileReader(path)
+                    probed = probe_audio_duration(reader)
+                probe_time = (time.perf_counter() - start) / repeat
+
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    decoded = AudioSegment.from_file(path).duration_seconds
+                decode_time = (time.perf_counter() - start) / repeat
+
+                speedup = decode_time / probe_time if probe_time else 0
+                self.stdout.write(
+                    f"{os.path.basename(path)} ({size / 1024 / 1024:.1f} МБ): "
+                    f"заголовки {probed if probed is None else round(probed, 2)} сек за {probe_time * 1000:.2f} мс "
+                    f"(прочитано {reader.bytes_read / 1024:.0f} КБ), "
+                    f"pydub {round(decoded, 2)} сек за {decode_time * 1000:.2f} мс, "
+                    f"ускорение x{speedup:.0f}"
+                )
+
+        self.stdout.write(self.style.SUCCESS("Готово!"))
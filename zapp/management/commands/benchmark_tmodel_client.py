@@ -0,0 +1,89 @@
+import json, statistics, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.core.management.base import BaseCommand
+from zapp.services.t_model import TMODEL_NAME, build_tmodel_client, close_tmodel_clients, init_tmodel_client
+
+
+class StubCompletionHandler(BaseHTTPRequestHandler):
+    """
+    Локальная заглушка chat/completions: отвечает сразу, чтобы измерялись только накладные расходы клиента.
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps({
+            "id": "stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": TMODEL_NAME,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubCompletionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def measure(get_client, repeat, close_after_call):
+    """
+    Среднее и медианное время одного запроса (мс).
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        client = get_client()
+        client.chat.completions.create(
+            model=TMODEL_NAME,
+            messages=[{"role": "user", "content": "ping"}],
+            max_tokens=1,
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+        if close_after_call:
+            client.close()
+    return statistics.mean(timings), statistics.median(timings)
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает задержку запроса к нейросети: новый клиент на каждый вызов против общего клиента из реестра'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--api-key", help="API-ключ Fireworks; без него запросы идут в локальную заглушку")
+        parser.add_argument("--base-url", default="https://api.fireworks.ai/inference/v1")
+        parser.add_argument("--repeat", type=int, default=20, help="Количество запросов в каждом режиме")
+
+    def handle(self, *args, **options):
+        api_key, base_url, repeat = options["api_key"], options["base_url"], options["repeat"]
+
+        server = None
+        if not api_key:
+            server, base_url = start_stub_server()
+            api_key = "benchmark"
+            self.stdout.write(f"API-ключ не указан, используется локальная заглушка {base_url}")
+
+        try:
+            fresh_mean, fresh_median = measure(lambda: build_tmodel_client(api_key, base_url), repeat, True)
+            # Первый вызов реестра открывает соединение, его не считаем
+            init_tmodel_client(api_key, base_url)
+            pooled_mean, pooled_median = measure(lambda: init_tmodel_client(api_key, base_url), repeat, False)
+        finally:
+            close_tmodel_clients()
+            if server:
+                server.shutdown()
+
+        self.stdout.write(f"Новый клиент на вызов: среднее {fresh_mean:.2f} мс, медиана {fresh_median:.2f} мс")
+        self.stdout.write(f"Клиент из реестра:     среднее {pooled_mean:.2f} мс, медиана {pooled_median:.2f} мс")
+        speedup = fresh_mean / pooled_mean if pooled_mean else 0
+        self.stdout.write(self.style.SUCCESS(f"Ускорение x{speedup:.1f}"))
@@ -0,0 +1,42 @@
+import logging, time
+from django.core.management.base import BaseCommand
+from zapp.services.webhook_ingest import (
+    WEBHOOK_QUEUE_BATCH_SIZE, WEBHOOK_QUEUE_POLL_INTERVAL, ack_webhook_batch, process_webhook_batch, read_webhook_batch
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Обрабатывает очередь вебхуков из асинхронных эндпоинтов get_call_async/ и get_call_b24_async/ (запускать в одном экземпляре)'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=WEBHOOK_QUEUE_BATCH_SIZE, help="Вебхуков за один проход")
+        parser.add_argument("--once", action="store_true", help="Обработать текущую очередь и завершиться")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+
+        while True:
+            try:
+                raw_items = read_webhook_batch(batch_size)
+            except Exception as e:
+                logger.error(f"Очередь вебхуков недоступна: {str(e)}")
+                time.sleep(5)
+                continue
+
+            if raw_items:
+                try:
+                    dispatched = process_webhook_batch(raw_items)
+                    ack_webhook_batch(len(raw_items))
+                except Exception as e:
+                    # Пачка остаётся в очереди и будет обработана заново после паузы
+                    logger.error(f"Ошибка обработки пачки вебхуков: {str(e)}")
+                    time.sleep(5)
+                    continue
+                self.stdout.write(f"Обработано вебхуков: {len(raw_items)}, поставлено задач: {dispatched}")
+
+            if options["once"] and len(raw_items) < batch_size:
+                break
+            if len(raw_items) < batch_size:
+                time.sleep(WEBHOOK_QUEUE_POLL_INTERVAL)
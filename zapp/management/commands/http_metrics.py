@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from zapp.services.http_client import get_host_metrics
+from zapp.services.webhook_dedup import get_suppressed_duplicates
+
+
+class Command(BaseCommand):
+    help = 'Показывает число запросов, ошибок и среднюю задержку внешних интеграций по хостам, а также отброшенные дубли вебхуков'
+
+    def handle(self, *args, **kwargs):
+        metrics = get_host_metrics()
+        if not metrics:
+            self.stdout.write("Метрик пока нет.")
+
+        for host, data in metrics.items():
+            self.stdout.write(
+                f"{host}: запросов {data['requests']}, ошибок {data['errors']}, "
+                f"средняя задержка {data['avg_latency'] * 1000:.0f} мс"
+            )
+
+        for source, count in get_suppressed_duplicates().items():
+            self.stdout.write(f"Отброшено повторных вебхуков {source}: {count}")
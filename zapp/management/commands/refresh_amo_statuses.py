@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from zapp.models import Organization
+from zapp.services.amo_status_cache import refresh_amo_status_mapping
+
+
+class Command(BaseCommand):
+    help = 'Принудительно обновляет кэш справочника статусов сделок amoCRM'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--organization", type=int, help="ID организации (по умолчанию — все с amoCRM)")
+
+    def handle(self, *args, **options):
+        organizations = Organization.objects.exclude(bearer_amocrm="").filter(custom_crm=False)
+        if options["organization"]:
+            organizations = organizations.filter(id=options["organization"])
+
+        for organization in organizations:
+            status_mapping = refresh_amo_status_mapping(organization)
+            if status_mapping:
+                self.stdout.write(f"{organization.name}: статусов {len(status_mapping)}")
+            else:
+                self.stdout.write(self.style.WARNING(f"{organization.name}: не удалось получить статусы"))
+
+        self.stdout.write(self.style.SUCCESS("Готово!"))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from zapp.services.token_budget import get_token_usage_by_organization
+
+
+class Command(BaseCommand):
+    help = 'Показывает расход токенов нейросети по организациям: токены запроса, ответа и всего'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=30, help="За сколько последних дней считать расход")
+
+    def handle(self, *args, **options):
+        usage = get_token_usage_by_organization(options["days"])
+        if not usage:
+            self.stdout.write("Запросов к нейросети за период нет.")
+
+        for row in usage:
+            self.stdout.write(
+                f"{row['organization__name']}: запросов {row['requests']}, "
+                f"токенов запроса {row['prompt_tokens'] or 0}, ответа {row['completion_tokens'] or 0}, "
+                f"всего {row['tokens_used'] or 0}"
+            )
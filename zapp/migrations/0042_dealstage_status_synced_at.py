@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 05:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zapp', '0041_alter_userprofile_role'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dealstage',
+            name='status_synced_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Статус сверен с CRM'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.1.4 on 2026-10-18 05:57
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def release_duplicate_webhook_keys(apps, schema_editor):
+    """
+    Повторные вебхуки раньше создавали дубли. Оставляем ключ у самого раннего запроса,
+    у более поздних очищаем note_id / call_id_b24 (сами запросы и их результаты сохраняются).
+    """
+    IncomingRequest = apps.get_model('zapp', 'IncomingRequest')
+
+    for field, empty in (('note_id', None), ('call_id_b24', '')):
+        duplicates = (
+            IncomingRequest.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+            .values('organization_id', field).annotate(total=Count('id')).filter(total__gt=1)
+        )
+        for duplicate in duplicates:
+            ids = list(
+                IncomingRequest.objects.filter(organization_id=duplicate['organization_id'], **{field: duplicate[field]})
+                .order_by('id').values_list('id', flat=True)
+            )
+            IncomingRequest.objects.filter(id__in=ids[1:]).update(**{field: empty})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zapp', '0042_dealstage_status_synced_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(release_duplicate_webhook_keys, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='incomingrequest',
+            constraint=models.UniqueConstraint(condition=models.Q(('note_id__isnull', False), models.Q(('note_id', ''), _negated=True)), fields=('organization', 'note_id'), name='unique_incoming_request_note'),
+        ),
+        migrations.AddConstraint(
+            model_name='incomingrequest',
+            constraint=models.UniqueConstraint(condition=models.Q(('call_id_b24', ''), _negated=True), fields=('organization', 'call_id_b24'), name='unique_incoming_request_call_b24'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 05:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zapp', '0043_incomingrequest_unique_webhook'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='s2trequest',
+            name='audio_fingerprint',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True, verbose_name='Отпечаток аудио'),
+        ),
+        migrations.AlterField(
+            model_name='s2trequest',
+            name='audio_link',
+            field=models.CharField(db_index=True, max_length=1000, verbose_name='Ссылка на аудиофайл'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.4 on 2026-10-18 06:00
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zapp', '0044_s2trequest_audio_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LLMResponseCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True, verbose_name='Ключ')),
+                ('model', models.CharField(max_length=255, verbose_name='Модель')),
+                ('answer', models.TextField(verbose_name='Ответ')),
+                ('raw_answer', models.TextField(blank=True, null=True, verbose_name='Полный ответ нейросети')),
+                ('tokens_used', models.IntegerField(blank=True, default=0, null=True, verbose_name='Токены')),
+                ('hits', models.IntegerField(default=0, verbose_name='Попаданий')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Последнее использование')),
+            ],
+            options={
+                'verbose_name': 'Кэш ответа нейросети',
+                'verbose_name_plural': 'Кэш ответов нейросети',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 06:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zapp', '0045_llmresponsecache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='structured_scoring',
+            field=models.BooleanField(default=False, verbose_name='Оценка звонков в формате JSON'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-18 06:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zapp', '0046_organization_structured_scoring'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='donkitrequest',
+            name='completion_tokens',
+            field=models.IntegerField(blank=True, null=True, verbose_name='Токены ответа'),
+        ),
+        migrations.AddField(
+            model_name='donkitrequest',
+            name='prompt_tokens',
+            field=models.IntegerField(blank=True, null=True, verbose_name='Токены запроса'),
+        ),
+        migrations.AddField(
+            model_name='llmresponsecache',
+            name='completion_tokens',
+            field=models.IntegerField(blank=True, null=True, verbose_name='Токены ответа'),
+        ),
+        migrations.AddField(
+            model_name='llmresponsecache',
+            name='prompt_tokens',
+            field=models.IntegerField(blank=True, null=True, verbose_name='Токены запроса'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-18 06:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zapp', '0047_donkitrequest_token_split'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='weeklyerrorreport',
+            name='last_processed_request_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='weeklyfactorreport',
+            name='last_processed_request_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='weeklyreport',
+            name='last_processed_request_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
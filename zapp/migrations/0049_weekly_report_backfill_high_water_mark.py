@@ -0,0 +1,67 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:40
+
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+from django.db import migrations
+from django.db.models import Max
+from django.utils import timezone
+
+# До появления отметки ночная задача generate_weekly_insights_for_all в 01:30 по Москве
+# анализировала ошибки и факторы по всем звонкам недели с готовой транскрибацией
+NIGHTLY_RUN_TIME = time(1, 30)
+NIGHTLY_RUN_TZ = ZoneInfo("Europe/Moscow")
+
+
+def get_last_nightly_run():
+    now = timezone.now().astimezone(NIGHTLY_RUN_TZ)
+    last_run = datetime.combine(now.date(), NIGHTLY_RUN_TIME, tzinfo=NIGHTLY_RUN_TZ)
+    return last_run if last_run <= now else last_run - timedelta(days=1)
+
+
+def set_high_water_marks(apps, schema_editor):
+    """
+    Ставит отметку last_processed_request_id уже проанализированным отчётам, чтобы первый запуск
+    после обновления не анализировал неделю заново (сохранение частот теперь накопительное).
+
+    Отчёты ошибок и факторов: последний звонок недели, транскрибация которого была готова к прошлому ночному запуску.
+    Отчёты инсайтов (запускались вручную): последний звонок из request_ids их инсайтов.
+    Отчёты, которые ещё не анализировались, остаются без отметки.
+    """
+    IncomingRequest = apps.get_model('zapp', 'IncomingRequest')
+    last_run = get_last_nightly_run()
+
+    for model_name in ('WeeklyErrorReport', 'WeeklyFactorReport'):
+        report_model = apps.get_model('zapp', model_name)
+        reports = report_model.objects.filter(last_processed_request_id__isnull=True, created_at__lt=last_run)
+        for report in reports:
+            mark = IncomingRequest.objects.filter(
+                organization_id=report.organization_id,
+                created_at__date__range=(report.week_start, report.week_end),
+                created_at__lt=last_run,
+                ignored=False,
+                related_s2t_requests__transcribed_text__gt='',
+                related_s2t_requests__updated_at__lt=last_run,
+            ).aggregate(mark=Max('id'))['mark']
+            if mark:
+                report_model.objects.filter(id=report.id).update(last_processed_request_id=mark)
+
+    WeeklyReport = apps.get_model('zapp', 'WeeklyReport')
+    for report in WeeklyReport.objects.filter(last_processed_request_id__isnull=True).prefetch_related('insights'):
+        request_ids = [
+            int(request_id) for insight in report.insights.all()
+            for request_id in insight.request_ids or [] if str(request_id).isdigit()
+        ]
+        if request_ids:
+            WeeklyReport.objects.filter(id=report.id).update(last_processed_request_id=max(request_ids))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zapp', '0048_weekly_report_high_water_mark'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_high_water_marks, migrations.RunPython.noop),
+    ]
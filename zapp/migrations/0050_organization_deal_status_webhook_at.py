@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zapp', '0049_weekly_report_backfill_high_water_mark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='deal_status_webhook_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Последний вебхук статусов сделок'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import User
 from django.utils import timezone
 
@@ -105,6 +106,15 @@ class Organization(models.Model):
         default=False,
         verbose_name="Отправлять саммари в сделки"
     )
+    structured_scoring = models.BooleanField(
+        default=False,
+        verbose_name="Оценка звонков в формате JSON"
+    )
+    deal_status_webhook_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        verbose_name="Последний вебхук статусов сделок"
+    )
   
     class Meta:
         verbose_name = "Организация"
@@ -201,6 +211,19 @@ class IncomingRequest(models.Model):
         verbose_name = "Входящий запрос"
         verbose_name_plural = "Входящие запросы"
         ordering = ['-created_at']
+        constraints = [
+            # Повторная доставка вебхука не должна создавать второй запрос (и платную транскрибацию)
+            models.UniqueConstraint(
+                fields=["organization", "note_id"],
+                condition=Q(note_id__isnull=False) & ~Q(note_id=""),
+                name="unique_incoming_request_note",
+            ),
+            models.UniqueConstraint(
+                fields=["organization", "call_id_b24"],
+                condition=~Q(call_id_b24=""),
+                name="unique_incoming_request_call_b24",
+            ),
+        ]
 
     def save(self, *args, **kwargs):
         if self.crm_entity_type:
@@ -225,6 +248,7 @@ class S2TRequest(models.Model):
         json_result_link (str): Ссылка на JSON результат.
         transcribed_text (str): Транскрибированный текст.
         status (str): Текущий статус задачи.
+        audio_fingerprint (str): Отпечаток аудиофайла для кэша транскрибаций.
         created_at (datetime): Дата создания.
         updated_at (datetime): Дата последнего обновления.
     """
@@ -236,12 +260,14 @@ class S2TRequest(models.Model):
         verbose_name="Связанный входящий запрос"
     )
     task_id = models.CharField(max_length=255, verbose_name="ID задачи в Speech2Text")
-    audio_link = models.CharField(max_length=1000, verbose_name="Ссылка на аудиофайл")
+    audio_link = models.CharField(max_length=1000, db_index=True, verbose_name="Ссылка на аудиофайл")
     raw_result_link = models.CharField(max_length=1000, blank=True, null=True, verbose_name="Ссылка на raw результат")
     txt_result_link = models.CharField(max_length=1000, blank=True, null=True, verbose_name="Ссылка на txt результат")
     json_result_link = models.CharField(max_length=1000, blank=True, null=True, verbose_name="Ссылка на json результат")
     transcribed_text = models.TextField(blank=True, null=True, verbose_name="Транскрибированный текст")
     status = models.CharField(max_length=255, default="pending", verbose_name="Статус задачи")
+    # sha256 от начала файла и его размера — одинаковые записи по разным ссылкам не транскрибируются повторно
+    audio_fingerprint = models.CharField(max_length=64, blank=True, null=True, db_index=True, verbose_name="Отпечаток аудио")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата последнего обновления")
     
@@ -291,6 +317,8 @@ class DonkitRequest(models.Model):
         question (str): Заданный вопрос.
         answer (str): Полученный ответ.
         tokens_used (int): Количество использованных токенов на обработку запроса.
+        prompt_tokens (int): Токены запроса (включая сжатие длинной транскрибации).
+        completion_tokens (int): Токены ответа.
         status (str): Статус запроса.
         created_at (datetime): Дата создания.
         updated_at (datetime): Дата последнего обновления.
@@ -311,6 +339,8 @@ class DonkitRequest(models.Model):
     question = models.TextField(verbose_name="Вопрос")
     answer = models.TextField(blank=True, null=True, verbose_name="Ответ")
     tokens_used = models.IntegerField(null=True, blank=True, default=0, verbose_name="Токены")
+    prompt_tokens = models.IntegerField(null=True, blank=True, verbose_name="Токены запроса")
+    completion_tokens = models.IntegerField(null=True, blank=True, verbose_name="Токены ответа")
     status = models.CharField(max_length=255, default="pending", verbose_name="Статус")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
@@ -332,6 +362,41 @@ class DonkitRequest(models.Model):
         return f"DeepSeekV3Request {self.chat_id} для {self.organization.name}"
 
 
+class LLMResponseCache(models.Model):
+    """
+    Кэш ответов нейросети: повторный запрос с той же моделью, промптом и транскрибацией не отправляется в API.
+
+    Атрибуты:
+        key (str): sha256 от модели, текста промпта и транскрибации.
+        model (str): Модель, давшая ответ.
+        answer (str): Ответ нейросети.
+        raw_answer (str): Полный ответ нейросети.
+        tokens_used (int): Токены, потраченные на исходный запрос.
+        prompt_tokens (int): Токены исходного запроса.
+        completion_tokens (int): Токены исходного ответа.
+        hits (int): Сколько раз ответ взят из кэша.
+        created_at (datetime): Дата создания.
+        last_used_at (datetime): Последнее использование (по нему вытесняются старые записи).
+    """
+    key = models.CharField(max_length=64, unique=True, verbose_name="Ключ")
+    model = models.CharField(max_length=255, verbose_name="Модель")
+    answer = models.TextField(verbose_name="Ответ")
+    raw_answer = models.TextField(blank=True, null=True, verbose_name="Полный ответ нейросети")
+    tokens_used = models.IntegerField(null=True, blank=True, default=0, verbose_name="Токены")
+    prompt_tokens = models.IntegerField(null=True, blank=True, verbose_name="Токены запроса")
+    completion_tokens = models.IntegerField(null=True, blank=True, verbose_name="Токены ответа")
+    hits = models.IntegerField(default=0, verbose_name="Попаданий")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name="Последнее использование")
+
+    class Meta:
+        verbose_name = "Кэш ответа нейросети"
+        verbose_name_plural = "Кэш ответов нейросети"
+
+    def __str__(self):
+        return f"LLMResponseCache {self.key[:12]} ({self.model})"
+
+
 # depricated model
 class Criteria(models.Model):
     """
@@ -473,6 +538,8 @@ class DealStage(models.Model):
     deal_id_crm = models.CharField(max_length=255, verbose_name="ID сделки в CRM")
     deal_type = models.CharField(max_length=20, choices=DEAL_TYPE_CHOICES, verbose_name="Тип сделки")
     status = models.CharField(max_length=255, blank=True, null=True, verbose_name="Статус сделки")
+    # Когда статус последний раз получен из CRM (вебхук или ночная сверка)
+    status_synced_at = models.DateTimeField(blank=True, null=True, db_index=True, verbose_name="Статус сверен с CRM")
 
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
@@ -569,6 +636,8 @@ class WeeklyReport(models.Model):
     week_end = models.DateField()
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # ID последнего проанализированного звонка: следующий запуск анализирует только более новые
+    last_processed_request_id = models.BigIntegerField(null=True, blank=True)
 
 
     class Meta:
@@ -621,6 +690,8 @@ class WeeklyFactorReport(models.Model):
     week_end = models.DateField()
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # ID последнего проанализированного звонка: следующий запуск анализирует только более новые
+    last_processed_request_id = models.BigIntegerField(null=True, blank=True)
 
     class Meta:
         unique_together = ('organization', 'week_start')
@@ -664,6 +735,8 @@ class WeeklyErrorReport(models.Model):
     week_end = models.DateField()
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # ID последнего проанализированного звонка: следующий запуск анализирует только более новые
+    last_processed_request_id = models.BigIntegerField(null=True, blank=True)
 
     class Meta:
         unique_together = ('organization', 'week_start')
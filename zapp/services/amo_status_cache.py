@@ -0,0 +1,109 @@
+import logging, time
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from .amocrm_service import get_amo_lead_statuses
+from .organization_cache import get_organization_by_id
+from .rate_limiter import CRMRateLimitError
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд справочник статусов считается устаревшим и обновляется в фоне
+AMO_STATUS_CACHE_TTL = getattr(settings, "AMO_STATUS_CACHE_TTL", 3600)
+# Сколько секунд устаревший справочник ещё отдаётся, пока идёт обновление
+AMO_STATUS_CACHE_MAX_AGE = getattr(settings, "AMO_STATUS_CACHE_MAX_AGE", 7 * 24 * 3600)
+# Не чаще одного внепланового обновления за этот интервал при неизвестном status_id
+AMO_STATUS_UNKNOWN_REFRESH_INTERVAL = getattr(settings, "AMO_STATUS_UNKNOWN_REFRESH_INTERVAL", 60)
+
+REFRESH_LOCK_TIMEOUT = 300
+
+
+def _cache_key(organization_id):
+    return f"amo_statuses:{organization_id}"
+
+
+def _lock_key(organization_id):
+    return f"amo_statuses:refresh:{organization_id}"
+
+
+def refresh_amo_status_mapping(organization):
+    """
+    Загружает справочник статусов из amoCRM и сохраняет его в кэш.
+    Пустой ответ (ошибка API) в кэш не пишется, чтобы не затереть рабочий справочник.
+    """
+    status_mapping = get_amo_lead_statuses(organization)
+    if status_mapping:
+        try:
+            cache.set(
+                _cache_key(organization.id),
+                {"mapping": status_mapping, "fetched_at": time.time()},
+                AMO_STATUS_CACHE_MAX_AGE,
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить статусы amoCRM в кэш: {str(e)}")
+    return status_mapping
+
+
+@shared_task(autoretry_for=(CRMRateLimitError,), retry_backoff=5, retry_jitter=True, max_retries=5)
+def refresh_amo_status_mapping_task(organization_id):
+    """
+    Фоновое обновление справочника статусов организации.
+    """
+    try:
+        organization = get_organization_by_id(organization_id)
+        if organization and organization.bearer_amocrm:
+            refresh_amo_status_mapping(organization)
+    finally:
+        cache.delete(_lock_key(organization_id))
+
+
+def get_amo_status_mapping(organization):
+    """
+    Справочник статусов amoCRM (ID -> название) из кэша.
+    Устаревший справочник отдаётся сразу, а обновление ставится в фон (не больше одной задачи на организацию).
+    """
+    try:
+        entry = cache.get(_cache_key(organization.id))
+    except Exception as e:
+        logger.warning(f"Кэш статусов amoCRM недоступен: {str(e)}")
+        return get_amo_lead_statuses(organization)
+
+    if entry is None:
+        return refresh_amo_status_mapping(organization)
+
+    if time.time() - entry["fetched_at"] > AMO_STATUS_CACHE_TTL:
+        try:
+            if cache.add(_lock_key(organization.id), 1, REFRESH_LOCK_TIMEOUT):
+                refresh_amo_status_mapping_task.delay(organization.id)
+        except Exception as e:
+            logger.warning(f"Не удалось запустить обновление статусов amoCRM: {str(e)}")
+
+    return entry["mapping"]
+
+
+def get_amo_status_name(organization, status_id, status_mapping=None):
+    """
+    Название статуса сделки amoCRM.
+    Если статуса нет в справочнике (например, этап только что создан), справочник один раз обновляется сразу.
+
+    :param status_mapping: справочник, уже полученный get_amo_status_mapping, — чтобы при разборе пачки сделок
+        не читать кэш на каждую сделку. При обновлении справочника он дополняется на месте.
+    """
+    if status_id is None:
+        return "Неизвестный статус (None)"
+
+    status_id = str(status_id)
+    if status_mapping is None:
+        status_mapping = get_amo_status_mapping(organization)
+
+    if status_id not in status_mapping:
+        try:
+            refresh_allowed = cache.add(
+                f"amo_statuses:unknown:{organization.id}", 1, AMO_STATUS_UNKNOWN_REFRESH_INTERVAL
+            )
+        except Exception:
+            refresh_allowed = False
+        if refresh_allowed:
+            status_mapping.update(refresh_amo_status_mapping(organization) or {})
+
+    return status_mapping.get(status_id, f"Неизвестный статус ({status_id})")
@@ -1,10 +1,23 @@
-import requests, logging, json
-from datetime import datetime
+import logging, json
 from celery import shared_task
 from ..models import *
+from .organization_cache import get_organization_by_id
+from .http_client import get_http_session
+from .rate_limiter import CRMRateLimitError, wait_for_amocrm
 
 logger = logging.getLogger(__name__)
 
+def amo_request(method, subdomain, url, **kwargs):
+    """
+    Запрос к API amoCRM с ожиданием токена в лимитере аккаунта (около 7 запросов в секунду).
+    Если amoCRM всё равно вернул 429, поднимает CRMRateLimitError, чтобы задача ушла на повтор.
+    """
+    wait_for_amocrm(subdomain)
+    response = get_http_session().request(method, url, **kwargs)
+    if response.status_code == 429:
+        raise CRMRateLimitError(f"amoCRM {subdomain} ограничил частоту запросов")
+    return response
+
 
 def get_contact_with_leads(contact_id, organization):
     """
@@ -15,39 +28,35 @@ def get_contact_with_leads(contact_id, organization):
         headers = {
             "Authorization": f"Bearer {organization.bearer_amocrm}"
         }
-        response = requests.get(url, headers=headers, timeout=(10, 60))
+        response = amo_request("GET", organization.account_amocrm, url, headers=headers)
         if response.status_code != 200:
             return None
 
         return response.json()
+    except CRMRateLimitError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при получении данных контакта {contact_id}: {str(e)}")
         return None
 
 
-def get_lead_tags(subdomain, lead_id, token):
+def get_leads_tags(organization, lead_ids):
     """
-    Получение тегов сделки через данные сделки.
+    Теги нескольких сделок одним списочным запросом по filter[id][].
+
+    :return: dict ID сделки (строкой) -> список названий тегов.
     """
-    try:
-        url = f"https://{subdomain}.amocrm.ru/api/v4/leads/{lead_id}"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
+    return {
+        lead_id: [tag["name"] for tag in lead.get("_embedded", {}).get("tags", [])]
+        for lead_id, lead in get_leads_by_ids(organization, lead_ids).items()
+    }
 
-        response = requests.get(url, headers=headers, timeout=(10, 60))
 
-        if response.status_code == 200:
-            # Извлекаем теги из ответа
-            lead_data = response.json()
-            return lead_data.get('_embedded', {}).get('tags', [])
-        else:
-            return []
-
-    except Exception as e:
-        logger.error(f"Ошибка при выполнении запроса данных сделки {lead_id}: {str(e)}")
-        return []
+def get_lead_tags(organization, lead_id):
+    """
+    Получение тегов сделки (названия).
+    """
+    return get_leads_tags(organization, [lead_id]).get(str(lead_id), [])
 
 
 def has_lead_tag(lead_id, organization, tag_name):
@@ -55,18 +64,15 @@ def has_lead_tag(lead_id, organization, tag_name):
     Проверяет, есть ли у сделки указанный тег.
     """
     try:
-        # Передаем subdomain и token в get_lead_tags
-        tags = get_lead_tags(
-            subdomain=organization.account_amocrm,
-            lead_id=lead_id,
-            token=organization.bearer_amocrm
-        )
+        tags = get_lead_tags(organization, lead_id)
         if not tags or not tag_name:
             return False
 
         # Приводим все теги и искомый тег к нижнему регистру
         tag_name_lower = tag_name.lower()
-        return any(tag["name"].lower() == tag_name_lower for tag in tags)
+        return any(tag.lower() == tag_name_lower for tag in tags)
+    except CRMRateLimitError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при проверке тега сделки {lead_id}: {str(e)}")
         return False
@@ -77,33 +83,32 @@ def get_active_leads_with_tag(contact_id, organization, tag_name=None):
     Получает активные сделки контакта.
     Если указан тег, фильтрует сделки по наличию этого тега.
     Если тег не указан, возвращает все активные сделки.
+    Сделки вместе со статусами и тегами загружаются одним списочным запросом, а не по одной.
     """
     try:
-        # Получаем данные контакта с привязанными сделками
-        contact_data = get_contact_with_leads(contact_id, organization)
-        if not contact_data:
+        contact_leads = resolve_contact_leads(contact_id, organization)
+        if not contact_leads:
             return []
 
-        # Извлекаем сделки
-        leads = contact_data.get("_embedded", {}).get("leads", [])
-        active_leads = [lead for lead in leads if not lead.get("is_deleted") and lead.get("status_id") not in {142, 143}]
+        active_leads = [lead for lead in contact_leads["leads"] if lead.get("status_id") not in EXCLUDED_STATUSES]
 
         if not tag_name:
-                return active_leads  # Если тег не указан — возвращаем все активные лиды
-        
-        # Проверяем наличие указанного тега
-        active_leads_with_tag = []
-        for lead in active_leads:
-            if has_lead_tag(lead["id"], organization, tag_name):
-                active_leads_with_tag.append(lead)
+            return active_leads  # Если тег не указан — возвращаем все активные лиды
 
-        return active_leads_with_tag
+        # Проверяем наличие указанного тега по уже загруженным данным сделок
+        tag_name_lower = tag_name.lower()
+        return [
+            lead for lead in active_leads
+            if any(tag["name"].lower() == tag_name_lower for tag in lead.get("_embedded", {}).get("tags", []))
+        ]
+    except CRMRateLimitError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при получении активных сделок с тегом {tag_name} для контакта {contact_id}: {str(e)}")
         return []
 
 
-@shared_task
+@shared_task(autoretry_for=(CRMRateLimitError,), retry_backoff=5, retry_jitter=True, max_retries=10)
 def add_amo_note(organization_id, user_id, comment):
     """
     Асинхронно добавляет примечание к контакту в amoCRM.
@@ -114,11 +119,10 @@ def add_amo_note(organization_id, user_id, comment):
     :param comment: Текст примечания.
     """
     
-    organization = Organization.objects.get(id=organization_id)
-    auth_token = organization.bearer_amocrm
-
-    if not auth_token:
+    organization = get_organization_by_id(organization_id)
+    if not organization or not organization.bearer_amocrm:
         return None
+    auth_token = organization.bearer_amocrm
 
     url = f"https://{organization.account_amocrm}.amocrm.ru/api/v4/contacts/{user_id}/notes"
     headers = {
@@ -135,7 +139,7 @@ def add_amo_note(organization_id, user_id, comment):
         }
     ]
 
-    response = requests.post(url, headers=headers, json=data)
+    response = amo_request("POST", organization.account_amocrm, url, headers=headers, json=data)
     
     if response.status_code == 200:
         return response.json()
@@ -143,17 +147,16 @@ def add_amo_note(organization_id, user_id, comment):
         logger.error(f"Ошибка добавления примечания в amoCRM: {response.status_code}, {response.text}")
 
 
-@shared_task
+@shared_task(autoretry_for=(CRMRateLimitError,), retry_backoff=5, retry_jitter=True, max_retries=10)
 def add_note_to_lead(organization_id, lead_id, comment):
     """
     Добавляет примечание к сделке в amoCRM.
     """
     try:
-        organization = Organization.objects.get(id=organization_id)
-        auth_token = organization.bearer_amocrm
-
-        if not auth_token:
+        organization = get_organization_by_id(organization_id)
+        if not organization or not organization.bearer_amocrm:
             return None
+        auth_token = organization.bearer_amocrm
 
         url = f"https://{organization.account_amocrm}.amocrm.ru/api/v4/leads/{lead_id}/notes"
         headers = {
@@ -170,85 +173,81 @@ def add_note_to_lead(organization_id, lead_id, comment):
             }
         ]
 
-        response = requests.post(url, headers=headers, json=data)
+        response = amo_request("POST", organization.account_amocrm, url, headers=headers, json=data)
         
         if response.status_code == 200:
             return response.json()
 
+    except CRMRateLimitError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при добавлении примечания в сделку {lead_id}: {str(e)}")
 
 
+@shared_task(autoretry_for=(CRMRateLimitError,), retry_backoff=5, retry_jitter=True, max_retries=10)
+def add_summary_to_active_leads(organization_id, contact_id, comment):
+    """
+    Добавляет примечание во все активные сделки контакта.
+    Вынесено в отдельную задачу, чтобы при 429 от amoCRM повторялся только поиск сделок, а не запрос к LLM.
+    """
+    organization = get_organization_by_id(organization_id)
+    if not organization or not organization.bearer_amocrm:
+        return None
+
+    for lead in get_active_leads_with_tag(contact_id, organization):
+        add_note_to_lead.delay(organization.id, lead["id"], comment)
+
+
 # Исключаем завершенные сделки (142 - успешные, 143 - неуспешные)
 EXCLUDED_STATUSES = {142, 143}
 
-def get_latest_active_lead(contact_id, organization):
+def pick_latest_active_lead(leads):
     """
-    Получает последнюю активную сделку (лид) для контакта в amoCRM.
-
-    :param contact_id: ID контакта в amoCRM.
-    :param organization: Организация (модель Organization), откуда берем API-ключ.
-    :return: ID последней активной сделки или None, если сделок нет.
+    Выбирает из полных данных сделок самую свежую (по created_at) незакрытую сделку.
     """
-    try:
-        base_url = f"https://{organization.account_amocrm}.amocrm.ru"
-        contact_url = f"{base_url}/api/v4/contacts/{contact_id}?with=leads"
-        headers = {
-            "Authorization": f"Bearer {organization.bearer_amocrm}"
-        }
-
-        # Запрашиваем контакт и связанные сделки
-        response = requests.get(contact_url, headers=headers, timeout=(10, 60))
-        if response.status_code != 200:
-            return None
+    active_leads = [
+        lead for lead in leads
+        if lead.get("status_id") not in EXCLUDED_STATUSES and lead.get("created_at")
+    ]
+    return max(active_leads, key=lambda lead: lead["created_at"], default=None)
 
-        contact_data = response.json()
 
-        # Проверяем, есть ли сделки у контакта
-        linked_leads = contact_data.get("_embedded", {}).get("leads", [])
-        if not linked_leads:
-            return None
-
-        latest_lead = None
+def resolve_contact_leads(contact_id, organization):
+    """
+    Получает контакт и все его сделки за два запроса: контакт с ?with=leads
+    и один список сделок по filter[id][] (вместо отдельного запроса на каждую сделку).
 
-        # Перебираем все сделки контакта и выбираем самую актуальную
-        for lead in linked_leads:
-            lead_id = lead["id"]
-            lead_url = f"{base_url}/api/v4/leads/{lead_id}"
-            lead_response = requests.get(lead_url, headers=headers, timeout=(10, 60))
+    :param contact_id: ID контакта в amoCRM.
+    :param organization: Организация (модель Organization), откуда берем API-ключ.
+    :return: dict с ключами contact, leads (полные данные сделок) и latest_active_lead
+             (последняя активная сделка или None); None, если контакт получить не удалось.
+    """
+    contact_data = get_contact_with_leads(contact_id, organization)
+    if not contact_data:
+        return None
 
-            if lead_response.status_code != 200:
-                continue  # Пропускаем ошибочную сделку
+    lead_ids = [lead["id"] for lead in contact_data.get("_embedded", {}).get("leads", [])]
+    leads = list(get_leads_by_ids(organization, lead_ids).values()) if lead_ids else []
 
-            lead_data = lead_response.json()
-            status_id = lead_data.get("status_id")
+    return {
+        "contact": contact_data,
+        "leads": leads,
+        "latest_active_lead": pick_latest_active_lead(leads),
+    }
 
-            # Проверяем, что статус сделки не находится в исключенных
-            if status_id in EXCLUDED_STATUSES:
-                continue
 
-            # Берем дату создания сделки
-            created_at = lead_data.get("created_at")
-            if created_at:
-                created_at = datetime.fromtimestamp(created_at)  # Преобразуем timestamp в дату
-
-                # Сравниваем с последней найденной активной сделкой
-                if not latest_lead or created_at > latest_lead["created_at"]:
-                    latest_lead = {
-                        "id": lead_id,
-                        "name": lead_data.get("name"),
-                        "status_id": status_id,
-                        "created_at": created_at
-                    }
-
-        if latest_lead:
-            return latest_lead["id"]
-        else:
-            return None
+def get_latest_active_lead(contact_id, organization):
+    """
+    Получает последнюю активную сделку (лид) для контакта в amoCRM.
 
-    except Exception as e:
-        logger.error(f"Ошибка при получении активного лида для контакта {contact_id}: {str(e)}")
+    :param contact_id: ID контакта в amoCRM.
+    :param organization: Организация (модель Organization), откуда берем API-ключ.
+    :return: ID последней активной сделки или None, если сделок нет.
+    """
+    contact_leads = resolve_contact_leads(contact_id, organization)
+    if not contact_leads or not contact_leads["latest_active_lead"]:
         return None
+    return contact_leads["latest_active_lead"]["id"]
 
 
 def get_lead_details(lead_id, organization):
@@ -263,16 +262,53 @@ def get_lead_details(lead_id, organization):
             "Authorization": f"Bearer {organization.bearer_amocrm}"
         }
 
-        response = requests.get(lead_url, headers=headers, timeout=(10, 60))
+        response = amo_request("GET", organization.account_amocrm, lead_url, headers=headers)
         if response.status_code != 200:
             return None
 
         return response.json()  # Возвращаем JSON-объект с данными о сделке
+    except CRMRateLimitError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при запросе данных сделки {lead_id}: {str(e)}")
         return None
     
 
+# Максимальный размер страницы списка сделок в API amoCRM
+AMO_LEADS_PAGE_SIZE = 250
+
+def get_leads_by_ids(organization, lead_ids):
+    """
+    Получает сделки списком через filter[id][] — одним запросом на каждые AMO_LEADS_PAGE_SIZE сделок.
+
+    :return: dict ID сделки (строкой) -> данные сделки. Сделки из неудачных запросов в результат не попадают.
+    """
+    headers = {"Authorization": f"Bearer {organization.bearer_amocrm}"}
+    url = f"https://{organization.account_amocrm}.amocrm.ru/api/v4/leads"
+    lead_ids = [str(lead_id) for lead_id in lead_ids]
+    leads = {}
+
+    for start in range(0, len(lead_ids), AMO_LEADS_PAGE_SIZE):
+        page_ids = lead_ids[start:start + AMO_LEADS_PAGE_SIZE]
+        params = [("filter[id][]", lead_id) for lead_id in page_ids] + [("limit", AMO_LEADS_PAGE_SIZE)]
+        try:
+            response = amo_request("GET", organization.account_amocrm, url, headers=headers, params=params)
+            if response.status_code == 204:  # Ни одной сделки не найдено
+                continue
+            if response.status_code != 200:
+                logger.error(f"Ошибка получения сделок amoCRM: {response.status_code}, {response.text}")
+                continue
+
+            for lead in response.json().get("_embedded", {}).get("leads", []):
+                leads[str(lead["id"])] = lead
+        except CRMRateLimitError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при запросе списка сделок amoCRM: {str(e)}")
+
+    return leads
+
+
 def get_amo_lead_statuses(organization):
     """
     Получает список статусов сделок из amoCRM.
@@ -281,7 +317,7 @@ def get_amo_lead_statuses(organization):
         url = f"https://{organization.account_amocrm}.amocrm.ru/api/v4/leads/pipelines"
         headers = {"Authorization": f"Bearer {organization.bearer_amocrm}"}
         
-        response = requests.get(url, headers=headers, timeout=(10, 60))
+        response = amo_request("GET", organization.account_amocrm, url, headers=headers)
         if response.status_code != 200:
             return {}
 
@@ -295,6 +331,8 @@ def get_amo_lead_statuses(organization):
 
         return status_mapping
 
+    except CRMRateLimitError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при запросе статусов amoCRM: {str(e)}")
         return {}
@@ -324,7 +362,7 @@ def get_note_text_by_id(note_id, element_id, element_type, organization):
             "Authorization": f"Bearer {organization.bearer_amocrm}"
         }
 
-        response = requests.get(url, headers=headers, timeout=(10, 60))
+        response = amo_request("GET", organization.account_amocrm, url, headers=headers)
 
         if response.status_code != 200:
             return {}
@@ -333,6 +371,8 @@ def get_note_text_by_id(note_id, element_id, element_type, organization):
 
         return json_data
 
+    except CRMRateLimitError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при получении данных примечания {note_id}: {str(e)}")
         return {}
@@ -348,7 +388,7 @@ def fetch_and_create_managers(organization):
             "Authorization": f"Bearer {organization.bearer_amocrm}"
         }
 
-        response = requests.get(url, headers=headers, timeout=(10, 60))
+        response = amo_request("GET", organization.account_amocrm, url, headers=headers)
 
         if response.status_code != 200:
             return
@@ -1,9 +1,16 @@
-import requests, logging, re
+import logging, re
 from celery import shared_task
-from ..models import *
+from .organization_cache import get_organization_by_id
+from .http_client import http_post
+from .rate_limiter import CRMRateLimitError, wait_for_bitrix24
 
 logger = logging.getLogger(__name__)
 
+# Финальные статусы лидов Bitrix24 (сконвертирован / некачественный)
+BITRIX_FINAL_LEAD_STATUSES = ["CONVERTED", "JUNK"]
+# Максимум команд в одном вызове batch
+BITRIX_BATCH_SIZE = 50
+
 
 def call_bitrix_method(organization, api_key, method, data):
     """
@@ -14,10 +21,16 @@ def call_bitrix_method(organization, api_key, method, data):
     :param method: Метод API Bitrix24 (например, 'voximplant.statistic.get' или 'crm.timeline.comment.add').
     :param data: Данные для отправки в Bitrix24.
     :return: JSON-ответ от Bitrix24 или None в случае ошибки.
+    :raises CRMRateLimitError: если Bitrix24 ограничил частоту запросов (задачу нужно повторить позже).
     """
     url = f"https://{organization.b24_domain}.bitrix24.ru/rest/{organization.b24_admin_id}/{api_key}/{method}"
     
-    response = requests.post(url, json=data)
+    wait_for_bitrix24(organization.b24_domain)
+    response = http_post(url, json=data)
+
+    # Bitrix24 сообщает о превышении лимита через 503 QUERY_LIMIT_EXCEEDED
+    if response.status_code == 429 or (response.status_code == 503 and "QUERY_LIMIT_EXCEEDED" in response.text):
+        raise CRMRateLimitError(f"Bitrix24 {organization.b24_domain} ограничил частоту запросов")
 
     if response.status_code == 200:
         return response.json()
@@ -51,7 +64,7 @@ def get_lead_by_company_id(organization, company_id):
     data = {
         "filter": {
             "COMPANY_ID": company_id,
-            "!STATUS_ID": ["CONVERTED", "JUNK"]
+            "!STATUS_ID": BITRIX_FINAL_LEAD_STATUSES
         },
         "select": ["ID", "TITLE", "STATUS_ID"],
         "order": {"ID": "DESC"}  # Берем последний актуальный лид
@@ -65,7 +78,7 @@ def get_lead_by_company_id(organization, company_id):
         return None
     
 
-@shared_task
+@shared_task(autoretry_for=(CRMRateLimitError,), retry_backoff=5, retry_jitter=True, max_retries=10)
 def add_bitrix_comment(organization_id, crm_entity_type, crm_entity_id, comment):
     """
     Асинхронно добавляет комментарий к контакту в Bitrix24.
@@ -76,9 +89,8 @@ def add_bitrix_comment(organization_id, crm_entity_type, crm_entity_id, comment)
     :param crm_entity_id: ID сущности в Bitrix24.
     :param comment: Полный текст комментария (из которого берем только часть после "8.")
     """
-    try:
-        organization = Organization.objects.get(id=organization_id)
-    except Organization.DoesNotExist:
+    organization = get_organization_by_id(organization_id)
+    if not organization:
         return
     
     # Извлекаем текст после "8."
@@ -122,5 +134,42 @@ def get_bitrix_lead_details(organization, lead_id):
             return result["result"].get("STATUS_ID", "").strip()  # Возвращаем JSON с деталями лида
         else:
             return None
+    except CRMRateLimitError:
+        raise
     except Exception as e:
-        return None
\ No newline at end of file
+        return None
+
+
+def get_bitrix_lead_statuses(organization, lead_ids):
+    """
+    Получает статусы лидов через метод batch — до BITRIX_BATCH_SIZE вызовов crm.lead.get за один запрос.
+
+    :return: dict ID лида (строкой) -> STATUS_ID. Лиды, которые не удалось получить, в результат не попадают.
+    """
+    lead_ids = [str(lead_id) for lead_id in lead_ids]
+    statuses = {}
+
+    for start in range(0, len(lead_ids), BITRIX_BATCH_SIZE):
+        commands = {
+            f"lead_{lead_id}": f"crm.lead.get?ID={lead_id}"
+            for lead_id in lead_ids[start:start + BITRIX_BATCH_SIZE]
+        }
+        try:
+            response = call_bitrix_method(organization, organization.b24_api_leads, "batch", {"halt": 0, "cmd": commands})
+        except CRMRateLimitError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка batch-запроса лидов Bitrix24: {str(e)}")
+            continue
+
+        if not response or "result" not in response:
+            continue
+
+        results = response["result"].get("result") or {}
+        if isinstance(results, list):  # Bitrix24 отдаёт пустой результат списком
+            continue
+        for lead in results.values():
+            if lead and lead.get("ID"):
+                statuses[str(lead["ID"])] = (lead.get("STATUS_ID") or "").strip()
+
+    return statuses
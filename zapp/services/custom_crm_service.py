@@ -1,5 +1,5 @@
-import requests
 import logging
+from .http_client import http_post
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +16,7 @@ def send_custom_crm_note(organization, external_id, text):
     logger.warning(payload)
 
     try:
-        response = requests.post(url, json=payload, timeout=10)
+        response = http_post(url, json=payload, timeout=10)
         response.raise_for_status()
     except Exception as e:
         logger.error(f"[CustomCRM] Ошибка при отправке заметки: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,149 @@
+import logging, threading, time
+import requests
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Таймауты (подключение, чтение) по умолчанию для всех интеграций
+DEFAULT_TIMEOUT = getattr(settings, "HTTP_CLIENT_TIMEOUT", (10, 60))
+# Сколько хостов держим в пуле и сколько соединений на хост
+HTTP_POOL_HOSTS = getattr(settings, "HTTP_POOL_HOSTS", 50)
+HTTP_POOL_SIZE = getattr(settings, "HTTP_POOL_SIZE", 20)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+METRICS_KEY_PREFIX = "http_metrics"
+METRICS_HOSTS_KEY = f"{METRICS_KEY_PREFIX}:hosts"
+
+
+class IntegrationRetry(Retry):
+    """
+    Повтор с экспоненциальной задержкой и джиттером.
+    POST повторяется только при 429: запрос гарантированно не выполнен, и примечание не задвоится.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method and method.upper() == "POST":
+            return status_code == 429 and bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def build_retry():
+    return IntegrationRetry(
+        total=3,
+        connect=3,
+        read=2,
+        status=3,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        backoff_max=10,
+        status_forcelist=RETRY_STATUSES,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+class IntegrationSession(requests.Session):
+    """
+    Session с таймаутом по умолчанию и учётом задержек и ошибок по хостам.
+    """
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        host = urlparse(url).hostname or "unknown"
+        started = time.monotonic()
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.RequestException:
+            record_request(host, time.monotonic() - started, error=True)
+            raise
+        record_request(host, time.monotonic() - started, error=response.status_code in RETRY_STATUSES)
+        return response
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Общая для процесса сессия: пулы keep-alive соединений по хостам, таймауты и повторы.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = IntegrationSession()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE, max_retries=build_retry())
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def http_get(url, **kwargs):
+    return get_http_session().get(url, **kwargs)
+
+
+def http_post(url, **kwargs):
+    return get_http_session().post(url, **kwargs)
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+_metrics_flushed_at = time.monotonic()
+METRICS_FLUSH_INTERVAL = 10  # сек
+
+
+def record_request(host, elapsed, error=False):
+    """
+    Копит в памяти число запросов, ошибок и суммарную задержку по хосту
+    и раз в METRICS_FLUSH_INTERVAL секунд сбрасывает их в Redis.
+    """
+    global _metrics, _metrics_flushed_at
+    with _metrics_lock:
+        host_metrics = _metrics.setdefault(host, {"requests": 0, "errors": 0, "latency_total": 0.0})
+        host_metrics["requests"] += 1
+        host_metrics["errors"] += int(error)
+        host_metrics["latency_total"] += elapsed
+
+        if time.monotonic() - _metrics_flushed_at < METRICS_FLUSH_INTERVAL:
+            return
+        pending, _metrics = _metrics, {}
+        _metrics_flushed_at = time.monotonic()
+
+    flush_metrics(pending)
+
+
+def flush_metrics(pending):
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for host, data in pending.items():
+            key = f"{METRICS_KEY_PREFIX}:{host}"
+            pipe.sadd(METRICS_HOSTS_KEY, host)
+            pipe.hincrby(key, "requests", data["requests"])
+            pipe.hincrby(key, "errors", data["errors"])
+            pipe.hincrbyfloat(key, "latency_total", data["latency_total"])
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Не удалось записать метрики HTTP: {str(e)}")
+
+
+def get_host_metrics():
+    """
+    Возвращает метрики по хостам: {host: {"requests", "errors", "avg_latency"}}.
+    """
+    client = get_redis()
+    metrics = {}
+    for raw_host in sorted(client.smembers(METRICS_HOSTS_KEY)):
+        host = raw_host.decode()
+        data = {k.decode(): v.decode() for k, v in client.hgetall(f"{METRICS_KEY_PREFIX}:{host}").items()}
+        count = int(data.get("requests", 0))
+        metrics[host] = {
+            "requests": count,
+            "errors": int(data.get("errors", 0)),
+            "avg_latency": float(data.get("latency_total", 0)) / count if count else 0,
+        }
+    return metrics
@@ -0,0 +1,79 @@
+import hashlib, logging
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from ..models import LLMResponseCache
+
+logger = logging.getLogger(__name__)
+
+# Глобальный выключатель кэша ответов нейросети
+LLM_RESPONSE_CACHE = getattr(settings, "LLM_RESPONSE_CACHE", True)
+# Максимум записей в кэше; при превышении удаляются давно не использованные
+LLM_RESPONSE_CACHE_MAX_ENTRIES = getattr(settings, "LLM_RESPONSE_CACHE_MAX_ENTRIES", 10000)
+# Размер кэша проверяется не на каждой записи, а раз в столько новых ответов
+EVICTION_CHECK_EVERY = 100
+
+
+def llm_cache_key(model, prompt_text, transcript):
+    """
+    Ключ кэша: sha256 от модели, текста промпта и транскрибации.
+    Изменённый промпт (новая версия) даёт новый ключ, старые ответы не переиспользуются.
+    """
+    digest = hashlib.sha256()
+    for part in (model, prompt_text, transcript):
+        digest.update((part or "").encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def get_cached_response(key):
+    """
+    Ответ из кэша или None. Попадание обновляет счётчик и время использования записи.
+    """
+    entry = LLMResponseCache.objects.filter(key=key).first()
+    if entry:
+        LLMResponseCache.objects.filter(pk=entry.pk).update(hits=F("hits") + 1, last_used_at=timezone.now())
+    return entry
+
+
+def store_response(key, model, answer, tokens_used, raw_answer, prompt_tokens=None, completion_tokens=None):
+    """
+    Сохраняет ответ нейросети в кэш и при необходимости вытесняет старые записи.
+    Ошибка записи в кэш не мешает обработке запроса.
+    """
+    try:
+        entry, created = LLMResponseCache.objects.update_or_create(
+            key=key,
+            defaults={
+                "model": model,
+                "answer": answer,
+                "raw_answer": raw_answer,
+                "tokens_used": tokens_used,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "last_used_at": timezone.now(),
+            },
+        )
+        if created and entry.pk % EVICTION_CHECK_EVERY == 0:
+            evict_stale_responses()
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить ответ нейросети в кэш: {str(e)}")
+
+
+def evict_stale_responses(max_entries=LLM_RESPONSE_CACHE_MAX_ENTRIES):
+    """
+    Оставляет в кэше не больше max_entries записей, удаляя давно не использованные.
+
+    :return: количество удалённых записей.
+    """
+    border = (
+        LLMResponseCache.objects.order_by("-last_used_at")
+        .values_list("last_used_at", flat=True)[max_entries:max_entries + 1]
+    )
+    border = list(border)
+    if not border:
+        return 0
+    deleted, _ = LLMResponseCache.objects.filter(last_used_at__lte=border[0]).delete()
+    if deleted:
+        logger.info(f"Из кэша ответов нейросети вытеснено записей: {deleted}")
+    return deleted
@@ -0,0 +1,102 @@
+import logging, time, threading
+from django.conf import settings
+from django.core.cache import cache
+from ..models import Organization
+
+logger = logging.getLogger(__name__)
+
+# Время жизни записей: в Redis и в памяти процесса (другие процессы узнают об изменениях не позже local TTL)
+ORGANIZATION_CACHE_TTL = getattr(settings, "ORGANIZATION_CACHE_TTL", 3600)
+ORGANIZATION_LOCAL_CACHE_TTL = getattr(settings, "ORGANIZATION_LOCAL_CACHE_TTL", 30)
+
+CACHE_KEY_PREFIX = "org_resolver"
+
+_local_cache = {}
+_local_lock = threading.Lock()
+
+# Маркер "организация не найдена", чтобы не ходить в БД на каждый вебхук от неизвестного домена
+_MISSING = "__missing__"
+
+
+def _cache_key(kind, value):
+    return f"{CACHE_KEY_PREFIX}:{kind}:{value}"
+
+
+def _local_get(key):
+    with _local_lock:
+        entry = _local_cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        _local_cache.pop(key, None)
+        return None
+
+
+def _local_set(key, value):
+    with _local_lock:
+        _local_cache[key] = (time.monotonic() + ORGANIZATION_LOCAL_CACHE_TTL, value)
+
+
+def _resolve(kind, value, lookup):
+    """
+    Ищет организацию сначала в памяти процесса, затем в Redis и только потом в БД.
+    """
+    if not value:
+        return None
+
+    key = _cache_key(kind, value)
+
+    organization = _local_get(key)
+    if organization is None:
+        try:
+            organization = cache.get(key)
+        except Exception as e:
+            logger.warning(f"Кэш организаций недоступен: {str(e)}")
+            organization = None
+
+        if organization is None:
+            organization = Organization.objects.filter(**lookup).first() or _MISSING
+            try:
+                cache.set(key, organization, ORGANIZATION_CACHE_TTL)
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить организацию в кэш: {str(e)}")
+
+        _local_set(key, organization)
+
+    return None if organization == _MISSING else organization
+
+
+def get_organization_by_id(organization_id):
+    return _resolve("id", organization_id, {"id": organization_id})
+
+
+def get_organization_by_subdomain(subdomain):
+    """
+    Организация по поддомену amoCRM (account[subdomain]).
+    """
+    return _resolve("amo", subdomain, {"account_amocrm": subdomain})
+
+
+def get_organization_by_b24_domain(b24_domain):
+    """
+    Организация по домену Bitrix24 (без .bitrix24.ru).
+    """
+    return _resolve("b24", b24_domain, {"b24_domain": b24_domain})
+
+
+def invalidate_organization_cache(*, organization_id=None, subdomains=(), b24_domains=()):
+    """
+    Удаляет записи организации из Redis и из памяти текущего процесса.
+    """
+    keys = [_cache_key("amo", value) for value in subdomains if value]
+    keys += [_cache_key("b24", value) for value in b24_domains if value]
+    if organization_id:
+        keys.append(_cache_key("id", organization_id))
+
+    with _local_lock:
+        for key in keys:
+            _local_cache.pop(key, None)
+
+    try:
+        cache.delete_many(keys)
+    except Exception as e:
+        logger.warning(f"Не удалось сбросить кэш организаций: {str(e)}")
@@ -1,19 +1,377 @@
-import requests
+import hashlib, struct
 from pydub import AudioSegment
 from io import BytesIO
 import logging
+from .http_client import http_get
 
 logger = logging.getLogger(__name__)
 
+# Сколько байт читаем с начала/конца файла для разбора заголовков
+PROBE_HEAD_BYTES = 64 * 1024
+PROBE_TAIL_BYTES = 64 * 1024
+# Сколько байт с начала файла входит в отпечаток аудио (вместе с размером файла)
+FINGERPRINT_BYTES = 64 * 1024
+# В пределах скольких байт после тега ID3v2 (или начала файла) должен начинаться первый кадр MP3
+MP3_SYNC_WINDOW = 4 * 1024
+# Сколько следующих кадров подряд должно подтвердить первый кадр MP3
+MP3_CONFIRM_FRAMES = 3
+
+# Сигнатуры других контейнеров: такие файлы не разбираются как MP3, а декодируются pydub
+OTHER_CONTAINER_MAGIC = (b"fLaC", b"RIFF", b"OggS", b"FORM", b"#!AMR", b"\x1a\x45\xdf\xa3", b"\x30\x26\xb2\x75")
+
+# Таблицы битрейтов MPEG (кбит/с): (версия, слой) -> индекс битрейта
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+
+
+class HttpRangeReader:
+    """
+    Читает фрагменты файла по HTTP Range, не скачивая файл целиком.
+    """
+
+    def __init__(self, url, timeout=(10, 30)):
+        self.url = url
+        self.timeout = timeout
+        self.size = None
+
+    def _update_size(self, response):
+        content_range = response.headers.get("Content-Range", "")
+        if "/" in content_range:
+            total = content_range.rsplit("/", 1)[1]
+            if total.isdigit():
+                self.size = int(total)
+                return
+        if response.status_code == 200 and response.headers.get("Content-Length", "").isdigit():
+            self.size = int(response.headers["Content-Length"])
+
+    def read(self, offset, length):
+        """
+        Возвращает до length байт начиная с offset.
+        Если сервер игнорирует Range, читает поток только до нужной границы.
+        """
+        headers = {"Range": f"bytes={offset}-{offset + length - 1}"}
+        with http_get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            self._update_size(response)
+
+            if response.status_code == 206:
+                return response.raw.read(length, decode_content=True)
+
+            # Сервер не поддерживает Range — дочитываем начало потока до нужной позиции
+            if offset + length > PROBE_HEAD_BYTES * 4:
+                return b""
+            data = b""
+            for chunk in response.iter_content(chunk_size=8192):
+                data += chunk
+                if len(data) >= offset + length:
+                    break
+            return data[offset:offset + length]
+
+    def read_tail(self, length):
+        """
+        Возвращает последние length байт файла.
+        """
+        if self.size is None:
+            self.read(0, 1)
+        if not self.size:
+            return b""
+        offset = max(self.size - length, 0)
+        return self.read(offset, self.size - offset)
+
+
+class FileRangeReader:
+    """
+    Тот же интерфейс, что и HttpRangeReader, для локальных файлов.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            f.seek(0, 2)
+            self.size = f.tell()
+
+    def read(self, offset, length):
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def read_tail(self, length):
+        offset = max(self.size - length, 0)
+        return self.read(offset, self.size - offset)
+
+
+def _skip_id3v2(reader, head):
+    """
+    Возвращает смещение первого аудиокадра после тега ID3v2 и буфер, начинающийся с него.
+    """
+    if len(head) < 10 or head[:3] != b"ID3":
+        return 0, head
+
+    size = (head[6] & 0x7F) << 21 | (head[7] & 0x7F) << 14 | (head[8] & 0x7F) << 7 | (head[9] & 0x7F)
+    offset = 10 + size + (10 if head[5] & 0x10 else 0)
+
+    if offset < len(head):
+        return offset, head[offset:]
+    return offset, reader.read(offset, PROBE_HEAD_BYTES)
+
+
+def _parse_mp3_frame_header(data, pos):
+    """
+    Разбирает 4-байтовый заголовок кадра MPEG. Возвращает dict или None.
+    """
+    if pos + 4 > len(data) or data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0:
+        return None
+
+    b1, b2, b3 = data[pos + 1], data[pos + 2], data[pos + 3]
+    version = {3: 1, 2: 2, 0: 2.5}.get((b1 >> 3) & 0x03)
+    layer = {3: 1, 2: 2, 1: 3}.get((b1 >> 1) & 0x03)
+    bitrate_index = (b2 >> 4) & 0x0F
+    sample_rate_index = (b2 >> 2) & 0x03
+
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    table_version = 1 if version == 1 else 2
+    bitrate = MP3_BITRATES[(table_version, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (b2 >> 1) & 0x01
+    mono = ((b3 >> 6) & 0x03) == 3
+
+    if layer == 1:
+        samples_per_frame = 384
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples_per_frame = 1152 if (layer == 2 or version == 1) else 576
+        frame_length = samples_per_frame // 8 * bitrate // sample_rate + padding
+
+    return {
+        "version": version,
+        "layer": layer,
+        "bitrate": bitrate,
+        "sample_rate": sample_rate,
+        "samples_per_frame": samples_per_frame,
+        "frame_length": frame_length,
+        "mono": mono,
+    }
+
+
+def _is_other_container(head):
+    """
+    Файл начинается с сигнатуры другого формата (MP4/M4A, FLAC, WAV, OGG/Opus, AIFF, AMR, WebM, WMA).
+    """
+    return (
+        head[4:8] == b"ftyp"
+        or head.startswith(OTHER_CONTAINER_MAGIC)
+        or b"OpusHead" in head[:64]
+    )
+
+
+def _confirm_mp3_frames(data, pos, frame, file_ends_in_data):
+    """
+    Проверяет, что за кадром в pos подряд идут MP3_CONFIRM_FRAMES кадров того же потока.
+    Цепочка может оборваться только на конце файла.
+    """
+    for _ in range(MP3_CONFIRM_FRAMES):
+        pos += frame["frame_length"]
+        if pos + 4 > len(data):
+            return file_ends_in_data and pos >= len(data)
+        next_frame = _parse_mp3_frame_header(data, pos)
+        if not next_frame or any(
+            next_frame[key] != frame[key] for key in ("version", "layer", "sample_rate")
+        ):
+            return False
+        frame = next_frame
+    return True
+
+
+def probe_mp3_duration(reader, head):
+    """
+    Длительность MP3 по заголовкам Xing/Info, VBRI или по битрейту первого кадра (CBR).
+    Первый кадр ищется только в начале аудиоданных и должен быть подтверждён несколькими следующими кадрами,
+    иначе формат считается неизвестным.
+    """
+    if _is_other_container(head):
+        return None
+
+    audio_offset, data = _skip_id3v2(reader, head)
+    file_ends_in_data = bool(reader.size) and audio_offset + len(data) >= reader.size
+
+    frame, pos = None, 0
+    while pos < min(MP3_SYNC_WINDOW, len(data) - 4):
+        frame = _parse_mp3_frame_header(data, pos)
+        if frame and _confirm_mp3_frames(data, pos, frame, file_ends_in_data):
+            break
+        frame = None
+        pos += 1
+
+    if not frame:
+        return None
+
+    # Xing/Info располагается сразу после side information
+    if frame["version"] == 1:
+        side_info = 17 if frame["mono"] else 32
+    else:
+        side_info = 9 if frame["mono"] else 17
+    xing_pos = pos + 4 + side_info
+
+    tag = data[xing_pos:xing_pos + 4]
+    if tag in (b"Xing", b"Info") and len(data) >= xing_pos + 12:
+        flags = struct.unpack(">I", data[xing_pos + 4:xing_pos + 8])[0]
+        if flags & 0x01:
+            frames = struct.unpack(">I", data[xing_pos + 8:xing_pos + 12])[0]
+            return frames * frame["samples_per_frame"] / frame["sample_rate"]
+
+    vbri_pos = pos + 4 + 32
+    if data[vbri_pos:vbri_pos + 4] == b"VBRI" and len(data) >= vbri_pos + 18:
+        frames = struct.unpack(">I", data[vbri_pos + 14:vbri_pos + 18])[0]
+        return frames * frame["samples_per_frame"] / frame["sample_rate"]
+
+    # CBR: длительность по размеру аудиоданных и битрейту
+    if not reader.size:
+        return None
+    audio_bytes = reader.size - audio_offset - pos
+    return audio_bytes * 8 / frame["bitrate"]
+
+
+def probe_wav_duration(reader, head):
+    """
+    Длительность WAV по чанкам fmt и data заголовка RIFF.
+    """
+    if len(head) < 12 or head[:4] != b"RIFF" or head[8:12] != b"WAVE":
+        return None
+
+    byte_rate, pos = None, 12
+    while pos + 8 <= len(head):
+        chunk_id = head[pos:pos + 4]
+        chunk_size = struct.unpack("<I", head[pos + 4:pos + 8])[0]
+
+        if chunk_id == b"fmt " and pos + 20 <= len(head):
+            byte_rate = struct.unpack("<I", head[pos + 16:pos + 20])[0]
+        elif chunk_id == b"data":
+            if not byte_rate:
+                return None
+            # Потоковые WAV пишут в размер 0 или 0xFFFFFFFF — берём фактический размер файла
+            if chunk_size in (0, 0xFFFFFFFF) and reader.size:
+                chunk_size = reader.size - pos - 8
+            # Обрезанный файл: заголовок обещает больше данных, чем есть, — пусть длину считает декодер
+            if reader.size and chunk_size > reader.size - pos - 8:
+                return None
+            return chunk_size / byte_rate
+
+        pos += 8 + chunk_size + (chunk_size & 1)
+
+    return None
+
+
+def probe_ogg_duration(reader, head):
+    """
+    Длительность OGG (Vorbis/Opus) по granule position последней страницы.
+    """
+    if len(head) < 28 or head[:4] != b"OggS":
+        return None
+
+    # Первая страница содержит заголовок кодека
+    segments = head[26]
+    packet = head[27 + segments:]
+    pre_skip = 0
+
+    if packet[:7] == b"\x01vorbis" and len(packet) >= 16:
+        sample_rate = struct.unpack("<I", packet[12:16])[0]
+    elif packet[:8] == b"OpusHead" and len(packet) >= 12:
+        sample_rate = 48000  # Opus всегда считает granule в 48 кГц
+        pre_skip = struct.unpack("<H", packet[10:12])[0]
+    else:
+        return None
+
+    tail = reader.read_tail(PROBE_TAIL_BYTES)
+    last_page = tail.rfind(b"OggS")
+    if last_page < 0 or last_page + 14 > len(tail) or not sample_rate:
+        return None
+
+    granule = struct.unpack("<q", tail[last_page + 6:last_page + 14])[0]
+    if granule <= 0:
+        return None
+    return (granule - pre_skip) / sample_rate
+
+
+def probe_audio_duration(reader):
+    """
+    Определяет длительность по заголовкам файла.
+    Возвращает секунды (float) или None, если формат не распознан.
+    """
+    head = reader.read(0, PROBE_HEAD_BYTES)
+    if not head:
+        return None
+
+    for probe in (probe_wav_duration, probe_ogg_duration, probe_mp3_duration):
+        duration = probe(reader, head)
+        if duration:
+            return duration
+    return None
+
+
+def audio_fingerprint(reader):
+    """
+    Отпечаток аудиофайла: sha256 от первых FINGERPRINT_BYTES байт и размера файла.
+    Возвращает None, если размер файла узнать не удалось.
+    """
+    head = reader.read(0, FINGERPRINT_BYTES)
+    if not head or not reader.size:
+        return None
+
+    digest = hashlib.sha256(head)
+    digest.update(str(reader.size).encode())
+    return digest.hexdigest()
+
+
+def get_audio_fingerprint(url):
+    """
+    Отпечаток аудиофайла по URL (один Range-запрос). None при ошибке.
+    """
+    try:
+        return audio_fingerprint(HttpRangeReader(url))
+    except Exception as e:
+        logger.warning(f"Не удалось вычислить отпечаток аудио: {str(e)}")
+        return None
+
+
+def decode_audio_duration(url):
+    """
+    Полное декодирование файла через pydub — используется, если формат не распознан по заголовкам.
+    """
+    response = http_get(url, timeout=(10, 120))
+    response.raise_for_status()  # Проверяем, что файл доступен
+    audio = AudioSegment.from_file(BytesIO(response.content))  # Читаем аудио в память
+    return audio.duration_seconds
+
+
 def get_audio_duration(url):
     """
     Вычисляет длину аудиофайла в секундах по URL.
+    Сначала читает только заголовки через HTTP Range, при неизвестном формате декодирует файл целиком.
     """
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()  # Проверяем, что файл доступен
-        audio = AudioSegment.from_file(BytesIO(response.content))  # Читаем аудио в память
-        return round(audio.duration_seconds)  # Длина в секундах
+        duration = None
+        try:
+            duration = probe_audio_duration(HttpRangeReader(url))
+        except Exception as e:
+            logger.warning(f"Не удалось определить длину аудио по заголовкам: {str(e)}")
+
+        if duration is None:
+            duration = decode_audio_duration(url)
+
+        return round(duration)  # Длина в секундах
     except Exception as e:
         logger.error(f"Ошибка получения длины аудио: {str(e)}")
-        return 0
\ No newline at end of file
+        return 0
@@ -0,0 +1,86 @@
+import logging, time
+from django.conf import settings
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Лимиты API: (запросов в секунду, размер "ведра" для коротких всплесков)
+AMOCRM_RATE_LIMIT = getattr(settings, "AMOCRM_RATE_LIMIT", (7, 7))
+BITRIX24_RATE_LIMIT = getattr(settings, "BITRIX24_RATE_LIMIT", (2, 50))
+# Сколько секунд задача готова ждать токен, прежде чем уйти на повтор
+RATE_LIMIT_MAX_WAIT = getattr(settings, "RATE_LIMIT_MAX_WAIT", 30)
+
+# Token bucket в Redis: одно атомарное обращение на запрос, общее для всех воркеров.
+# Возвращает {1, 0}, если токен выдан, иначе {0, сколько миллисекунд ждать}.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate / 1000)
+
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return {allowed, wait}
+"""
+
+_script = None
+
+
+class CRMRateLimitError(Exception):
+    """
+    CRM ограничила частоту запросов (429) или токен не удалось получить за RATE_LIMIT_MAX_WAIT.
+    Задачу нужно поставить на повтор, а не терять данные.
+    """
+
+
+def _get_script():
+    global _script
+    if _script is None:
+        _script = get_redis().register_script(TOKEN_BUCKET_SCRIPT)
+    return _script
+
+
+def acquire_token(key, rate, capacity, max_wait=RATE_LIMIT_MAX_WAIT):
+    """
+    Ждёт свободный токен в распределённом ведре key.
+    Если Redis недоступен, запрос пропускается без ограничения.
+    """
+    deadline = time.monotonic() + max_wait
+    while True:
+        try:
+            allowed, wait_ms = _get_script()(keys=[f"rate_limit:{key}"], args=[rate, capacity])
+        except Exception as e:
+            logger.warning(f"Лимитер запросов недоступен, запрос к {key} без ограничения: {str(e)}")
+            return
+
+        if allowed:
+            return
+
+        wait = wait_ms / 1000
+        if time.monotonic() + wait > deadline:
+            raise CRMRateLimitError(f"Не удалось получить токен для {key} за {max_wait} сек")
+        time.sleep(wait)
+
+
+def wait_for_amocrm(subdomain):
+    rate, capacity = AMOCRM_RATE_LIMIT
+    acquire_token(f"amocrm:{subdomain}", rate, capacity)
+
+
+def wait_for_bitrix24(b24_domain):
+    rate, capacity = BITRIX24_RATE_LIMIT
+    acquire_token(f"bitrix24:{b24_domain}", rate, capacity)
@@ -0,0 +1,33 @@
+import asyncio, threading, weakref
+import redis
+import redis.asyncio
+from django.conf import settings
+
+_client = None
+_client_lock = threading.Lock()
+
+# Асинхронный клиент привязан к event loop, поэтому храним по клиенту на каждый loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis():
+    """
+    Общий для процесса клиент Redis (метрики, лимиты запросов, очереди).
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = redis.Redis.from_url(settings.REDIS_URL, socket_timeout=5, socket_connect_timeout=5)
+        return _client
+
+
+def get_async_redis():
+    """
+    Клиент redis.asyncio для текущего event loop (асинхронные вебхуки).
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = redis.asyncio.Redis.from_url(settings.REDIS_URL, socket_timeout=5, socket_connect_timeout=5)
+        _async_clients[loop] = client
+    return client
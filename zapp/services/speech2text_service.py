@@ -0,0 +1,121 @@
+import logging
+from urllib.parse import urlencode, urlparse
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .http_client import get_http_session
+
+logger = logging.getLogger(__name__)
+
+S2T_API_URL = "https://speech2text.ru/api"
+
+# Статусы Speech2Text, при которых задачу нужно опросить
+S2T_PENDING_STATUSES = ["Задание создано", "В очереди на распознание", "Процесс получения файла"]
+# Статус, которым помечаются строки, взятые в опрос
+S2T_CHECKING_STATUS = "Распознается..."
+# Статус, в который возвращаются строки, если опрос не удался (будут опрошены повторно)
+S2T_RETRY_STATUS = "В очереди на распознание"
+# Статус завершённой задачи, если колбэк не прислал описание
+S2T_DONE_STATUS = "Распознано"
+
+S2T_POLL_CHUNK_SIZE = getattr(settings, "S2T_POLL_CHUNK_SIZE", 100)
+S2T_POLL_CONCURRENCY = getattr(settings, "S2T_POLL_CONCURRENCY", 10)
+# Если задача опроса потерялась (таймаут, падение воркера), её строки забираются снова через столько секунд
+S2T_POLL_LEASE_TIMEOUT = getattr(settings, "S2T_POLL_LEASE_TIMEOUT", 600)
+
+# Колбэк о завершении распознавания: адрес эндпоинта s2t_callback/ и секрет для проверки запроса
+S2T_CALLBACK_URL = getattr(settings, "S2T_CALLBACK_URL", None)
+S2T_CALLBACK_TOKEN = getattr(settings, "S2T_CALLBACK_TOKEN", "")
+# Через сколько секунд без колбэка задачу начинает опрашивать страховочный проход
+S2T_CALLBACK_GRACE_PERIOD = getattr(settings, "S2T_CALLBACK_GRACE_PERIOD", 600)
+
+# Повторно не транскрибировать запись, которая уже распознана в организации (та же ссылка или тот же файл)
+S2T_TRANSCRIPT_CACHE = getattr(settings, "S2T_TRANSCRIPT_CACHE", True)
+
+def s2t_callbacks_enabled():
+    """
+    Колбэки включены, только если заданы и адрес, и токен: без токена эндпоинт s2t_callback/ закрыт.
+    """
+    return bool(S2T_CALLBACK_URL and S2T_CALLBACK_TOKEN)
+
+
+def get_s2t_callback_url():
+    """
+    Адрес колбэка, передаваемый в Speech2Text при создании задачи, или None, если колбэки выключены.
+    """
+    if not s2t_callbacks_enabled():
+        return None
+    return f"{S2T_CALLBACK_URL}?{urlencode({'token': S2T_CALLBACK_TOKEN})}"
+
+
+def is_trusted_s2t_link(link):
+    """
+    Ссылка на результат принадлежит Speech2Text (к ней можно добавить api-key организации).
+    """
+    if not link:
+        return False
+    parsed = urlparse(link)
+    host = parsed.hostname or ""
+    return parsed.scheme == "https" and (host == "speech2text.ru" or host.endswith(".speech2text.ru"))
+
+
+def fetch_recognition(task_id, api_key, session=None):
+    """
+    Запрашивает статус задачи распознавания, а для завершённой — сразу и текст результата.
+
+    :return: dict с ключами status, done, txt_result_link, transcribed_text или None, если запрос не удался.
+    """
+    session = session or get_http_session()
+
+    response = session.get(f"{S2T_API_URL}/recognitions/{task_id}", params={"api-key": api_key}, timeout=(10, 30))
+    if response.status_code != 200:
+        logger.warning(f"Speech2Text вернул {response.status_code} для задачи {task_id}")
+        return None
+
+    response_data = response.json()
+    status = response_data.get("status", {})
+    result = {
+        "status": status.get("description", "unknown"),
+        "done": status.get("code") == 200,
+        "txt_result_link": None,
+        "transcribed_text": None,
+    }
+
+    if result["done"]:
+        result_links = response_data.get("result", {})
+        result["txt_result_link"] = result_links.get("txt")
+        result["transcribed_text"] = fetch_transcribed_text(result["txt_result_link"], api_key, session=session)
+
+    return result
+
+
+def fetch_transcribed_text(txt_result_link, api_key, session=None):
+    """
+    Скачивает txt-результат распознавания.
+    """
+    if not txt_result_link:
+        return None
+    session = session or get_http_session()
+    response = session.get(txt_result_link, params={"api-key": api_key}, timeout=(10, 60))
+    response.raise_for_status()
+    return response.text
+
+
+def poll_recognitions(tasks, concurrency=S2T_POLL_CONCURRENCY):
+    """
+    Параллельно опрашивает пачку задач через общую сессию.
+
+    :param tasks: список пар (task_id, api_key).
+    :return: dict task_id -> результат fetch_recognition (None при ошибке).
+    """
+    session = get_http_session()
+
+    def poll(task):
+        task_id, api_key = task
+        try:
+            return task_id, fetch_recognition(task_id, api_key, session=session)
+        except Exception as e:
+            logger.error(f"Ошибка при проверке статуса транскрибации {task_id}: {str(e)}")
+            return task_id, None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(tasks)))) as executor:
+        return dict(executor.map(poll, tasks))
@@ -0,0 +1,131 @@
+import logging
+from typing import List, Optional
+from pydantic import BaseModel, Field, ValidationError
+from ..models import CriteriaLabel, Objection
+from .t_model import TMODEL_NAME, add_usage, get_active_positions, save_criteria_scores
+
+logger = logging.getLogger(__name__)
+
+
+class CriterionScore(BaseModel):
+    position: int = Field(ge=1, le=7, description="Номер критерия")
+    score: int = Field(ge=0, description="Оценка по критерию")
+
+
+class CallScoring(BaseModel):
+    """
+    Оценка звонка, которую нейросеть возвращает в JSON (вместо свободного текста).
+    """
+    criteria: List[CriterionScore] = Field(description="Оценки по критериям")
+    overall_score: Optional[int] = Field(default=None, ge=0, description="Итоговая оценка")
+    objection: Optional[str] = Field(default=None, description="Тип возражения клиента из списка или null")
+    analytics: str = Field(description="Аналитика звонка")
+    summary: str = Field(description="Саммари звонка")
+
+
+CALL_SCORING_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "call_scoring", "schema": CallScoring.model_json_schema()},
+}
+
+
+def build_scoring_prompt(prompt_text, organization):
+    """
+    Промпт организации с требованием ответить в JSON: перечисляет критерии и допустимые типы возражений.
+    """
+    labels = CriteriaLabel.objects.filter(organization=organization).order_by("position")
+    objections = Objection.objects.filter(organization=organization, deleted=False).values_list("name", flat=True)
+
+    criteria_text = "\n".join(f"{label.position}. {label.label}" for label in labels)
+    objections_text = ", ".join(f'"{name}"' for name in objections) or "нет"
+
+    return (
+        f"{prompt_text}\n\n"
+        "Ответ верни строго в формате JSON без пояснений: "
+        "criteria — список оценок {position, score} по критериям, overall_score — итоговая оценка, "
+        "objection — тип возражения клиента (одно из значений списка или null), "
+        "analytics — аналитика звонка, summary — саммари.\n"
+        f"Критерии:\n{criteria_text}\n"
+        f"Типы возражений: {objections_text}"
+    )
+
+
+def parse_call_scoring(raw_answer):
+    """
+    Проверяет JSON-ответ нейросети по схеме CallScoring.
+
+    :return: CallScoring или None, если ответ не соответствует схеме.
+    """
+    if not raw_answer:
+        return None
+    try:
+        return CallScoring.model_validate_json(raw_answer)
+    except ValidationError as e:
+        logger.warning(f"Ответ нейросети не соответствует схеме оценки: {str(e)}")
+        return None
+
+
+def request_call_scoring(client, question, usage=None):
+    """
+    Запрашивает у DeepSeekV3 оценку звонка с ответом, ограниченным JSON-схемой.
+
+    :return: (CallScoring или None, tokens_used, raw_answer).
+    """
+    if client is None:
+        return None, None, None
+
+    try:
+        response = client.chat.completions.create(
+            model=TMODEL_NAME,
+            messages=[{"role": "user", "content": question}],
+            response_format=CALL_SCORING_RESPONSE_FORMAT,
+        )
+        raw_answer = response.choices[0].message.content
+        tokens_used = response.usage.total_tokens
+        add_usage(usage, response.usage)
+    except Exception as e:
+        logger.error(f"Ошибка при запросе оценки в JSON к DeepSeekV3: {str(e)}")
+        return None, None, None
+
+    return parse_call_scoring(raw_answer), tokens_used, raw_answer
+
+
+def format_scoring_answer(scoring):
+    """
+    Текст ответа в привычном виде (аналитика и "Саммари:"), чтобы его понимали split_answer и отчёты.
+    """
+    return f"{scoring.analytics.strip()}\n\nСаммари: {scoring.summary.strip()}"
+
+
+def apply_call_scoring(incoming_request, scoring):
+    """
+    Сохраняет оценки и тип возражения из JSON-ответа в CriteriaSteps.
+    Возражение сопоставляется по названию с типами возражений организации.
+    """
+    organization = incoming_request.organization
+    active_positions = get_active_positions(organization)
+
+    scores = {
+        f"criteria_{item.position}": item.score
+        for item in scoring.criteria if item.position in active_positions
+    }
+    if scoring.overall_score is not None:
+        scores["overall_score"] = scoring.overall_score
+
+    if scoring.objection:
+        objection_name = scoring.objection.strip().casefold()
+        objection = next(
+            (
+                objection for objection in Objection.objects.filter(organization=organization, deleted=False)
+                if objection.name.strip().casefold() == objection_name
+            ),
+            None,
+        )
+        if objection:
+            scores["objection"] = objection
+        else:
+            logger.info(f"Возражение '{scoring.objection}' не найдено среди типов возражений организации {organization.id}")
+
+    if not scores:
+        return None
+    return save_criteria_scores(incoming_request, scores)
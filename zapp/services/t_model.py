@@ -1,25 +1,90 @@
-import logging, re
-from openai import OpenAI
+import importlib.util, logging, re, threading
+import httpx
+from celery.signals import worker_process_init, worker_process_shutdown
+from django.conf import settings
+from openai import OpenAI, RateLimitError
 from ..models import *
 
 
 # Настраиваем логгер
 logger = logging.getLogger(__name__)
 
-# Глобальная переменная для хранения клиента
-client = None
 old_base_url="https://api.fireworks.ai/inference/v1"
 
+# Пул соединений клиента нейросети: максимум соединений, сколько из них держать открытыми и сколько секунд
+TMODEL_MAX_CONNECTIONS = getattr(settings, "TMODEL_MAX_CONNECTIONS", 20)
+TMODEL_MAX_KEEPALIVE = getattr(settings, "TMODEL_MAX_KEEPALIVE", 10)
+TMODEL_KEEPALIVE_EXPIRY = getattr(settings, "TMODEL_KEEPALIVE_EXPIRY", 120)
+# HTTP/2 включается, только если установлен пакет h2, иначе keep-alive по HTTP/1.1
+TMODEL_HTTP2 = getattr(settings, "TMODEL_HTTP2", True) and importlib.util.find_spec("h2") is not None
+# Получать ответ потоком и сохранять оценки критериев по мере их появления
+TMODEL_STREAMING = getattr(settings, "TMODEL_STREAMING", True)
 
-def init_tmodel_client(api_key, base_url="https://api.fireworks.ai/inference/v1"):
+# Клиенты по (api_key, base_url): один пул соединений на ключ в пределах процесса
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Модель, которой отправляются запросы (входит в ключ кэша ответов)
+TMODEL_NAME = "accounts/fireworks/models/deepseek-v3p1-terminus"
+
+
+def build_tmodel_client(api_key, base_url="https://api.fireworks.ai/inference/v1"):
     """
-    Инициализирует клиента OpenAI для работы с моделью DeepSeekV3.
+    Создаёт новый клиент OpenAI со своим пулом keep-alive соединений.
     """
-    client = OpenAI(
-        base_url=base_url,
-        api_key=api_key
+    http_client = httpx.Client(
+        http2=TMODEL_HTTP2,
+        limits=httpx.Limits(
+            max_connections=TMODEL_MAX_CONNECTIONS,
+            max_keepalive_connections=TMODEL_MAX_KEEPALIVE,
+            keepalive_expiry=TMODEL_KEEPALIVE_EXPIRY,
+        ),
     )
-    return client
+    return OpenAI(base_url=base_url, api_key=api_key, http_client=http_client)
+
+
+def init_tmodel_client(api_key, base_url="https://api.fireworks.ai/inference/v1"):
+    """
+    Клиент OpenAI для работы с моделью DeepSeekV3.
+    Клиент создаётся один раз на (api_key, base_url) и переиспользуется всеми задачами процесса,
+    поэтому TLS-соединение с Fireworks не устанавливается заново на каждый запрос.
+    """
+    key = (api_key, base_url)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = build_tmodel_client(api_key, base_url)
+            _clients[key] = client
+        return client
+
+
+def close_tmodel_clients():
+    """
+    Закрывает все клиенты процесса и их соединения.
+    """
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception as e:
+            logger.warning(f"Не удалось закрыть клиент DeepSeekV3: {str(e)}")
+
+
+@worker_process_init.connect
+def reset_tmodel_clients(**kwargs):
+    """
+    Дочерний процесс Celery не должен использовать соединения, унаследованные от родителя при fork:
+    клиенты просто забываются (не закрываются, чтобы не оборвать сокеты родителя).
+    """
+    with _clients_lock:
+        _clients.clear()
+
+
+@worker_process_shutdown.connect
+def shutdown_tmodel_clients(**kwargs):
+    close_tmodel_clients()
 
 
 def split_answer(answer_text):
@@ -41,9 +106,22 @@ def split_answer(answer_text):
         return answer_text.strip(), ""
     
 
-def send_question_to_tlite(client, question):
+def add_usage(usage, response_usage):
+    """
+    Добавляет токены ответа API к счётчику usage ({"prompt_tokens", "completion_tokens"}), если он передан.
+    """
+    if usage is None or response_usage is None:
+        return
+    usage["prompt_tokens"] = usage.get("prompt_tokens", 0) + (response_usage.prompt_tokens or 0)
+    usage["completion_tokens"] = usage.get("completion_tokens", 0) + (response_usage.completion_tokens or 0)
+
+
+def send_question_to_tlite(client, question, usage=None, raise_rate_limit=False):
     """
     Отправляет запрос в DeepSeekV3 и возвращает обработанный ответ без форматирующих символов.
+    Если передан dict usage, в него добавляются токены запроса и ответа.
+
+    :param raise_rate_limit: пробросить RateLimitError (429), чтобы вызывающий код сам решил, когда повторить.
     """
     if client is None:
         return None, None, None
@@ -51,70 +129,209 @@ def send_question_to_tlite(client, question):
     try:
         # Отправка запроса к нейросети
         response = client.chat.completions.create(
-            model="accounts/fireworks/models/deepseek-v3p1-terminus",
+            model=TMODEL_NAME,
             messages=[{"role": "user", "content": question}]
         )
 
         # Извлекаем текст ответа
         raw_answer = response.choices[0].message.content
         tokens_used = response.usage.total_tokens
+        add_usage(usage, response.usage)
 
         # Очищаем ответ от форматирования
         cleaned_answer = raw_answer #clean_answer_text(raw_answer) из-за clean_answer_text удалялась важная часть текст 22.04.25г.
 
         return cleaned_answer, tokens_used, raw_answer
 
+    except RateLimitError as e:
+        if raise_rate_limit:
+            raise
+        logger.error(f"Ошибка при запросе к DeepSeekV3: {str(e)}")
+        return None, None, None
+
     except Exception as e:
         logger.error(f"Ошибка при запросе к DeepSeekV3: {str(e)}")
         return None, None, None
 
 
-def analyze_criteria_20(donkit_response: str, incoming_request):
+def stream_question_to_tlite(client, question, on_text=None, usage=None):
     """
-    Анализирует ответ нейросети и сохраняет оценки по критериям (1–7)
-    и итоговую оценку (overall_score) в модель CriteriaSteps.
+    Отправляет запрос в DeepSeekV3 в потоковом режиме.
+    Каждый полученный фрагмент ответа передаётся в on_text, результат такой же, как у send_question_to_tlite.
     """
+    if client is None:
+        return None, None, None
+
     try:
-        # Только активные позиции
-        active_positions = set(
-            CriteriaLabel.objects
-            .filter(organization=incoming_request.organization)
-            .values_list("position", flat=True)
+        stream = client.chat.completions.create(
+            model=TMODEL_NAME,
+            messages=[{"role": "user", "content": question}],
+            stream=True,
+            stream_options={"include_usage": True},
         )
 
-        # Шаблон: "1. Установление контакта (оценка: 3)"
-        pattern = r"(?P<position>\d+)\.\s*.+?\((?:оценка|общая оценка):\s*(?P<score>\d+)\)"
-        matches = re.findall(pattern, donkit_response)
+        parts = []
+        tokens_used = None
+        for chunk in stream:
+            if chunk.usage:
+                tokens_used = chunk.usage.total_tokens
+                add_usage(usage, chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                if on_text:
+                    on_text(delta)
+
+        raw_answer = "".join(parts)
+        return raw_answer, tokens_used, raw_answer
+
+    except Exception as e:
+        logger.error(f"Ошибка при потоковом запросе к DeepSeekV3: {str(e)}")
+        return None, None, None
+
+
+# Шаблон: "1. Установление контакта (оценка: 3)"
+CRITERIA_PATTERN = re.compile(r"(?P<position>\d+)\.\s*.+?\((?:оценка|общая оценка):\s*(?P<score>\d+)\)")
+# Шаблон итоговой оценки: "Итоговая оценка: 9/14"
+OVERALL_SCORE_PATTERN = re.compile(r"Итоговая оценка[:\s]*([\d]+)\s*/\s*[\d]+")
+# Учитываются только первые 7 строк с оценками
+MAX_CRITERIA = 7
+
+
+def get_active_positions(organization):
+    """
+    Позиции критериев, настроенные у организации.
+    """
+    return set(
+        CriteriaLabel.objects
+        .filter(organization=organization)
+        .values_list("position", flat=True)
+    )
+
 
-        scores = {}
-        for pos_str, score_str in matches[:7]:
-            pos = int(pos_str)
-            score = int(score_str)
-            if 1 <= pos <= 7 and pos in active_positions:
-                scores[f"criteria_{pos}"] = score
+def parse_criteria_scores(text, active_positions):
+    """
+    Извлекает из текста оценки по критериям и итоговую оценку.
 
-        # Шаблон итоговой оценки: "Итоговая оценка: 9/14"
-        overall_score_pattern = r"Итоговая оценка[:\s]*([\d]+)\s*/\s*[\d]+"
-        overall_score_match = re.search(overall_score_pattern, donkit_response)
-        if overall_score_match:
-            scores["overall_score"] = int(overall_score_match.group(1))
+    :return: dict поле CriteriaSteps -> оценка.
+    """
+    scores = {}
+    for pos_str, score_str in CRITERIA_PATTERN.findall(text)[:MAX_CRITERIA]:
+        pos = int(pos_str)
+        if 1 <= pos <= 7 and pos in active_positions:
+            scores[f"criteria_{pos}"] = int(score_str)
+
+    overall_score_match = OVERALL_SCORE_PATTERN.search(text)
+    if overall_score_match:
+        scores["overall_score"] = int(overall_score_match.group(1))
+    return scores
+
+
+def save_criteria_scores(incoming_request, scores):
+    """
+    Создаёт или обновляет CriteriaSteps запроса.
+    """
+    criteria_obj, created = CriteriaSteps.objects.get_or_create(
+        incoming_request=incoming_request,
+        defaults=scores
+    )
+    if not created:
+        for field, value in scores.items():
+            setattr(criteria_obj, field, value)
+        criteria_obj.save(update_fields=[*scores, "updated_at"])
+    return criteria_obj
+
+
+def analyze_criteria_20(donkit_response: str, incoming_request):
+    """
+    Анализирует ответ нейросети и сохраняет оценки по критериям (1–7)
+    и итоговую оценку (overall_score) в модель CriteriaSteps.
+    """
+    try:
+        scores = parse_criteria_scores(donkit_response, get_active_positions(incoming_request.organization))
 
         if not scores:
             raise ValueError("Не найдены оценки в ответе нейросети.")
 
-        # Создаём или обновляем запись
-        criteria_obj, created = CriteriaSteps.objects.get_or_create(
-            incoming_request=incoming_request,
-            defaults=scores
-        )
-        if not created:
-            for field, value in scores.items():
-                setattr(criteria_obj, field, value)
-            criteria_obj.save()
-
-        return criteria_obj
+        return save_criteria_scores(incoming_request, scores)
 
     except Exception as e:
         logger.error(f"Ошибка анализа критериев: {str(e)}")
         return None
- 
\ No newline at end of file
+
+
+class CriteriaStreamParser:
+    """
+    Разбирает ответ нейросети по мере поступления: как только строка с оценкой дописана,
+    оценка сразу сохраняется в CriteriaSteps, не дожидаясь конца ответа.
+    Окончательная сверка всё равно делается analyze_criteria_20 по полному тексту.
+    Если ответ оборвался, промежуточные оценки отменяются rollback.
+    """
+
+    def __init__(self, incoming_request):
+        self.incoming_request = incoming_request
+        self.active_positions = get_active_positions(incoming_request.organization)
+        self.buffer = ""
+        self.criteria_lines = 0
+        self.scores = {}
+        # Оценки до первой промежуточной записи (None — строки CriteriaSteps не было)
+        self.previous_scores = None
+
+    def feed(self, delta):
+        """
+        Принимает очередной фрагмент ответа; разбирает только завершённые строки.
+        """
+        self.buffer += delta
+        if "\n" not in self.buffer:
+            return
+        lines, self.buffer = self.buffer.rsplit("\n", 1)
+
+        new_scores = {}
+        for line in lines.split("\n"):
+            for pos_str, score_str in CRITERIA_PATTERN.findall(line):
+                if self.criteria_lines >= MAX_CRITERIA:
+                    break
+                self.criteria_lines += 1
+                pos = int(pos_str)
+                if 1 <= pos <= 7 and pos in self.active_positions:
+                    new_scores[f"criteria_{pos}"] = int(score_str)
+
+            # Как и в analyze_criteria_20, берётся первая итоговая оценка
+            overall_score_match = OVERALL_SCORE_PATTERN.search(line)
+            if overall_score_match and "overall_score" not in self.scores and "overall_score" not in new_scores:
+                new_scores["overall_score"] = int(overall_score_match.group(1))
+
+        if new_scores:
+            self.save(new_scores)
+
+    def save(self, new_scores):
+        try:
+            if not self.scores:
+                self.previous_scores = (
+                    CriteriaSteps.objects.filter(incoming_request=self.incoming_request)
+                    .values(*[f"criteria_{pos}" for pos in range(1, MAX_CRITERIA + 1)], "overall_score")
+                    .first()
+                )
+            save_criteria_scores(self.incoming_request, new_scores)
+            self.scores.update(new_scores)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить промежуточные оценки для запроса {self.incoming_request.id}: {str(e)}")
+
+    def rollback(self):
+        """
+        Отменяет промежуточные оценки, если полный ответ не получен:
+        созданная парсером строка CriteriaSteps удаляется, у существующей возвращаются прежние оценки.
+        """
+        if not self.scores:
+            return
+        try:
+            criteria = CriteriaSteps.objects.filter(incoming_request=self.incoming_request)
+            if self.previous_scores is None:
+                criteria.delete()
+            else:
+                criteria.update(**{field: self.previous_scores[field] for field in self.scores})
+            self.scores = {}
+        except Exception as e:
+            logger.warning(f"Не удалось отменить промежуточные оценки для запроса {self.incoming_request.id}: {str(e)}")
@@ -0,0 +1,159 @@
+import logging, math, re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Count, Sum
+from django.utils import timezone
+from ..models import DonkitRequest
+from .t_model import send_question_to_tlite
+
+logger = logging.getLogger(__name__)
+
+# Сколько токенов может занимать запрос (промпт + транскрибация), прежде чем транскрибация сжимается
+TMODEL_MAX_PROMPT_TOKENS = getattr(settings, "TMODEL_MAX_PROMPT_TOKENS", 60000)
+# Размер фрагмента длинной транскрибации, который пересказывается отдельным запросом
+TMODEL_CHUNK_TOKENS = getattr(settings, "TMODEL_CHUNK_TOKENS", 12000)
+# Сколько фрагментов пересказывается параллельно
+TMODEL_CHUNK_CONCURRENCY = getattr(settings, "TMODEL_CHUNK_CONCURRENCY", 4)
+
+# Примерно столько символов приходится на токен у BPE-токенизатора DeepSeek (кириллица и латиница)
+CHARS_PER_TOKEN = 3.5
+
+TOKEN_PIECE_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# Неречевые запинки, которые распознавание оставляет в репликах ("э", "эм", "мм", "хм").
+# "Угу" и "ага" — это ответы клиента (согласие), их не трогаем
+FILLER_PATTERN = re.compile(r"(?<!\w)(?:э+м*|м{2,}|х+м+)(?!\w)[,.]?\s*", re.IGNORECASE)
+# Метка спикера в начале строки: "Спикер 1:", "Менеджер:", "Клиент:"
+SPEAKER_PATTERN = re.compile(r"^\s*[^:\n]{1,30}:\s*")
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s+")
+
+CHUNK_SUMMARY_PROMPT = (
+    "Ниже фрагмент расшифровки телефонного разговора менеджера с клиентом. "
+    "Подробно перескажи его по репликам: кто что сказал, потребности и возражения клиента, "
+    "аргументы менеджера, договорённости и следующие шаги. Не давай оценок и не сокращай важные детали."
+)
+
+
+def estimate_tokens(text):
+    """
+    Быстрая локальная оценка числа токенов без токенизатора модели:
+    каждое слово — не меньше одного токена, длинные слова делятся по CHARS_PER_TOKEN символов.
+    """
+    if not text:
+        return 0
+    return sum(max(1, math.ceil(len(piece) / CHARS_PER_TOKEN)) for piece in TOKEN_PIECE_PATTERN.findall(text))
+
+
+def trim_filler(transcript):
+    """
+    Убирает из транскрибации запинки ("э", "эм", "мм", "хм") и реплики, в которых кроме них ничего не было.
+    """
+    lines = []
+    for line in transcript.splitlines():
+        speaker = SPEAKER_PATTERN.match(line)
+        prefix = speaker.group(0) if speaker else ""
+        text = FILLER_PATTERN.sub("", line[len(prefix):]).strip(" ,")
+        if text:
+            lines.append(f"{prefix}{text}")
+    return "\n".join(lines)
+
+
+def split_transcript(transcript, chunk_tokens=TMODEL_CHUNK_TOKENS):
+    """
+    Делит транскрибацию на фрагменты примерно по chunk_tokens токенов, не разрывая реплики и предложения.
+    """
+    pieces = []
+    for line in transcript.splitlines():
+        # Распознавание без диаризации может вернуть весь разговор одной строкой — делим её по предложениям
+        if estimate_tokens(line) > chunk_tokens:
+            pieces.extend(SENTENCE_END_PATTERN.split(line))
+        else:
+            pieces.append(line)
+
+    chunks, current, current_tokens = [], [], 0
+    for line in pieces:
+        line_tokens = estimate_tokens(line)
+        if current and current_tokens + line_tokens > chunk_tokens:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def summarize_chunks(client, chunks, usage=None):
+    """
+    Map-шаг: параллельно пересказывает фрагменты длинной транскрибации.
+
+    :return: пересказы в исходном порядке или None, если хотя бы один фрагмент не удалось пересказать.
+    """
+    # Каждый фрагмент пишет токены в свой счётчик, потом они суммируются
+    chunk_usages = [{} for _ in chunks]
+
+    def summarize(index):
+        answer, _, _ = send_question_to_tlite(
+            client, f"{CHUNK_SUMMARY_PROMPT}\n\n{chunks[index]}", usage=chunk_usages[index]
+        )
+        return answer
+
+    with ThreadPoolExecutor(max_workers=max(1, min(TMODEL_CHUNK_CONCURRENCY, len(chunks)))) as executor:
+        summaries = list(executor.map(summarize, range(len(chunks))))
+
+    if usage is not None:
+        for chunk_usage in chunk_usages:
+            for key, value in chunk_usage.items():
+                usage[key] = usage.get(key, 0) + value
+
+    if not all(summaries):
+        return None
+    return summaries
+
+
+def prepare_transcript(client, prompt_text, transcript, usage=None):
+    """
+    Готовит транскрибацию к отправке в нейросеть с учётом бюджета токенов.
+    Междометия убираются всегда; если запрос всё равно не помещается в TMODEL_MAX_PROMPT_TOKENS,
+    транскрибация делится на фрагменты, каждый пересказывается отдельно (map),
+    а оценка потом ставится по склеенным пересказам (reduce).
+    """
+    trimmed = trim_filler(transcript)
+    prompt_tokens = estimate_tokens(prompt_text) + estimate_tokens(trimmed)
+    if prompt_tokens <= TMODEL_MAX_PROMPT_TOKENS:
+        return trimmed
+
+    chunks = split_transcript(trimmed)
+    logger.info(f"Транскрибация ~{prompt_tokens} токенов больше бюджета, пересказываем {len(chunks)} фрагментов")
+
+    summaries = summarize_chunks(client, chunks, usage=usage)
+    if not summaries:
+        logger.warning("Не удалось пересказать фрагменты транскрибации, отправляем её целиком")
+        return trimmed
+
+    return "\n\n".join(
+        f"Часть {number} разговора (пересказ):\n{summary}"
+        for number, summary in enumerate(summaries, start=1)
+    )
+
+
+def get_token_usage_by_organization(days=30):
+    """
+    Расход токенов по организациям за последние days дней.
+
+    :return: список dict с ключами organization__name, requests, prompt_tokens, completion_tokens, tokens_used.
+    """
+    since = timezone.now() - timedelta(days=days)
+    return list(
+        DonkitRequest.objects
+        .filter(created_at__gte=since)
+        .values("organization_id", "organization__name")
+        .annotate(
+            requests=Count("id"),
+            prompt_tokens=Sum("prompt_tokens"),
+            completion_tokens=Sum("completion_tokens"),
+            tokens_used=Sum("tokens_used"),
+        )
+        .order_by("-tokens_used")
+    )
@@ -0,0 +1,82 @@
+import logging
+from django.conf import settings
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд помним принятый вебхук (amoCRM и Bitrix24 повторяют доставку в пределах суток)
+WEBHOOK_DEDUP_TTL = getattr(settings, "WEBHOOK_DEDUP_TTL", 24 * 3600)
+
+DEDUP_KEY_PREFIX = "webhook_dedup"
+SUPPRESSED_KEY = f"{DEDUP_KEY_PREFIX}:suppressed"
+
+# Источники примечаний в вебхуке amoCRM и типы примечаний-звонков (входящий и исходящий)
+AMOCRM_NOTE_SOURCES = ("contacts", "leads", "companies")
+AMOCRM_CALL_NOTE_TYPES = ("10", "11")
+
+
+def find_amocrm_call_note(data):
+    """
+    Префикс первого примечания-звонка в вебхуке amoCRM (например, "contacts[note][0][note]") или None.
+    """
+    for source in AMOCRM_NOTE_SOURCES:
+        prefix = f"{source}[note][0][note]"
+        if data.get(f"{prefix}[note_type]") in AMOCRM_CALL_NOTE_TYPES:
+            return prefix
+    return None
+
+
+def get_dedup_key(kind, organization_id, external_id):
+    return f"{DEDUP_KEY_PREFIX}:{kind}:{organization_id}:{external_id}"
+
+
+def claim_webhook(kind, organization_id, external_id):
+    """
+    Отмечает вебхук как принятый (SETNX в Redis).
+    Возвращает False, если вебхук с таким ключом уже принимали — это повторная доставка.
+    Если Redis недоступен, вебхук пропускается: дубль всё равно отсечёт уникальный индекс в БД.
+    Если принятый вебхук не удалось сохранить или поставить в обработку, отметку нужно снять release_webhook.
+
+    :param kind: "amo" (ключ — note_id) или "b24" (ключ — CALL_ID).
+    """
+    if not external_id:
+        return True
+    try:
+        return bool(get_redis().set(get_dedup_key(kind, organization_id, external_id), 1, nx=True, ex=WEBHOOK_DEDUP_TTL))
+    except Exception as e:
+        logger.warning(f"Дедупликация вебхуков недоступна: {str(e)}")
+        return True
+
+
+def release_webhook(kind, organization_id, external_id):
+    """
+    Снимает отметку claim_webhook, чтобы повторная доставка вебхука была обработана,
+    а не отброшена как дубль. Вызывается, когда обработка принятого вебхука не удалась.
+    """
+    if not external_id:
+        return
+    try:
+        get_redis().delete(get_dedup_key(kind, organization_id, external_id))
+    except Exception as e:
+        logger.warning(f"Не удалось снять отметку вебхука {kind}:{external_id}: {str(e)}")
+
+
+def record_duplicate(source):
+    """
+    Увеличивает счётчик отброшенных повторных вебхуков по источнику.
+    """
+    logger.info(f"Повторный вебхук {source} отброшен")
+    try:
+        get_redis().hincrby(SUPPRESSED_KEY, source, 1)
+    except Exception as e:
+        logger.warning(f"Не удалось обновить счётчик дублей вебхуков: {str(e)}")
+
+
+def get_suppressed_duplicates():
+    """
+    Количество отброшенных повторных вебхуков: dict источник -> число.
+    """
+    return {
+        source.decode(): int(count)
+        for source, count in get_redis().hgetall(SUPPRESSED_KEY).items()
+    }
@@ -0,0 +1,299 @@
+import json, logging, time, urllib.parse
+from celery import group
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils.timezone import localtime
+from ..models import IncomingRequest
+from ..tasks import process_amocrm_request, get_bitrix_call_record_task
+from .organization_cache import get_organization_by_subdomain, get_organization_by_b24_domain
+from .redis_client import get_redis, get_async_redis
+from .webhook_dedup import claim_webhook, find_amocrm_call_note, record_duplicate, release_webhook
+
+logger = logging.getLogger(__name__)
+
+# Очередь сырых вебхуков в Redis (асинхронный режим приёма)
+WEBHOOK_QUEUE_KEY = getattr(settings, "WEBHOOK_QUEUE_KEY", "webhooks:incoming")
+# Сколько вебхуков потребитель забирает за один проход и как часто проверяет пустую очередь (сек)
+WEBHOOK_QUEUE_BATCH_SIZE = getattr(settings, "WEBHOOK_QUEUE_BATCH_SIZE", 200)
+WEBHOOK_QUEUE_POLL_INTERVAL = getattr(settings, "WEBHOOK_QUEUE_POLL_INTERVAL", 0.3)
+
+SOURCE_AMOCRM = "amoCRM"
+SOURCE_BITRIX24 = "Bitrix24"
+
+DUPLICATE_RESPONSE = {"status": "duplicate", "message": "Повторный вебхук, запрос уже принят"}
+
+
+def parse_bitrix_payload(body, content_type):
+    """
+    Разбирает тело вебхука Bitrix24 (JSON или form-urlencoded) в плоский dict.
+
+    :raises ValueError: неподдерживаемый формат или некорректный JSON.
+    """
+    if "application/json" in content_type:
+        return json.loads(body.decode('utf-8'))
+
+    if "application/x-www-form-urlencoded" in content_type:
+        data = urllib.parse.parse_qs(body.decode('utf-8'))
+        return {k: v[0] if isinstance(v, list) else v for k, v in data.items()}
+
+    raise ValueError(f"Unsupported content type: {content_type}")
+
+
+def check_amocrm_call(data):
+    """
+    Проверяет вебхук amoCRM о звонке.
+
+    :return: (тело ответа, HTTP-статус, отметка вебхука для release_webhook или None).
+        Если отметка есть, вебхук нужно передать в process_amocrm_request.
+    """
+    # Проверяем наличие subdomain
+    subdomain = data.get("account[subdomain]")
+    if not subdomain:
+        logger.warning("Запрос без поля 'account[subdomain]'.")
+        return {"status": "error", "message": "Поле 'account[subdomain]' отсутствует."}, 400, None
+
+    # Получаем по subdomain организацию из таблицы Organization
+    organization = get_organization_by_subdomain(subdomain)
+    if not organization:
+        logger.warning(f"Запрос от неизвестного subdomain: {subdomain}")
+        return {"status": "ignored", "message": f"Subdomain '{subdomain}' не зарегистрирован."}, 403, None
+
+    if organization.trial_expires_at and localtime().date() > organization.trial_expires_at:
+        return {"status": "error", "message": "Истек срок пробного периода."}, 200, None
+
+    # Среди примечаний контактов, сделок и компаний обрабатываем только первое примечание-звонок
+    prefix = find_amocrm_call_note(data)
+    if not prefix:
+        logger.warning("Примечание не является аудиозаписью или не найдено. END")
+        return {"status": "ignored", "message": "Примечание не является аудиозаписью."}, 200, None
+
+    # Повторная доставка того же примечания — не запускаем обработку второй раз
+    claim = ("amo", organization.id, data.get(f"{prefix}[id]"))
+    if not claim_webhook(*claim):
+        record_duplicate(SOURCE_AMOCRM)
+        return DUPLICATE_RESPONSE, 200, None
+    return {"status": "success", "message": "Запрос передан в обработку."}, 200, claim
+
+
+def accept_amocrm_call(data):
+    """
+    Проверяет вебхук amoCRM о звонке и передаёт его в Celery.
+
+    :return: (тело ответа, HTTP-статус).
+    """
+    result, status, claim = check_amocrm_call(data)
+    if claim:
+        try:
+            process_amocrm_request.delay(data)
+        except Exception:
+            # Вебхук не поставлен в обработку — повторная доставка из amoCRM не должна считаться дублем
+            release_webhook(*claim)
+            raise
+    return result, status
+
+
+def build_bitrix_call(data):
+    """
+    Проверяет вебхук Bitrix24 о звонке и готовит запись IncomingRequest (без сохранения).
+
+    :return: (тело ответа, HTTP-статус, несохранённый IncomingRequest или None).
+    """
+    # Проверяем наличие CALL_ID
+    call_id = data.get("data[CALL_ID]") or data.get("CALL_ID")
+    if not call_id:
+        logger.error("Вебхук не содержит CALL_ID")
+        return {"status": "error", "message": "CALL_ID отсутствует"}, 400, None
+
+    # Получаем значение CALL_DURATION, некорректное или пустое считаем нулём
+    call_duration_raw = data.get("data[CALL_DURATION]")
+    if call_duration_raw is None or call_duration_raw == "" or not call_duration_raw.isdigit():
+        call_duration = 0
+    else:
+        call_duration = int(call_duration_raw)
+
+    # Определяем организацию по auth[domain]
+    full_b24_domain = data.get("auth[domain]")
+    b24_domain = full_b24_domain.split('.')[0] if full_b24_domain else None
+
+    organization = get_organization_by_b24_domain(b24_domain)
+    if not organization:
+        logger.warning(f"Не найдена организация для домена {b24_domain}. END")
+        return {"status": "ignored", "message": "Организация не найдена"}, 403, None
+
+    if organization.trial_expires_at and localtime().date() > organization.trial_expires_at:
+        return {"status": "error", "message": "Истек срок пробного периода. END"}, 200, None
+
+    # Повторная доставка того же звонка
+    if not claim_webhook("b24", organization.id, call_id):
+        record_duplicate(SOURCE_BITRIX24)
+        return DUPLICATE_RESPONSE, 200, None
+
+    minimal_length = organization.minimal_call_length
+    ignored_flag = call_duration < minimal_length
+
+    # CALL_TYPE 1 и 3 — входящие, остальные (и неопределённый) считаем исходящими
+    call_type = data.get("data[CALL_TYPE]")
+    call_direction = "incoming" if call_type in ("1", "3") else "outgoing"
+
+    incoming_request = IncomingRequest(
+        raw_data=data,
+        domain_b24=b24_domain,
+        call_id_b24=call_id,
+        ignored=ignored_flag,
+        organization=organization,
+        source="Bitrix24",
+        call_direction=call_direction
+    )
+
+    if ignored_flag:
+        logger.warning(f"Запрос с CALL_ID {call_id} сохранён, но помечен как ignored. Длительность {call_duration} сек < MINIMAL_CALL_LENGTH сек. END")
+        return {"status": "ignored", "message": f"Запрос с CALL_ID {call_id} сохранён, но помечен как ignored. Длительность ({call_duration} сек меньше чем минимальная"}, 200, incoming_request
+
+    return {"status": "success", "message": "Запрос принят, ожидаем ссылку на запись"}, 200, incoming_request
+
+
+def bitrix_call_claim(incoming_request):
+    """
+    Отметка вебхука Bitrix24, которую взял build_bitrix_call (для release_webhook).
+    """
+    return "b24", incoming_request.organization_id, incoming_request.call_id_b24
+
+
+def bitrix_call_record_signature(incoming_request):
+    """
+    Задача получения CALL_RECORD_URL — через 5 секунд после звонка, когда запись уже готова.
+    """
+    return get_bitrix_call_record_task.signature(args=[incoming_request.id], countdown=5)
+
+
+def accept_bitrix_call(data):
+    """
+    Сохраняет звонок из вебхука Bitrix24 и ставит задачу получения CALL_RECORD_URL.
+
+    :return: (тело ответа, HTTP-статус).
+    """
+    result, status, incoming_request = build_bitrix_call(data)
+    if incoming_request:
+        try:
+            # Если задачу не удалось поставить, сохранение звонка откатывается вместе с ней
+            with transaction.atomic():
+                incoming_request.save()
+                if not incoming_request.ignored:
+                    bitrix_call_record_signature(incoming_request).apply_async()
+        except IntegrityError:
+            # Звонок уже сохранён (дубль, пропущенный Redis)
+            record_duplicate(SOURCE_BITRIX24)
+            return DUPLICATE_RESPONSE, 200
+        except Exception:
+            release_webhook(*bitrix_call_claim(incoming_request))
+            raise
+    return result, status
+
+
+async def enqueue_webhook(source, data):
+    """
+    Кладёт сырой вебхук в очередь Redis одной командой RPUSH.
+    """
+    item = json.dumps({"source": source, "data": data, "received_at": time.time()}, ensure_ascii=False)
+    await get_async_redis().rpush(WEBHOOK_QUEUE_KEY, item)
+
+
+def read_webhook_batch(limit=WEBHOOK_QUEUE_BATCH_SIZE):
+    """
+    Читает до limit вебхуков из начала очереди, не удаляя их.
+    Из очереди они удаляются ack_webhook_batch только после обработки, поэтому при падении
+    потребителя вебхуки не теряются. Потребитель должен быть один.
+    """
+    return get_redis().lrange(WEBHOOK_QUEUE_KEY, 0, limit - 1)
+
+
+def ack_webhook_batch(count):
+    """
+    Удаляет из очереди count обработанных вебхуков.
+    """
+    get_redis().ltrim(WEBHOOK_QUEUE_KEY, count, -1)
+
+
+def save_bitrix_calls(incoming_requests):
+    """
+    Сохраняет звонки Bitrix24 одним bulk_create.
+    Если в пачке оказался уже сохранённый звонок (уникальный индекс), сохраняет по одному и пропускает дубли.
+
+    :return: сохранённые запросы.
+    """
+    try:
+        with transaction.atomic():
+            return IncomingRequest.objects.bulk_create(incoming_requests)
+    except IntegrityError:
+        pass
+
+    saved = []
+    for incoming_request in incoming_requests:
+        incoming_request.pk = None
+        try:
+            with transaction.atomic():
+                incoming_request.save()
+            saved.append(incoming_request)
+        except IntegrityError:
+            record_duplicate(SOURCE_BITRIX24)
+    return saved
+
+
+def process_webhook_batch(raw_items):
+    """
+    Обрабатывает пачку вебхуков из очереди.
+    Звонки Bitrix24 сохраняются одним bulk_create, а задачи всех вебхуков пачки отправляются одной группой Celery.
+    Звонки amoCRM пакетной вставкой не охвачены: здесь они только проверяются и отмечаются,
+    а IncomingRequest и связанные DealStage создаёт process_amocrm_request по одному,
+    потому что для каждого звонка нужны запросы к API amoCRM (сделка, контакт, длительность записи).
+    Ошибка в одном вебхуке не останавливает обработку остальных.
+    Если пачку не удалось сохранить или отправить, сохранение откатывается, отметки вебхуков снимаются
+    и исключение пробрасывается: пачка остаётся в очереди и будет обработана заново.
+
+    :return: количество поставленных задач.
+    """
+    signatures = []
+    bitrix_requests = []
+    claims = []
+
+    for raw_item in raw_items:
+        try:
+            item = json.loads(raw_item)
+            source, data = item.get("source"), item.get("data") or {}
+
+            if source == SOURCE_AMOCRM:
+                result, status, claim = check_amocrm_call(data)
+                if claim:
+                    claims.append(claim)
+                    signatures.append(process_amocrm_request.s(data))
+            elif source == SOURCE_BITRIX24:
+                result, status, incoming_request = build_bitrix_call(data)
+                if incoming_request:
+                    claims.append(bitrix_call_claim(incoming_request))
+                    bitrix_requests.append(incoming_request)
+            else:
+                logger.error(f"Неизвестный источник вебхука в очереди: {source}")
+                continue
+
+            if status >= 400:
+                logger.warning(f"Вебхук {source} отклонён ({status}): {result.get('message')}")
+        except Exception as e:
+            logger.error(f"Ошибка обработки вебхука из очереди: {str(e)}")
+
+    try:
+        with transaction.atomic():
+            if bitrix_requests:
+                bitrix_requests = save_bitrix_calls(bitrix_requests)
+                signatures += [
+                    bitrix_call_record_signature(incoming_request)
+                    for incoming_request in bitrix_requests if not incoming_request.ignored
+                ]
+
+            if signatures:
+                group(signatures).apply_async()
+    except Exception:
+        for claim in claims:
+            release_webhook(*claim)
+        raise
+
+    return len(signatures)
@@ -0,0 +1,184 @@
+import logging, random, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from openai import RateLimitError
+from .t_model import send_question_to_tlite
+from .weekly_common import iter_week_transcripts
+
+logger = logging.getLogger(__name__)
+
+# Размер пачки звонков в одном запросе недельного анализа
+WEEKLY_BATCH_SIZE = getattr(settings, "WEEKLY_BATCH_SIZE", 20)
+# Сколько пачек одной недели анализируется параллельно
+WEEKLY_LLM_CONCURRENCY = getattr(settings, "WEEKLY_LLM_CONCURRENCY", 4)
+# Повторы пачки при 429 и начальная задержка между ними (сек), дальше задержка удваивается
+WEEKLY_LLM_MAX_RETRIES = getattr(settings, "WEEKLY_LLM_MAX_RETRIES", 5)
+WEEKLY_LLM_BACKOFF = getattr(settings, "WEEKLY_LLM_BACKOFF", 2)
+# Сколько секунд ждать транскрибацию нового звонка, прежде чем анализировать следующие звонки без него
+WEEKLY_TRANSCRIPT_GRACE = getattr(settings, "WEEKLY_TRANSCRIPT_GRACE", 24 * 3600)
+# После стольких успешных запросов подряд параллельность снова увеличивается на единицу
+CONCURRENCY_RECOVERY_STREAK = 5
+
+
+class AdaptiveConcurrency:
+    """
+    Ограничение числа одновременных запросов, которое подстраивается под лимиты Fireworks:
+    при 429 допустимая параллельность уменьшается вдвое, после серии успешных запросов растёт на единицу.
+    """
+
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.current = self.limit
+        self.active = 0
+        self.streak = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.current:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, rate_limited=False):
+        with self.condition:
+            self.active -= 1
+            if rate_limited:
+                self.current = max(1, self.current // 2)
+                self.streak = 0
+            else:
+                self.streak += 1
+                if self.streak >= CONCURRENCY_RECOVERY_STREAK and self.current < self.limit:
+                    self.current += 1
+                    self.streak = 0
+            self.condition.notify_all()
+
+
+def ask_with_backoff(client, prompt, concurrency):
+    """
+    Запрос одной пачки: ждёт свободный слот, при 429 повторяет с экспоненциальной задержкой и джиттером.
+
+    :return: ответ нейросети или None.
+    """
+    for attempt in range(WEEKLY_LLM_MAX_RETRIES + 1):
+        concurrency.acquire()
+        try:
+            response, _, _ = send_question_to_tlite(client, prompt, raise_rate_limit=True)
+        except RateLimitError:
+            concurrency.release(rate_limited=True)
+            delay = WEEKLY_LLM_BACKOFF * 2 ** attempt
+            logger.warning(f"Fireworks ограничил частоту запросов, повтор пачки через {delay} сек")
+            time.sleep(delay + random.uniform(0, delay / 2))
+            continue
+        concurrency.release()
+        return response
+
+    logger.error(f"Пачка недельного анализа не обработана за {WEEKLY_LLM_MAX_RETRIES} повторов")
+    return None
+
+
+def split_batches(items, size=WEEKLY_BATCH_SIZE):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class WeeklyBatchJob:
+    """
+    Пачки звонков одного вида анализа (ошибки, факторы или инсайты) для run_weekly_jobs.
+
+    :param batch_texts: тексты пачек (звонки, склеенные в одну строку).
+    :param build_prompt: функция текст пачки -> промпт; вызывается перед отправкой.
+    :param save_response: функция, сохраняющая ответ нейросети в отчёт.
+    :param seed_first: первая пачка обрабатывается и сохраняется до остальных, чтобы остальные
+        получили уже найденные названия (ошибок, факторов) в промпте.
+    :param drop_failed: функция номер пачки -> True, если пачку без ответа нужно пропустить
+        (например, она не получает ответа уже несколько запусков подряд), а не останавливать задание.
+    """
+
+    def __init__(self, batch_texts, build_prompt, save_response, seed_first=True, drop_failed=None):
+        self.batch_texts = batch_texts
+        self.build_prompt = build_prompt
+        self.save_response = save_response
+        self.seed_first = seed_first
+        self.drop_failed = drop_failed
+        # Сколько пачек с начала списка обработано (сохранено или пропущено);
+        # после первой пачки без ответа, которую нельзя пропустить, задание останавливается
+        self.saved = 0
+        self.stopped = False
+        # Номера пропущенных пачек: они считаются обработанными, но звонки в них не проанализированы
+        self.dropped = []
+
+    def handle_response(self, response):
+        """
+        Сохраняет ответ очередной пачки или решает, что делать с пачкой без ответа.
+        """
+        if response:
+            self.save_response(response)
+        elif self.drop_failed and self.drop_failed(self.saved):
+            self.dropped.append(self.saved)
+        else:
+            self.stopped = True
+            return
+        self.saved += 1
+
+
+def ask_all(client, prompts, concurrency):
+    """
+    Отправляет промпты параллельно (не больше WEEKLY_LLM_CONCURRENCY потоков) и возвращает ответы в том же порядке.
+    """
+    if not prompts:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(WEEKLY_LLM_CONCURRENCY, len(prompts)))) as executor:
+        return list(executor.map(lambda prompt: ask_with_backoff(client, prompt, concurrency), prompts))
+
+
+def run_weekly_jobs(client, jobs):
+    """
+    Анализирует пачки нескольких видов анализа с общим ограничением параллельности.
+
+    Сначала параллельно отправляются первые пачки заданий с seed_first, затем все остальные пачки всех заданий.
+    Промпты строятся и ответы сохраняются в вызывающем потоке, по порядку пачек каждого задания,
+    поэтому итог не зависит от того, какой запрос ответил раньше. Сохранение задания останавливается
+    на первой пачке без ответа (если job.drop_failed не разрешил её пропустить):
+    она и следующие будут проанализированы в следующий запуск.
+
+    :return: jobs; в job.saved — количество обработанных пачек с начала списка.
+    """
+    concurrency = AdaptiveConcurrency(WEEKLY_LLM_CONCURRENCY)
+
+    seeded = [job for job in jobs if job.seed_first and job.batch_texts]
+    responses = ask_all(client, [job.build_prompt(job.batch_texts[0]) for job in seeded], concurrency)
+    for job, response in zip(seeded, responses):
+        job.handle_response(response)
+
+    pending = [
+        (job, job.build_prompt(text))
+        for job in jobs if not job.stopped
+        for text in job.batch_texts[job.saved:]
+    ]
+    responses = ask_all(client, [prompt for _, prompt in pending], concurrency)
+
+    # Reduce: ответы сохраняются строго в порядке пачек каждого задания
+    for (job, _), response in zip(pending, responses):
+        if not job.stopped:
+            job.handle_response(response)
+
+    return jobs
+
+
+def collect_new_calls(organization, week_start, week_end, after_id=None):
+    """
+    Звонки недели, которые ещё не анализировались (ID больше after_id — отметки отчёта).
+    Звонок без транскрибации, созданный недавно, останавливает выборку: его транскрибация может ещё прийти,
+    а отметка не должна уйти дальше него.
+
+    :return: список пар (ID звонка, текст транскрибации) по возрастанию ID.
+    """
+    grace_border = timezone.now() - timedelta(seconds=WEEKLY_TRANSCRIPT_GRACE)
+    calls = []
+    for request_id, created_at, transcript in iter_week_transcripts(organization, week_start, week_end, after_id=after_id):
+        if transcript:
+            calls.append((request_id, transcript.strip()))
+        elif created_at > grace_border:
+            break
+    return calls
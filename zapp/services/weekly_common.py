@@ -0,0 +1,200 @@
+import re
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils.timezone import now
+from ..models import IncomingRequest, S2TRequest
+
+# Сколько строк за раз читается из курсора при обходе звонков недели
+WEEKLY_TRANSCRIPT_CHUNK_SIZE = getattr(settings, "WEEKLY_TRANSCRIPT_CHUNK_SIZE", 500)
+
+
+def get_week_bounds(today=None):
+    """
+    Возвращает дату начала (понедельник) и конца (воскресенье) текущей недели.
+    """
+    today = today or now().date()
+    start = today - timedelta(days=today.weekday())  # понедельник
+    end = start + timedelta(days=6)                  # воскресенье
+    return start, end
+
+
+def get_or_create_active_report(report_model, organization):
+    """
+    Возвращает активный недельный отчёт модели report_model (WeeklyReport, WeeklyErrorReport, WeeklyFactorReport).
+    Если нет — создаёт. Также завершает предыдущие устаревшие отчёты.
+    """
+    week_start, week_end = get_week_bounds()
+
+    # Деактивируем устаревшие
+    report_model.objects.filter(organization=organization, is_active=True)\
+        .exclude(week_start=week_start).update(is_active=False)
+
+    # Пытаемся найти активный
+    report = report_model.objects.filter(
+        organization=organization,
+        week_start=week_start,
+        is_active=True
+    ).first()
+
+    if report:
+        return report
+
+    # Если нет — создаём новый
+    return report_model.objects.create(
+        organization=organization,
+        week_start=week_start,
+        week_end=week_end,
+        is_active=True
+    )
+
+
+def parse_weekly_response(text, title_pattern):
+    """
+    Разбирает ответ недельного анализа на элементы вида
+    "<Заголовок> N: название", "Количество повторений: N" и примеры, начинающиеся с тире.
+
+    :param title_pattern: регулярка слова заголовка, например "Ошибка" или "Ошибка|Проблема".
+    :return: список dict с ключами title, frequency, examples.
+    """
+    items = []
+    current = None
+
+    lines = text.replace("=== RESPONSE ===", "").strip().splitlines()
+
+    for line in lines:
+        line = line.strip()
+
+        # Парсим заголовок "Ошибка 1: ..."
+        match_title = re.match(rf"({title_pattern})\s+\d+:\s+(.+)", line)
+        if match_title:
+            if current:
+                items.append(current)
+            current = {"title": match_title.group(2).strip(), "frequency": 0, "examples": []}
+            continue
+
+        # Парсим "Количество повторений: N"
+        match_freq = re.match(r"Количество повторений:\s+(\d+)", line)
+        if match_freq and current:
+            current["frequency"] = int(match_freq.group(1))
+            continue
+
+        # Парсим примеры
+        if line.startswith("-") and current:
+            current["examples"].append(line.lstrip("-").strip())
+
+    if current:
+        items.append(current)
+
+    return items
+
+
+def iter_week_transcripts(organization, week_start, week_end, after_id=None, chunk_size=WEEKLY_TRANSCRIPT_CHUNK_SIZE):
+    """
+    Обходит звонки недели одним запросом: последняя непустая транскрибация подтягивается подзапросом,
+    строки читаются из курсора порциями по chunk_size.
+
+    :param after_id: пропустить звонки с ID не больше этого (уже проанализированные).
+    :return: итератор троек (ID звонка, дата создания, текст транскрибации или None) по возрастанию ID.
+    """
+    latest_transcript = (
+        S2TRequest.objects
+        .filter(incoming_request=OuterRef("pk"))
+        .exclude(Q(transcribed_text__isnull=True) | Q(transcribed_text=""))
+        .order_by("-created_at", "-id")
+        .values("transcribed_text")[:1]
+    )
+
+    requests = IncomingRequest.objects.filter(
+        organization=organization,
+        created_at__date__range=(week_start, week_end),
+        ignored=False,
+    )
+    if after_id:
+        requests = requests.filter(id__gt=after_id)
+
+    return (
+        requests
+        .annotate(transcript=Subquery(latest_transcript))
+        .order_by("id")
+        .values_list("id", "created_at", "transcript")
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def extract_request_ids_from_text(text):
+    """
+    Ищет все ID звонков в тексте по шаблону 'звонок <число>'.
+    """
+    matches = re.findall(r"звонок\s*(\d+)", text.lower())
+    return list(map(int, matches))
+
+
+def get_week_request_ids(organization, week_start, week_end):
+    """
+    ID всех звонков недели (для проверки ссылок на звонки в ответе нейросети).
+    """
+    return set(
+        IncomingRequest.objects.filter(
+            organization=organization,
+            created_at__date__range=(week_start, week_end),
+        ).values_list("id", flat=True)
+    )
+
+
+def save_weekly_items(report, parsed, item_model, example_model, item_field, request_ids=None):
+    """
+    Сохраняет разобранный ответ недельного анализа (ошибки, факторы или инсайты):
+    частоты складываются с уже накопленными, примеры создаются одним bulk_create,
+    а связи примеров со звонками — ещё одним bulk_create по промежуточной таблице.
+
+    :param parsed: список dict с ключами title, frequency, examples.
+    :param item_field: имя FK примера на элемент отчёта ("error", "factor", "insight").
+    :param request_ids: допустимые ID звонков; ID, которых нет в наборе (выдуманные нейросетью), отбрасываются.
+        Если не передан, берутся все звонки недели отчёта.
+    """
+    if request_ids is None:
+        request_ids = get_week_request_ids(report.organization, report.week_start, report.week_end)
+
+    examples, example_request_ids = [], []
+    with transaction.atomic():
+        for item_data in parsed:
+            title = item_data["title"].strip()
+            frequency = item_data.get("frequency") or 0
+
+            # Пропускаем элементы без повторений и примеров
+            if frequency == 0 or not item_data["examples"]:
+                continue
+
+            # Частоты из новых пачек складываются с уже накопленными
+            item = item_model.objects.filter(report=report, title__iexact=title).first()
+            if item:
+                item.frequency += frequency
+                item.save(update_fields=["frequency"])
+            else:
+                item = item_model.objects.create(report=report, title=title, frequency=frequency)
+
+            for example_line in item_data["examples"]:
+                examples.append(example_model(**{item_field: item, "text": example_line}))
+                example_request_ids.append(
+                    dict.fromkeys(
+                        request_id for request_id in extract_request_ids_from_text(example_line)
+                        if request_id in request_ids
+                    )
+                )
+
+        if not examples:
+            return
+
+        examples = example_model.objects.bulk_create(examples)
+
+        m2m_field = example_model._meta.get_field("incoming_requests")
+        through = m2m_field.remote_field.through
+        example_column = f"{m2m_field.m2m_field_name()}_id"
+        request_column = f"{m2m_field.m2m_reverse_field_name()}_id"
+        through.objects.bulk_create([
+            through(**{example_column: example.pk, request_column: request_id})
+            for example, ids in zip(examples, example_request_ids)
+            for request_id in ids
+        ])
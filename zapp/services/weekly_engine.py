@@ -0,0 +1,181 @@
+import logging
+from functools import partial
+from django.conf import settings
+from django.core.cache import cache
+from ..models import WeeklyErrorReport, WeeklyFactorReport, WeeklyReport
+from .t_model import init_tmodel_client
+from .weekly_batches import WeeklyBatchJob, collect_new_calls, run_weekly_jobs, split_batches
+from .weekly_common import get_or_create_active_report
+from .weekly_errors import DEFAULT_WEEKLY_ERROR_PROMPT_INITIAL, build_prompt_with_existing_errors, save_weekly_errors
+from .weekly_factors import DEFAULT_WEEKLY_FACTOR_PROMPT_INITIAL, build_prompt_with_existing_factors, save_weekly_factors
+from .weekly_reports import DEFAULT_WEEKLY_PROMPT_INITIAL, save_weekly_insights
+
+logger = logging.getLogger(__name__)
+
+# Виды анализа, которые ночная задача запускает за один проход по транскрибациям недели
+WEEKLY_ANALYSIS_KINDS = getattr(settings, "WEEKLY_ANALYSIS_KINDS", ["errors", "factors"])
+# После стольких запусков без ответа пачка пропускается, чтобы отметка отчёта могла сдвинуться дальше неё
+WEEKLY_BATCH_MAX_ATTEMPTS = getattr(settings, "WEEKLY_BATCH_MAX_ATTEMPTS", 3)
+# Счётчик неудач живёт дольше недели: отчёт анализируется только в течение своей недели
+WEEKLY_BATCH_FAILURES_TTL = 8 * 24 * 60 * 60
+
+
+def build_error_prompt(report, calls_text):
+    existing_errors = report.errors.all()
+    if existing_errors.exists():
+        return build_prompt_with_existing_errors(existing_errors, calls_text)
+    return DEFAULT_WEEKLY_ERROR_PROMPT_INITIAL + "\n\n" + calls_text
+
+
+def build_factor_prompt(report, calls_text):
+    existing_factors = report.factors.all()
+    if existing_factors.exists():
+        return build_prompt_with_existing_factors(existing_factors, calls_text)
+    return DEFAULT_WEEKLY_FACTOR_PROMPT_INITIAL + "\n\n" + calls_text
+
+
+def build_insight_prompt(report, calls_text):
+    return DEFAULT_WEEKLY_PROMPT_INITIAL + "\n\n" + calls_text
+
+
+class WeeklyAnalysisKind:
+    """
+    Вид недельного анализа: модель отчёта, построение промпта и сохранение ответа.
+
+    :param seed_first: промпт зависит от уже найденных названий, поэтому первая пачка анализируется раньше остальных.
+    """
+
+    def __init__(self, report_model, build_prompt, save_response, seed_first):
+        self.report_model = report_model
+        self.build_prompt = build_prompt
+        self.save_response = save_response
+        self.seed_first = seed_first
+
+
+def register_failed_batch(kind_name, report, batches, index):
+    """
+    Учитывает неудачную попытку анализа пачки и решает, пропустить ли её.
+    Пачка определяется первым звонком: следующий запуск разбивает звонки после отметки так же.
+
+    :return: True, если пачка не получила ответа WEEKLY_BATCH_MAX_ATTEMPTS раз и её нужно пропустить.
+    """
+    batch = batches[index]
+    key = f"weekly_batch_failures:{kind_name}:{report.id}:{batch[0][0]}"
+    try:
+        cache.add(key, 0, WEEKLY_BATCH_FAILURES_TTL)
+        attempts = cache.incr(key)
+    except Exception as e:
+        logger.warning(f"Не удалось учесть неудачную пачку недельного анализа {kind_name} отчёта {report.id}: {e}")
+        return False
+
+    if attempts < WEEKLY_BATCH_MAX_ATTEMPTS:
+        logger.warning(f"Пачка звонков {batch[0][0]}-{batch[-1][0]} ({kind_name}, отчёт {report.id}) без ответа, попытка {attempts}")
+        return False
+
+    logger.error(
+        f"Пачка звонков {batch[0][0]}-{batch[-1][0]} ({kind_name}, отчёт {report.id}) пропущена "
+        f"после {attempts} неудачных попыток: {len(batch)} звонков не проанализированы"
+    )
+    cache.delete(key)
+    return True
+
+
+ANALYSIS_KINDS = {
+    "errors": WeeklyAnalysisKind(WeeklyErrorReport, build_error_prompt, save_weekly_errors, seed_first=True),
+    "factors": WeeklyAnalysisKind(WeeklyFactorReport, build_factor_prompt, save_weekly_factors, seed_first=True),
+    "insights": WeeklyAnalysisKind(WeeklyReport, build_insight_prompt, save_weekly_insights, seed_first=False),
+}
+
+
+def analyze_weekly_reports(organization, reports):
+    """
+    Анализирует звонки для нескольких недельных отчётов за один проход.
+    Транскрибации каждой недели читаются один раз (начиная с самой ранней отметки среди отчётов),
+    пачки всех видов анализа отправляются в нейросеть через общий клиент с общим ограничением параллельности,
+    а отметка last_processed_request_id каждого отчёта сдвигается на последний звонок его сохранённых пачек.
+    Пачка, не получившая ответа WEEKLY_BATCH_MAX_ATTEMPTS запусков подряд, пропускается (см. register_failed_batch),
+    чтобы одна проблемная пачка не останавливала отчёт и не отправлялась в нейросеть каждую ночь.
+
+    :param reports: dict вид анализа ("errors", "factors", "insights") -> отчёт.
+    :return: dict вид анализа -> количество проанализированных звонков.
+    """
+    weeks = {}
+    for kind_name, report in reports.items():
+        weeks.setdefault((report.week_start, report.week_end), []).append((kind_name, report))
+
+    client = init_tmodel_client(api_key=organization.donkit_api_key)
+    analyzed = {}
+
+    for (week_start, week_end), week_reports in weeks.items():
+        after_id = min(report.last_processed_request_id or 0 for _, report in week_reports)
+        calls = collect_new_calls(organization, week_start, week_end, after_id=after_id)
+
+        jobs = []
+        for kind_name, report in week_reports:
+            kind = ANALYSIS_KINDS[kind_name]
+            mark = report.last_processed_request_id or 0
+            batches = split_batches([call for call in calls if call[0] > mark])
+
+            # Ссылки на звонки в ответах проверяются по набору проанализированных звонков, без запросов к БД
+            request_ids = {request_id for batch in batches for request_id, _ in batch}
+            batch_texts = [
+                "\n".join(f"звонок {request_id}: {text}" for request_id, text in batch)
+                for batch in batches
+            ]
+            job = WeeklyBatchJob(
+                batch_texts,
+                partial(kind.build_prompt, report),
+                partial(kind.save_response, report=report, request_ids=request_ids),
+                seed_first=kind.seed_first,
+                drop_failed=partial(register_failed_batch, kind_name, report, batches),
+            )
+            jobs.append((kind_name, report, batches, job))
+
+        run_weekly_jobs(client, [job for _, _, _, job in jobs])
+
+        for kind_name, report, batches, job in jobs:
+            if job.saved:
+                report.last_processed_request_id = batches[job.saved - 1][-1][0]
+                report.save(update_fields=["last_processed_request_id"])
+            analyzed[kind_name] = sum(
+                len(batch) for index, batch in enumerate(batches[:job.saved]) if index not in job.dropped
+            )
+            logger.info(f"Недельный анализ {kind_name} для {organization.name}: проанализировано звонков {analyzed[kind_name]}")
+
+    return analyzed
+
+
+def analyze_week(organization, kinds=None):
+    """
+    Анализирует активные отчёты текущей недели по всем настроенным видам анализа (WEEKLY_ANALYSIS_KINDS).
+    """
+    kinds = kinds or WEEKLY_ANALYSIS_KINDS
+    reports = {
+        kind_name: get_or_create_active_report(ANALYSIS_KINDS[kind_name].report_model, organization)
+        for kind_name in kinds
+    }
+    return analyze_weekly_reports(organization, reports)
+
+
+def analyze_weekly_errors(org, specific_report=None):
+    """
+    Анализирует ошибки за неделю для организации.
+    """
+    report = specific_report or get_or_create_active_report(WeeklyErrorReport, org)
+    return analyze_weekly_reports(org, {"errors": report})
+
+
+def analyze_weekly_factors(org, specific_report=None):
+    """
+    Анализирует факторы за неделю для организации.
+    """
+    report = specific_report or get_or_create_active_report(WeeklyFactorReport, org)
+    return analyze_weekly_reports(org, {"factors": report})
+
+
+def analyze_weekly_insights(org, specific_report=None, custom_prompt=None):
+    """
+    Анализирует инсайты за неделю для организации.
+    """
+    report = specific_report or get_or_create_active_report(WeeklyReport, org)
+    return analyze_weekly_reports(org, {"insights": report})
@@ -1,10 +1,7 @@
 # services/weekly_errors.py
 
-import re
-from datetime import timedelta
-from django.utils.timezone import now
 from ..models import *
-from .t_model import *
+from .weekly_common import get_or_create_active_report, parse_weekly_response, save_weekly_items
 
 DEFAULT_WEEKLY_ERROR_PROMPT_INITIAL = (
 """
@@ -102,144 +99,20 @@ f"""
 )
 
 
-def get_week_bounds(today=None):
-    """
-    Возвращает дату начала (понедельник) и конца (воскресенье) текущей недели.
-    """
-    today = today or now().date()
-    start = today - timedelta(days=today.weekday())
-    end = start + timedelta(days=6)
-    return start, end
-
-
 def get_or_create_active_weekly_error_report(organization):
     """
     Возвращает активный недельный отчет по ошибкам. Если нет — создаёт.
     Также завершает предыдущие устаревшие отчеты.
     """
-    week_start, week_end = get_week_bounds()
-
-    # Деактивируем устаревшие
-    WeeklyErrorReport.objects.filter(organization=organization, is_active=True)\
-        .exclude(week_start=week_start).update(is_active=False)
-
-    # Пытаемся найти активный
-    report = WeeklyErrorReport.objects.filter(
-        organization=organization,
-        week_start=week_start,
-        is_active=True
-    ).first()
-
-    if report:
-        return report
-
-    # Если нет — создаём новый
-    return WeeklyErrorReport.objects.create(
-        organization=organization,
-        week_start=week_start,
-        week_end=week_end,
-        is_active=True
-    )
+    return get_or_create_active_report(WeeklyErrorReport, organization)
 
 
 def parse_error_response(text: str) -> list[dict]:
-    errors = []
-    current = None
-
-    lines = text.replace("=== RESPONSE ===", "").strip().splitlines()
-
-    for line in lines:
-        line = line.strip()
-
-        # Парсим заголовок "Ошибка 1: ..."
-        match_title = re.match(r"(Ошибка)\s+\d+:\s+(.+)", line)
-        if match_title:
-            if current:
-                errors.append(current)
-            current = {"title": match_title.group(2).strip(), "frequency": 0, "examples": []}
-            continue
-
-        # Парсим "Количество повторений: N"
-        match_freq = re.match(r"Количество повторений:\s+(\d+)", line)
-        if match_freq and current:
-            current["frequency"] = int(match_freq.group(1))
-            continue
-
-        # Парсим примеры
-        if line.startswith("-") and current:
-            current["examples"].append(line.lstrip("-").strip())
-
-    if current:
-        errors.append(current)
-
-    return errors
+    return parse_weekly_response(text, "Ошибка")
 
 
-def extract_request_ids_from_text(text):
+def save_weekly_errors(response_text, report, request_ids=None):
     """
-    Ищет все ID звонков в тексте по шаблону 'звонок <число>'.
+    Сохраняет ответ нейросети в отчёт: примеры и их связи со звонками пишутся пачкой.
     """
-    matches = re.findall(r"звонок\s*(\d+)", text.lower())
-    return list(map(int, matches))
-
-
-def save_weekly_errors(response_text, report):
-    parsed = parse_error_response(response_text)
-
-    for error_data in parsed:
-        title = error_data["title"].strip()
-        frequency = error_data.get("frequency") or 0
-
-        if frequency == 0 or not error_data["examples"]:
-            continue
-        
-        error, created = WeeklyError.objects.update_or_create(
-            report=report,
-            title__iexact=title,
-            defaults={"title": title, "frequency": frequency}
-        )
-
-        for example_line in error_data["examples"]:
-            example = ErrorExample.objects.create(error=error, text=example_line)
-            request_ids = extract_request_ids_from_text(example_line)
-
-            for req_id in request_ids:
-                incoming = IncomingRequest.objects.filter(id=req_id).first()
-                if incoming:
-                    example.incoming_requests.add(incoming)
-
-
-def analyze_weekly_errors(org, specific_report=None):
-    """
-    Анализирует ошибки за неделю для организации.
-    """
-    report = specific_report or get_or_create_active_weekly_error_report(org)
-
-    requests = IncomingRequest.objects.filter(
-        organization=org,
-        created_at__date__range=(report.week_start, report.week_end),
-        ignored=False,
-    ).order_by("created_at")
-    batches = [requests[i:i + 20] for i in range(0, len(requests), 20)]
-    for batch in batches:
-        calls_text = "\n".join(
-            f"звонок {req.id}: {req.related_s2t_requests.last().transcribed_text.strip()}"
-            for req in batch
-            if req.related_s2t_requests.exists() and req.related_s2t_requests.last().transcribed_text
-        )
-
-        if calls_text == '':
-            continue
-
-        existing_errors = report.errors.all()
-
-        if existing_errors.exists():
-            prompt = build_prompt_with_existing_errors(existing_errors, calls_text)
-        else:
-            prompt = DEFAULT_WEEKLY_ERROR_PROMPT_INITIAL + "\n\n" + calls_text
-
-        client = init_tmodel_client(api_key=org.donkit_api_key)
-        response, _, _ = send_question_to_tlite(client, prompt)
-        if response:
-            save_weekly_errors(response, report)
-
+    save_weekly_items(report, parse_error_response(response_text), WeeklyError, ErrorExample, "error", request_ids)
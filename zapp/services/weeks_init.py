@@ -1,10 +1,10 @@
-import time
 from datetime import date, timedelta
 from django.utils.timezone import now
 from ..models import *
 from .weekly_reports import *
 from .weekly_errors import *
 from .weekly_factors import *
+from .weekly_engine import *
 
 
 def get_week_ranges(start_date: date, end_date: date):
@@ -50,6 +50,7 @@ def backfill_WeeklyReports(start_date=date(2025, 5, 1), end_date=date(2025, 6, 1
 def backfill_ErrorReports(org, start_date, end_date):
     """
     Создаёт WeeklyErrorReport для указанной организации и анализирует с заданным промптом.
+    Пауза между неделями не нужна: при 429 запросы сами замедляются (weekly_batches).
     """
     weeks = get_week_ranges(start_date, end_date)
 
@@ -61,12 +62,12 @@ def backfill_ErrorReports(org, start_date, end_date):
             defaults={"is_active": False}
         )
         analyze_weekly_errors(org, specific_report=report)
-        time.sleep(30)
 
 
 def backfill_FactorReports(org, start_date, end_date):
     """
     Создаёт WeeklyFactorReport для указанной организации и анализирует с заданным промптом.
+    Пауза между неделями не нужна: при 429 запросы сами замедляются (weekly_batches).
     """
     weeks = get_week_ranges(start_date, end_date)
 
@@ -78,4 +79,3 @@ def backfill_FactorReports(org, start_date, end_date):
             defaults={"is_active": False}
         )
         analyze_weekly_factors(org, specific_report=report)
-        time.sleep(30)
\ No newline at end of file
@@ -1,11 +1,12 @@
 # zapp/signals.py
 
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.conf import settings
 from .models import UserProfile, Organization, Prompt
 from .services.amocrm_service import fetch_and_create_managers
+from .services.organization_cache import invalidate_organization_cache
 
 
 @receiver(post_save, sender=User)
@@ -27,4 +28,30 @@ def create_default_prompt_and_managers_for_organization(sender, instance, create
             name="Промпт по умолчанию",
             description=settings.DEFAULT_ORGANIZATION_PROMPT.strip()
         )
-    fetch_and_create_managers(instance)
\ No newline at end of file
+    fetch_and_create_managers(instance)
+
+
+@receiver(pre_save, sender=Organization)
+def remember_organization_lookup_keys(sender, instance, **kwargs):
+    """
+    Запоминает прежние поддомен amoCRM и домен Bitrix24, чтобы сбросить кэш и по старым ключам.
+    """
+    instance._previous_lookup_keys = None
+    if instance.pk:
+        instance._previous_lookup_keys = (
+            Organization.objects.filter(pk=instance.pk).values_list("account_amocrm", "b24_domain").first()
+        )
+
+
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+def invalidate_organization_lookup_cache(sender, instance, **kwargs):
+    """
+    Сбрасывает кэш поиска организаций при изменении или удалении организации.
+    """
+    previous_subdomain, previous_b24_domain = getattr(instance, "_previous_lookup_keys", None) or (None, None)
+    invalidate_organization_cache(
+        organization_id=instance.pk,
+        subdomains=(instance.account_amocrm, previous_subdomain),
+        b24_domains=(instance.b24_domain, previous_b24_domain),
+    )
@@ -1,6 +1,10 @@
-import json, requests, logging
-from datetime import datetime
+import json, logging
+from datetime import timedelta
 from celery import shared_task
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
 from .models import *
 from .services.t_model import *
 from .services.pydub import *
@@ -9,26 +13,75 @@ from .services.amocrm_service import *
 from .services.weekly_reports import *
 from .services.weekly_errors import *
 from .services.weekly_factors import *
+from .services.weekly_engine import *
 from .services.custom_crm_service import *
+from .services.organization_cache import get_organization_by_subdomain
+from .services.amo_status_cache import get_amo_status_name, get_amo_status_mapping
+from .services.speech2text_service import *
+from .services.http_client import http_post
+from .services.webhook_dedup import find_amocrm_call_note, record_duplicate, release_webhook
+from .services.structured_scoring import build_scoring_prompt, parse_call_scoring, request_call_scoring, format_scoring_answer, apply_call_scoring
+from .services.token_budget import estimate_tokens, prepare_transcript
+from .services.llm_cache import LLM_RESPONSE_CACHE, llm_cache_key, get_cached_response, store_response
 
 logger = logging.getLogger(__name__)
 
 MINIMAL_CALL_LENGTH = 30
 MIN_TRANSCRIBATION_TEXT_LENGTH = 100
 MAX_NUMBER_OF_RETRY_TO_GET_CALL_URL = 50
+# Если организация присылает вебхуки статусов, ночная сверка затрагивает только сделки,
+# статус которых не сверяли дольше этого срока; без вебхуков сделки сверяются каждую ночь
+DEAL_STATUS_RECONCILE_DAYS = getattr(settings, "DEAL_STATUS_RECONCILE_DAYS", 3)
 
-@shared_task
-def process_amocrm_request(data):
+def is_duplicate_note(organization, note_id):
+    """
+    Запрос по этому примечанию amoCRM уже сохранён (повторная доставка вебхука).
+    """
+    return bool(note_id) and IncomingRequest.objects.filter(organization=organization, note_id=note_id).exists()
+
+
+def get_or_update_amo_deal(organization, lead_id, deal_status):
+    """
+    Находит сделку amoCRM в БД или создаёт её; при изменении статуса обновляет его.
+    """
+    lead_id = str(lead_id)
+    status_text = get_amo_status_name(organization, deal_status)
+
+    deal = DealStage.objects.filter(deal_id_crm=lead_id, organization=organization).first()
+    if not deal:
+        return DealStage.objects.create(
+            deal_id_crm=lead_id,
+            organization=organization,
+            crm_type="amoCRM",
+            deal_type="first",
+            status=status_text
+        )
+
+    if deal_status and deal.status != status_text:
+        deal.status = status_text
+        deal.save()
+    return deal
+
+
+@shared_task(bind=True, autoretry_for=(CRMRateLimitError,), retry_backoff=5, retry_jitter=True, max_retries=10)
+def process_amocrm_request(self, data):
     """
     Обрабатывает данные из входящего вебхука amoCRM, включая contacts, leads и companies.
+    При ограничении частоты запросов amoCRM задача повторяется с задержкой.
+    Если обработка не удалась окончательно, отметка вебхука снимается, чтобы повторная доставка из amoCRM прошла.
     """
+    organization = None
     try:
         subdomain = data.get("account[subdomain]") 
-        organization = Organization.objects.filter(account_amocrm=subdomain).first()
+        organization = get_organization_by_subdomain(subdomain)
 
-        if organization.custom_crm:
+        if organization and organization.custom_crm:
             # Извлекаем note
             note_id = data.get("contacts[note][0][note][id]")
+            if is_duplicate_note(organization, note_id):
+                record_duplicate("amoCRM")
+                return {"status": "duplicate", "message": f"Примечание {note_id} уже обработано"}
+
             note_text_raw = data.get("contacts[note][0][note][text]")
             note_data = {}
 
@@ -123,6 +176,11 @@ def process_amocrm_request(data):
         if not organization:
             return {"status": "ignored", "message": f"Не найдена организация {subdomain}"}
 
+        # Повторный вебхук — не скачиваем аудио и не запускаем платную транскрибацию второй раз
+        if not self.request.retries and is_duplicate_note(organization, note_id):
+            record_duplicate("amoCRM")
+            return {"status": "duplicate", "message": f"Примечание {note_id} уже обработано"}
+
         # Парсинг note_text
         try:
             note_data = json.loads(note_text)
@@ -152,98 +210,56 @@ def process_amocrm_request(data):
         if note_info_amocrm.get("note_type") == "call_in":
             call_direction = "incoming"
 
+        # Контакт и сделку определяем до сохранения, чтобы записать запрос одним INSERT
+        user_id = None
+        deal = None
+        if not ignored_flag:
+            if element_type == "1":
+                # Контакт и его сделки — два запроса к amoCRM, последняя активная сделка выбирается локально
+                user_id = element_id
+                contact_leads = resolve_contact_leads(element_id, organization)
+                latest_lead = contact_leads["latest_active_lead"] if contact_leads else None
+                if latest_lead:
+                    deal = get_or_update_amo_deal(organization, latest_lead["id"], latest_lead.get("status_id"))
+
+            elif element_type == "2":
+                # Прямая работа со сделкой, указанной в примечании
+                deal_data = get_lead_details(element_id, organization)
+                deal = get_or_update_amo_deal(organization, element_id, deal_data.get("status_id") if deal_data else None)
+
+                # 🔍 Контакт звонка — первый контакт сделки
+                contacts = deal_data.get("_embedded", {}).get("contacts", []) if deal_data else []
+                if contacts and contacts[0].get("id"):
+                    user_id = str(contacts[0]["id"])
+
+        # При повторе после 429 запрос уже сохранён — не создаём дубль
+        incoming_request = None
+        if self.request.retries:
+            incoming_request = IncomingRequest.objects.filter(organization=organization, note_id=note_id, source="amoCRM").first()
+
         # Сохраняем запрос
-        incoming_request = IncomingRequest.objects.create(
-            raw_data=data,
-            domain=subdomain,
-            ignored=ignored_flag,
-            note_id=note_id,
-            organization=organization,
-            call_direction=call_direction,
-            audio_link=audio_link,
-            audio_duration=audio_duration,
-            source="amoCRM",
-            client_phone=client_phone,
-            manager=manager,
-        )
+        if not incoming_request:
+            incoming_request = IncomingRequest.objects.create(
+                raw_data=data,
+                domain=subdomain,
+                ignored=ignored_flag,
+                note_id=note_id,
+                organization=organization,
+                call_direction=call_direction,
+                audio_link=audio_link,
+                audio_duration=audio_duration,
+                source="amoCRM",
+                client_phone=client_phone,
+                manager=manager,
+                user_id=user_id,
+            )
 
         if ignored_flag:
             return {"status": "ignored", "message": "Аудио слишком короткое"}
 
-        # Обработка только для element_type = 1 (контакт)
-        if element_type == "1":
-            incoming_request.user_id = element_id
-            incoming_request.save()
-            contact_data = get_contact_with_leads(element_id, organization)
-
-            if contact_data and "_embedded" in contact_data and "leads" in contact_data["_embedded"]:
-                lead_id = get_latest_active_lead(element_id, organization)
-
-                if lead_id:
-                    deal_data = get_lead_details(lead_id, organization)
-                    deal_status = deal_data.get("status_id") if deal_data else None
-                    status_mapping = get_amo_lead_statuses(organization)
-                    status_text = status_mapping.get(str(deal_status), f"Неизвестный статус ({deal_status})")
-
-                    existing_deal = DealStage.objects.filter(deal_id_crm=lead_id, organization=organization).first()
-                    if not existing_deal:
-                        existing_deal = DealStage.objects.create(
-                            deal_id_crm=lead_id,
-                            organization=organization,
-                            crm_type="amoCRM",
-                            deal_type="first",
-                            status=status_text
-                        )
-                    else:
-                        if deal_status and existing_deal.status != deal_status:
-                            existing_deal.status = deal_status
-                            existing_deal.save()
-
-                    incoming_request.deal_stages.add(existing_deal)
-                    incoming_request.save()
-        elif element_type == "2":
-            # Прямая работа со сделкой, указанной в примечании
-            lead_id = element_id
-
-            # Получаем данные сделки
-            deal_data = get_lead_details(lead_id, organization)
-            deal_status = deal_data.get("status_id") if deal_data else None
-
-            # Получаем текстовое описание статуса
-            status_mapping = get_amo_lead_statuses(organization)
-            status_text = status_mapping.get(str(deal_status), f"Неизвестный статус ({deal_status})")
-
-            # Пытаемся найти сделку в БД
-            existing_deal = DealStage.objects.filter(deal_id_crm=lead_id, organization=organization).first()
-
-            if not existing_deal:
-                # Если сделки нет — создаём новую
-                existing_deal = DealStage.objects.create(
-                    deal_id_crm=lead_id,
-                    organization=organization,
-                    crm_type="amoCRM",
-                    deal_type="first",
-                    status=status_text
-                )
-            else:
-                # Если уже есть — обновляем статус при необходимости
-                if deal_status and existing_deal.status != deal_status:
-                    existing_deal.status = deal_status
-                    existing_deal.save()
-
-            # 🔍 Получаем contact_id первого контакта
-            contact_id = None
-            if deal_data:
-                contacts = deal_data.get("_embedded", {}).get("contacts", [])
-                if contacts:
-                    contact_id = contacts[0].get("id")
-
-            if contact_id:
-                incoming_request.user_id = str(contact_id)
-
-            # Привязываем звонок к этой сделке
-            incoming_request.deal_stages.add(existing_deal)
-            incoming_request.save()
+        # Привязываем звонок к сделке (одна строка в связующей таблице, без повторного save)
+        if deal:
+            incoming_request.deal_stages.add(deal)
 
         # Отправляем на транскрибацию
         if audio_link:
@@ -251,8 +267,16 @@ def process_amocrm_request(data):
 
         return {"status": "success", "message": "Запрос успешно обработан"}
 
+    except IntegrityError:
+        # Параллельная обработка того же примечания уже сохранила запрос (уникальный индекс)
+        record_duplicate("amoCRM")
+        return {"status": "duplicate", "message": "Примечание уже обработано"}
     except Exception as e:
         logger.error(f"Ошибка в process_amocrm_request: {str(e)}")
+        retrying = isinstance(e, CRMRateLimitError) and self.request.retries < self.max_retries
+        prefix = find_amocrm_call_note(data)
+        if organization and prefix and not retrying:
+            release_webhook("amo", organization.id, data.get(f"{prefix}[id]"))
         raise
 
 
@@ -317,12 +341,11 @@ def get_bitrix_call_record_task(self, incoming_request_id, attempt=1):
                         existing_deal_stage.status = deal_status
                         existing_deal_stage.save()
 
+            incoming_request.save()
+
             # Привязываем входящий запрос к сделке
             if existing_deal_stage:
                 incoming_request.deal_stages.add(existing_deal_stage)
-                incoming_request.save()
-
-            incoming_request.save()
 
             # Запускаем транскрибацию
             send_to_speech2text.delay(incoming_request.id)
@@ -332,14 +355,62 @@ def get_bitrix_call_record_task(self, incoming_request_id, attempt=1):
             if attempt < MAX_NUMBER_OF_RETRY_TO_GET_CALL_URL:
                 raise self.retry(exc=Exception("Запись не найдена"), countdown=countdown)
 
+    except CRMRateLimitError as e:
+        # Bitrix24 ограничил частоту запросов — повторяем позже, не теряя звонок
+        raise self.retry(exc=e, countdown=30)
     except Exception as e:
         logger.error(f"Ошибка при обработке звонка Bitrix24: {str(e)}")
 
 
+def find_cached_transcription(incoming_request):
+    """
+    Ищет готовую транскрибацию той же записи в организации (транскрибации самого запроса не учитываются).
+    Запись определяется по ссылке и отпечатку файла (начало файла + размер): одна ссылка без отпечатка
+    не считается совпадением, так как по той же ссылке может лежать уже другая запись.
+    Если по той же ссылке совпадения нет, ищется та же запись, пришедшая по другой ссылке (только по отпечатку).
+
+    :return: (отпечаток аудио или None, S2TRequest с текстом или None).
+    """
+    audio_link = incoming_request.audio_link
+    fingerprint = get_audio_fingerprint(audio_link)
+    if not fingerprint:
+        return None, None
+
+    transcribed = S2TRequest.objects.filter(
+        organization=incoming_request.organization, audio_fingerprint=fingerprint
+    ).exclude(
+        Q(transcribed_text__isnull=True) | Q(transcribed_text="") | Q(incoming_request=incoming_request)
+    ).order_by("-created_at")
+
+    cached = transcribed.filter(audio_link=audio_link).first() or transcribed.first()
+    return fingerprint, cached
+
+
+def clone_cached_transcription(incoming_request, cached, fingerprint):
+    """
+    Копирует готовый текст транскрибации в новый S2TRequest и сразу отправляет звонок в DeepSeekV3.
+    """
+    s2t_request = S2TRequest.objects.create(
+        incoming_request=incoming_request,
+        organization=incoming_request.organization,
+        task_id=f"cache:{cached.task_id.removeprefix('cache:')}",
+        status=S2T_DONE_STATUS,
+        audio_link=incoming_request.audio_link,
+        txt_result_link=cached.txt_result_link,
+        transcribed_text=cached.transcribed_text,
+        audio_fingerprint=fingerprint,
+    )
+    send_latest_prompt_to_donkit(incoming_request, incoming_request.organization)
+    return s2t_request
+
+
 @shared_task
-def send_to_speech2text(incoming_request_id):
+def send_to_speech2text(incoming_request_id, use_cache=True):
     """
     Отправляет аудиофайл, связанный с входящим запросом, на сервис Speech2Text.
+    Если эта запись уже транскрибирована в организации, текст берётся из кэша без обращения к Speech2Text.
+
+    :param use_cache: False — транскрибировать заново, даже если есть готовый текст.
     """
     try:
         incoming_request = IncomingRequest.objects.get(id=incoming_request_id)
@@ -351,11 +422,23 @@ def send_to_speech2text(incoming_request_id):
         if not s2t_api_key:
             return {"status": "error", "message": "API-ключ Speech2Text отсутствует"}
 
+        fingerprint = None
+        if S2T_TRANSCRIPT_CACHE and use_cache:
+            fingerprint, cached = find_cached_transcription(incoming_request)
+            if cached:
+                clone_cached_transcription(incoming_request, cached, fingerprint)
+                return {"status": "success", "message": "Транскрибация взята из кэша"}
+        elif S2T_TRANSCRIPT_CACHE:
+            fingerprint = get_audio_fingerprint(audio_link)
+
         # Формируем запрос
-        url = "https://speech2text.ru/api/recognitions/task/link"
+        url = f"{S2T_API_URL}/recognitions/task/link"
         headers = {"Content-Type":"application/json"}
         data = {"lang": "ru", "url": audio_link, "speakers": 2, "multi_channel": 1}
-        response = requests.post(f"{url}?api-key={s2t_api_key}", headers=headers, json=data)
+        callback_url = get_s2t_callback_url()
+        if callback_url:
+            data["callback_url"] = callback_url
+        response = http_post(url, params={"api-key": s2t_api_key}, headers=headers, json=data)
 
         # Обрабатываем ответ от Speech2Text
         if response.status_code == 201:
@@ -370,12 +453,13 @@ def send_to_speech2text(incoming_request_id):
                 task_id=task_id,
                 status=status_description,
                 audio_link=audio_link,
+                audio_fingerprint=fingerprint,
             )
 
             if response_data.get("status", {}).get("code") == 200:
                 result_links = response_data.get("result", {})
                 s2t_request.txt_result_link = result_links.get("txt")
-                s2t_request.transcribed_text = requests.get(result_links["txt"]+"?api-key="+s2t_api_key).text
+                s2t_request.transcribed_text = fetch_transcribed_text(result_links["txt"], s2t_api_key)
 
                 # Автоматически отправляем запрос в Donkit
                 incoming_request = s2t_request.incoming_request
@@ -388,39 +472,44 @@ def send_to_speech2text(incoming_request_id):
         logger.error(f"Ошибка при отправке на транскрибацию: {str(e)}")
 
 
+def apply_recognition_result(s2t_request, result):
+    """
+    Переносит результат опроса Speech2Text в S2TRequest (без сохранения).
+    Возвращает True, если распознавание завершено.
+    """
+    s2t_request.status = result["status"]
+    if result["done"]:
+        s2t_request.txt_result_link = result["txt_result_link"]
+        s2t_request.transcribed_text = result["transcribed_text"]
+    return result["done"]
+
+
+def send_latest_prompt_to_donkit(incoming_request, organization):
+    """
+    Отправляет звонок в DeepSeekV3 с последним промптом организации.
+    """
+    prompt = organization.prompts.order_by('-created_at').first()
+    send_to_donkit_task.delay(incoming_request.id, prompt.id if prompt else None)
+
+
 @shared_task
 def check_transcription_status(task_id):
     """
-    еряет статус задачи в Speech2Text и сохраняет результаты.
+    Проверяет статус задачи в Speech2Text и сохраняет результаты.
     """
     try:
         s2t_request = S2TRequest.objects.get(task_id=task_id)
         organization = s2t_request.organization
-        s2t_api_key = organization.s2t_api_key
-
-        # Проверяем статус задачи
-        url = f"https://speech2text.ru/api/recognitions/{task_id}"
-        response = requests.get(f"{url}?api-key={s2t_api_key}")
 
-        if response.status_code == 200:
-            response_data = response.json()
-            status = response_data.get("status", {}).get("description", "unknown")
-            s2t_request.status = status
-
-            # Если задача завершена, сохраняем текст
-            if response_data.get("status", {}).get("code") == 200:
-                result_links = response_data.get("result", {})
-                s2t_request.txt_result_link = result_links.get("txt")
-                s2t_request.transcribed_text = requests.get(result_links["txt"]+"?api-key="+s2t_api_key).text
-
-                # Автоматически отправляем запрос в Donkit
+        result = fetch_recognition(task_id, organization.s2t_api_key)
+        if result:
+            # Если задача завершена, отправляем текст в Donkit
+            if apply_recognition_result(s2t_request, result):
                 if not s2t_request.incoming_request:
-                    logger.error(f"Ошибка привязки S2TRequest к IncomingRequest {incoming_request.id}")
+                    logger.error(f"Ошибка привязки S2TRequest {s2t_request.id} к IncomingRequest")
                 else:
-                    incoming_request = s2t_request.incoming_request
-                    prompt = organization.prompts.order_by('-created_at').first()
-                    send_to_donkit_task.delay(incoming_request.id, prompt.id if prompt else None)
-            
+                    send_latest_prompt_to_donkit(s2t_request.incoming_request, organization)
+
             s2t_request.save()
 
     except Exception as e:
@@ -428,28 +517,142 @@ def check_transcription_status(task_id):
 
 
 @shared_task
-def schedule_transcription_checks():
+def complete_transcription(task_id, txt_result_link=None):
     """
-    Проверяет статус всех запросов Speech2Text, которые находятся в состоянии ожидания или обработки.
-    Если статус задания меняется на завершённое, обновляет записи в базе данных.
+    Завершает распознавание по колбэку Speech2Text: один раз скачивает txt-результат
+    и сразу отправляет звонок в DeepSeekV3.
+    Если ссылка не передана или ей нельзя доверять, статус запрашивается у Speech2Text.
     """
-    # Ищем все запросы со статусом, указывающим на ожидание или обработку
-    pending_requests = S2TRequest.objects.filter(status__in=["Задание создано", "В очереди на распознание", "Процесс получения файла"])
+    try:
+        s2t_request = S2TRequest.objects.select_related("organization").filter(task_id=task_id).first()
+        if not s2t_request:
+            logger.warning(f"Колбэк Speech2Text для неизвестной задачи {task_id}")
+            return
+        if s2t_request.transcribed_text:
+            return  # Уже обработано опросом или повторным колбэком
+
+        organization = s2t_request.organization
+        api_key = organization.s2t_api_key
+
+        if is_trusted_s2t_link(txt_result_link):
+            result = {
+                "status": S2T_DONE_STATUS,
+                "done": True,
+                "txt_result_link": txt_result_link,
+                "transcribed_text": fetch_transcribed_text(txt_result_link, api_key),
+            }
+        else:
+            result = fetch_recognition(task_id, api_key)
+            if not result:
+                return
+
+        done = apply_recognition_result(s2t_request, result)
+
+        # Сохраняем, только если строку не завершил параллельный опрос — так звонок не уйдёт в DeepSeekV3 дважды
+        updated = S2TRequest.objects.filter(id=s2t_request.id).filter(
+            Q(transcribed_text__isnull=True) | Q(transcribed_text="")
+        ).update(
+            status=s2t_request.status,
+            txt_result_link=s2t_request.txt_result_link,
+            transcribed_text=s2t_request.transcribed_text,
+            updated_at=timezone.now(),
+        )
 
-    if not pending_requests.exists():
+        if done and updated:
+            send_latest_prompt_to_donkit(s2t_request.incoming_request, organization)
+
+    except Exception as e:
+        logger.error(f"Ошибка при обработке колбэка Speech2Text {task_id}: {str(e)}")
+
+
+@shared_task
+def poll_transcription_batch(s2t_request_ids):
+    """
+    Опрашивает пачку задач Speech2Text параллельно через общую keep-alive сессию
+    и сохраняет результаты одним bulk_update.
+    """
+    s2t_requests = list(
+        S2TRequest.objects.filter(id__in=s2t_request_ids).select_related("organization", "incoming_request")
+    )
+    if not s2t_requests:
         return
 
-    # Перебираем все найденные запросы и добавляем их в Celery очередь для проверки
-    for request in pending_requests:
-        S2TRequest.objects.filter(id=request.id).update(status="Распознается...")
-        check_transcription_status.delay(request.task_id)
+    results = poll_recognitions([(r.task_id, r.organization.s2t_api_key) for r in s2t_requests])
+
+    completed = []
+    updated_at = timezone.now()
+    for s2t_request in s2t_requests:
+        result = results.get(s2t_request.task_id)
+        if result is None:
+            # Опрос не удался — вернём строку в очередь на следующий проход
+            s2t_request.status = S2T_RETRY_STATUS
+        elif apply_recognition_result(s2t_request, result):
+            completed.append(s2t_request)
+        s2t_request.updated_at = updated_at
+
+    S2TRequest.objects.bulk_update(
+        s2t_requests, ["status", "txt_result_link", "transcribed_text", "updated_at"]
+    )
+
+    # Автоматически отправляем завершённые распознавания в Donkit
+    prompts = {}
+    for s2t_request in completed:
+        organization = s2t_request.organization
+        if organization.id not in prompts:
+            prompts[organization.id] = organization.prompts.order_by('-created_at').first()
+        prompt = prompts[organization.id]
+        send_to_donkit_task.delay(s2t_request.incoming_request_id, prompt.id if prompt else None)
+
+
+def claim_pending_transcriptions(updated_before, limit=S2T_POLL_CHUNK_SIZE):
+    """
+    Забирает в опрос пачку ожидающих S2TRequest одним UPDATE.
+    Параллельные запуски не получат одни и те же строки благодаря SKIP LOCKED,
+    а строки, уже опрошенные после updated_before, не берутся повторно в том же проходе.
+    Строки, взятые в опрос дольше S2T_POLL_LEASE_TIMEOUT назад, забираются снова: их задача опроса потерялась.
+    """
+    lease_expired_at = timezone.now() - timedelta(seconds=S2T_POLL_LEASE_TIMEOUT)
+    pending = S2TRequest.objects.filter(
+        Q(status__in=S2T_PENDING_STATUSES, updated_at__lt=updated_before)
+        | Q(status=S2T_CHECKING_STATUS, updated_at__lt=lease_expired_at)
+    )
+    if get_s2t_callback_url():
+        # При работающих колбэках опрос — только страховка для задач, по которым колбэк не пришёл
+        pending = pending.filter(created_at__lt=timezone.now() - timedelta(seconds=S2T_CALLBACK_GRACE_PERIOD))
+
+    with transaction.atomic():
+        ids = list(
+            pending.select_for_update(skip_locked=True)
+            .order_by("id")
+            .values_list("id", flat=True)[:limit]
+        )
+        if ids:
+            S2TRequest.objects.filter(id__in=ids).update(status=S2T_CHECKING_STATUS, updated_at=timezone.now())
+    return ids
+
+
+@shared_task
+def schedule_transcription_checks():
+    """
+    Проверяет статус всех запросов Speech2Text, которые находятся в состоянии ожидания или обработки.
+    Ожидающие запросы забираются пачками, и на каждую пачку ставится одна задача опроса.
+    """
+    sweep_started_at = timezone.now()
+    while True:
+        ids = claim_pending_transcriptions(sweep_started_at)
+        if not ids:
+            return
+        poll_transcription_batch.delay(ids)
 
 
 @shared_task
-def send_to_donkit_task(incoming_request_id, prompt_id=None):
+def send_to_donkit_task(incoming_request_id, prompt_id=None, use_cache=True):
     """
     Отправляет запрос в DeepSeekV3.
     Если промпт не указан, используется последний добавленный промпт.
+    Если та же модель уже отвечала на тот же промпт для той же транскрибации, ответ берётся из кэша.
+
+    :param use_cache: False — принудительно отправить запрос в нейросеть, не заглядывая в кэш.
     """
     try:
         incoming_request = IncomingRequest.objects.get(id=incoming_request_id)
@@ -472,20 +675,73 @@ def send_to_donkit_task(incoming_request_id, prompt_id=None):
         if len(transcribed_text) < MIN_TRANSCRIBATION_TEXT_LENGTH:
             return {"status": "skipped", "message": "Текст слишком короткий для отправки в DeepSeekV3"}
 
-        # Авторизация в DeepSeekV3
-        client = init_tmodel_client(api_key=organization.donkit_api_key)
+        # Формируем запрос; в режиме JSON промпт дополняется схемой ответа
+        structured = organization.structured_scoring
+        prompt_text = build_scoring_prompt(prompt.description, organization) if structured else prompt.description
+        question = f"{prompt_text}\n\n{transcribed_text}"
+
+        cache_key = llm_cache_key(TMODEL_NAME, prompt_text, transcribed_text)
+        cached = get_cached_response(cache_key) if use_cache and LLM_RESPONSE_CACHE else None
+
+        scoring = None
+        if cached:
+            logger.info(f"Ответ DeepSeekV3 для запроса {incoming_request.id} взят из кэша")
+            answer, tokens_used, raw_answer = cached.answer, cached.tokens_used, cached.raw_answer
+            usage = {"prompt_tokens": cached.prompt_tokens, "completion_tokens": cached.completion_tokens}
+            if structured:
+                scoring = parse_call_scoring(raw_answer)
+        else:
+            # Авторизация в DeepSeekV3
+            client = init_tmodel_client(api_key=organization.donkit_api_key)
+
+            # Убираем междометия, а слишком длинную транскрибацию сжимаем пересказом по частям
+            usage = {}
+            model_transcript = prepare_transcript(client, prompt_text, transcribed_text, usage=usage)
+            question = f"{prompt_text}\n\n{model_transcript}"
+
+            answer = None
+            if structured:
+                scoring, tokens_used, raw_answer = request_call_scoring(client, question, usage=usage)
+                if scoring:
+                    answer = format_scoring_answer(scoring)
+                else:
+                    # Модель не вернула корректный JSON — запрашиваем обычный текст и разбираем его регулярками
+                    logger.warning(f"Оценка в JSON для запроса {incoming_request.id} не получена, используем текстовый ответ")
+                    question = f"{prompt.description}\n\n{model_transcript}"
+                    cache_key = llm_cache_key(TMODEL_NAME, prompt.description, transcribed_text)
+
+            if not answer:
+                # Отправляем запрос в DeepSeekV3; в потоковом режиме оценки сохраняются по мере появления в ответе
+                if TMODEL_STREAMING:
+                    stream_parser = CriteriaStreamParser(incoming_request)
+                    answer, tokens_used, raw_answer = stream_question_to_tlite(client, question, on_text=stream_parser.feed, usage=usage)
+                    if not answer:
+                        # Поток оборвался: DonkitRequest не будет сохранён, поэтому и частичные оценки не оставляем
+                        stream_parser.rollback()
+                else:
+                    answer, tokens_used, raw_answer = send_question_to_tlite(client, question, usage=usage)
+            if not answer:
+                logger.warning(
+                    f"DeepSeekV3 не вернул ответ для запроса {incoming_request.id} "
+                    f"(оценка запроса ~{estimate_tokens(question)} токенов)"
+                )
+                return
 
-        # Формируем запрос
-        question = f"{prompt.description}\n\n{transcribed_text}"
+            # С учётом пересказа частей и неудачной попытки JSON токенов потрачено больше, чем в последнем ответе
+            if usage:
+                tokens_used = usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
 
-        # Отправляем запрос в DeepSeekV3
-        answer, tokens_used, raw_answer = send_question_to_tlite(client, question)
-        if not answer:
-            return
+            if LLM_RESPONSE_CACHE:
+                store_response(
+                    cache_key, TMODEL_NAME, answer, tokens_used, raw_answer,
+                    prompt_tokens=usage.get("prompt_tokens"), completion_tokens=usage.get("completion_tokens"),
+                )
         
-        # Успешная обработка: обновляем общий счётчик
-        organization.total_audio_duration += incoming_request.audio_duration
-        organization.save()
+        # Успешная обработка: обновляем общий счётчик одним UPDATE, без сохранения всей организации
+        # (сохранение перечитывает организацию в pre_save и сбрасывает её кэш при каждом звонке)
+        Organization.objects.filter(pk=organization.pk).update(
+            total_audio_duration=F("total_audio_duration") + (incoming_request.audio_duration or 0)
+        )
 
         # Сохраняем результат в DonkitRequest
         donkit_request = DonkitRequest.objects.create(
@@ -497,11 +753,16 @@ def send_to_donkit_task(incoming_request_id, prompt_id=None):
             question=question,
             answer=answer,
             tokens_used=tokens_used,  
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
             prompt=prompt  
         )
 
-        # Анализируем критерии
-        criteria = analyze_criteria_20(answer, incoming_request)
+        # Анализируем критерии: из JSON-ответа напрямую, из текстового — регулярками
+        if scoring:
+            criteria = apply_call_scoring(incoming_request, scoring)
+        else:
+            criteria = analyze_criteria_20(answer, incoming_request)
         # отладка критериев
         if criteria:
             logger.info(f"Критерии успешно сохранены для запроса {incoming_request.id}")
@@ -534,9 +795,7 @@ def send_to_donkit_task(incoming_request_id, prompt_id=None):
                 if organization.summary_to_lead and summary != "":
                     if text_to_send == "**Саммари:**\n\n":
                         return
-                    active_leads = get_active_leads_with_tag(incoming_request.user_id, organization)
-                    for lead in active_leads:
-                        add_note_to_lead.delay(organization.id, lead["id"], "**Саммари:**\n\n"+summary)
+                    add_summary_to_active_leads.delay(organization.id, incoming_request.user_id, "**Саммари:**\n\n"+summary)
             elif incoming_request.organization.send_comments_to_amocrm and incoming_request.organization.custom_crm:
                 send_custom_crm_note(organization, incoming_request.user_id, text_to_send)
 
@@ -571,37 +830,190 @@ def send_to_donkit_task(incoming_request_id, prompt_id=None):
         logger.error(f"Ошибка в Celery задаче отправки в DeepSeekV3: {str(e)}")
 
 
-@shared_task
-def update_deal_statuses():
+def fetch_amo_deal_statuses(organization, lead_ids):
     """
-    Проверяет статус сделок в CRM (Bitrix24 и amoCRM) и обновляет их в БД, если они изменились.
-    Запускается раз в сутки через Celery Beat.
+    Названия статусов сделок amoCRM: dict ID сделки -> название статуса.
+    """
+    leads = get_leads_by_ids(organization, lead_ids)
+    status_mapping = get_amo_status_mapping(organization)
+    return {
+        lead_id: get_amo_status_name(organization, lead.get("status_id"), status_mapping)
+        for lead_id, lead in leads.items()
+    }
+
+
+def sync_deal_chunk(organization, deals, fetch_statuses):
+    """
+    Получает статусы пачки сделок одним обращением к CRM и сохраняет только изменившиеся.
+
+    :return: количество обновлённых сделок.
     """
-    deals = DealStage.objects.all()
+    statuses = fetch_statuses(organization, {deal.deal_id_crm for deal in deals})
+    now = timezone.now()
 
+    changed, synced_ids = [], []
     for deal in deals:
-        if deal.crm_type == "Bitrix24":
-            new_status = get_bitrix_lead_details(deal.organization, deal.deal_id_crm)
-        elif deal.crm_type == "amoCRM":
-            lead_data = get_lead_details(deal.deal_id_crm, deal.organization)  # Переиспользуем функцию
-            if lead_data:
-                status_id = str(lead_data.get("status_id"))
-                status_mapping = get_amo_lead_statuses(deal.organization)  # Получаем соответствие ID -> название
-                new_status = status_mapping.get(status_id, f"Неизвестный статус ({status_id})")
-        else:
+        new_status = statuses.get(str(deal.deal_id_crm))
+        if not new_status:
             continue
-
-        if new_status and new_status != deal.status:
+        if new_status != deal.status:
             deal.status = new_status
-            deal.updated_at = datetime.now()
-            deal.save()
+            deal.updated_at = now
+            deal.status_synced_at = now
+            changed.append(deal)
+        else:
+            synced_ids.append(deal.id)
+
+    if changed:
+        DealStage.objects.bulk_update(changed, ["status", "updated_at", "status_synced_at"])
+    if synced_ids:
+        DealStage.objects.filter(id__in=synced_ids).update(status_synced_at=now)
+    return len(changed)
+
+
+def apply_deal_status(organization, crm_type, deal_id_crm, status):
+    """
+    Записывает статус, пришедший из CRM вебхуком, во все строки сделки одним запросом и отмечает время сверки.
+    updated_at меняется только у строк, где статус действительно изменился.
+    """
+    now = timezone.now()
+    DealStage.objects.filter(
+        organization=organization, crm_type=crm_type, deal_id_crm=str(deal_id_crm)
+    ).update(
+        status=status,
+        status_synced_at=now,
+        updated_at=Case(When(status=status, then=F("updated_at")), default=Value(now)),
+    )
+
+
+def mark_deal_status_webhook(organization):
+    """
+    Запоминает время вебхука статусов: по нему ночная сверка понимает, что статусы организации приходят вебхуками.
+    """
+    Organization.objects.filter(id=organization.id).update(deal_status_webhook_at=timezone.now())
+
+
+@shared_task(autoretry_for=(CRMRateLimitError,), retry_backoff=5, retry_jitter=True, max_retries=10)
+def apply_amo_lead_statuses(organization_id, lead_statuses):
+    """
+    Обновляет статусы сделок по вебхуку amoCRM leads[status].
+
+    :param lead_statuses: dict ID сделки -> status_id из вебхука.
+    """
+    organization = Organization.objects.filter(id=organization_id).first()
+    if not organization:
+        return
+
+    tracked = set(DealStage.objects.filter(
+        organization=organization, crm_type="amoCRM", deal_id_crm__in=list(lead_statuses)
+    ).values_list("deal_id_crm", flat=True))
+
+    mark_deal_status_webhook(organization)
+    status_mapping = get_amo_status_mapping(organization)
+    for lead_id in tracked:
+        apply_deal_status(
+            organization, "amoCRM", lead_id, get_amo_status_name(organization, lead_statuses[lead_id], status_mapping)
+        )
+
+
+@shared_task(autoretry_for=(CRMRateLimitError,), retry_backoff=5, retry_jitter=True, max_retries=10)
+def sync_bitrix_lead_status(organization_id, lead_id):
+    """
+    Обновляет статус лида по событию Bitrix24 ONCRMLEADUPDATE (событие не содержит полей лида).
+    """
+    organization = Organization.objects.filter(id=organization_id).first()
+    if not organization:
+        return
+
+    mark_deal_status_webhook(organization)
+    if not DealStage.objects.filter(organization=organization, crm_type="Bitrix24", deal_id_crm=str(lead_id)).exists():
+        return  # Лид не связан со звонками — статус не нужен
+
+    status = get_bitrix_lead_details(organization, lead_id)
+    if status:
+        apply_deal_status(organization, "Bitrix24", lead_id, status)
+
+
+@shared_task
+def update_deal_statuses(full_resync=False):
+    """
+    Проверяет статус сделок в CRM (Bitrix24 и amoCRM) и обновляет их в БД, если они изменились.
+    Запускается раз в сутки через Celery Beat и раздаёт работу по задаче на организацию.
+    Если организация присылала вебхуки статусов за последние DEAL_STATUS_RECONCILE_DAYS дней,
+    ночью сверяются только сделки, статус которых не сверяли дольше этого срока;
+    у остальных организаций сделки сверяются каждую ночь.
+
+    :param full_resync: проверять все сделки, включая финальные статусы и недавно сверенные.
+    """
+    organization_ids = DealStage.objects.values_list("organization_id", flat=True).distinct()
+    for organization_id in organization_ids:
+        sync_organization_deal_statuses.delay(organization_id, full_resync=full_resync)
+
+
+@shared_task(bind=True, max_retries=10)
+def sync_organization_deal_statuses(self, organization_id, full_resync=False, deal_ids=None):
+    """
+    Синхронизирует статусы сделок одной организации пачками:
+    amoCRM — списком по filter[id][] (250 сделок на запрос), Bitrix24 — через batch (50 лидов на запрос).
+    При ограничении частоты запросов задача повторяется только для необработанных сделок.
+    """
+    organization = Organization.objects.filter(id=organization_id).first()
+    if not organization:
+        return
+
+    deals = DealStage.objects.filter(organization=organization).only("id", "crm_type", "deal_id_crm", "status")
+    synced_after = timezone.now() - timedelta(days=DEAL_STATUS_RECONCILE_DAYS)
+    if deal_ids is not None:
+        deals = deals.filter(id__in=deal_ids)
+    elif not full_resync and organization.deal_status_webhook_at and organization.deal_status_webhook_at >= synced_after:
+        deals = deals.filter(Q(status_synced_at__isnull=True) | Q(status_synced_at__lt=synced_after))
+
+    chunks = []
+
+    if organization.bearer_amocrm and not organization.custom_crm:
+        amo_deals = deals.filter(crm_type="amoCRM")
+        if not full_resync:
+            status_mapping = get_amo_status_mapping(organization)
+            final_statuses = [status_mapping[str(status_id)] for status_id in EXCLUDED_STATUSES if str(status_id) in status_mapping]
+            amo_deals = amo_deals.exclude(status__in=final_statuses)
+        amo_deals = list(amo_deals.order_by("id"))
+        chunks += [
+            (fetch_amo_deal_statuses, amo_deals[start:start + AMO_LEADS_PAGE_SIZE])
+            for start in range(0, len(amo_deals), AMO_LEADS_PAGE_SIZE)
+        ]
+
+    if organization.b24_domain and organization.b24_api_leads:
+        bitrix_deals = deals.filter(crm_type="Bitrix24")
+        if not full_resync:
+            bitrix_deals = bitrix_deals.exclude(status__in=BITRIX_FINAL_LEAD_STATUSES)
+        bitrix_deals = list(bitrix_deals.order_by("id"))
+        chunks += [
+            (get_bitrix_lead_statuses, bitrix_deals[start:start + BITRIX_BATCH_SIZE])
+            for start in range(0, len(bitrix_deals), BITRIX_BATCH_SIZE)
+        ]
+
+    updated = 0
+    for index, (fetch_statuses, chunk) in enumerate(chunks):
+        try:
+            updated += sync_deal_chunk(organization, chunk, fetch_statuses)
+        except CRMRateLimitError as e:
+            remaining = [deal.id for _, rest in chunks[index:] for deal in rest]
+            logger.warning(f"Обновление статусов {len(remaining)} сделок {organization.name} отложено из-за лимита запросов CRM")
+            raise self.retry(
+                exc=e,
+                countdown=60,
+                kwargs={"organization_id": organization_id, "full_resync": full_resync, "deal_ids": remaining},
+            )
+
+    logger.info(f"Статусы сделок {organization.name}: обновлено {updated}")
+    return {"updated": updated}
 
 
 @shared_task
 def generate_weekly_insights_for_all():
+    # Все виды анализа (WEEKLY_ANALYSIS_KINDS) за один проход по транскрибациям недели
     for org in Organization.objects.all():
-        analyze_weekly_errors(org)
-        analyze_weekly_factors(org)
+        analyze_week(org)
 
 
 @shared_task
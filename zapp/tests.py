@@ -1,3 +1,378 @@
-from django.test import TestCase
+import json, os, tempfile, threading
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from . import tasks
+from .management.commands.benchmark_audio_duration import create_mp3_fixture, create_wav_fixture
+from .models import (
+    CriteriaLabel, CriteriaSteps, DonkitRequest, IncomingRequest, Objection, Organization, Prompt, S2TRequest
+)
+from .services import pydub, speech2text_service
+from .services.structured_scoring import parse_call_scoring
+from .services.t_model import CriteriaStreamParser
 
-# Create your tests here.
+CALLBACK_TOKEN = "secret"
+TRANSCRIPT = "Менеджер: Добрый день. Клиент: Здравствуйте."
+
+
+class FakeS2THandler(BaseHTTPRequestHandler):
+    """
+    Локальная заглушка Speech2Text: статус задачи /api/recognitions/<id> и txt-результат /txt/<id>.
+    """
+    protocol_version = "HTTP/1.1"
+    # task_id -> ответ на запрос статуса
+    recognitions = {}
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path.startswith("/api/recognitions/"):
+            recognition = self.recognitions.get(path.rsplit("/", 1)[-1])
+            if recognition is None:
+                return self.reply(404, b"{}")
+            return self.reply(200, json.dumps(recognition).encode(), "application/json")
+        if path.startswith("/txt/"):
+            return self.reply(200, TRANSCRIPT.encode(), "text/plain; charset=utf-8")
+        self.reply(404, b"")
+
+    def reply(self, code, body, content_type="application/json"):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class S2TTestCase(TestCase):
+    """
+    Колбэк и опрос Speech2Text против локальной заглушки сервиса.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeS2THandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.server_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        with mock.patch("zapp.signals.fetch_and_create_managers"):
+            self.organization = Organization.objects.create(name="Тест", s2t_api_key="key")
+        incoming_request = IncomingRequest.objects.create(organization=self.organization, raw_data={})
+        self.s2t_request = S2TRequest.objects.create(
+            organization=self.organization,
+            incoming_request=incoming_request,
+            task_id="101",
+            status="В очереди на распознание",
+        )
+        FakeS2THandler.recognitions = {}
+
+        patches = [
+            mock.patch.object(speech2text_service, "S2T_API_URL", f"{self.server_url}/api"),
+            mock.patch.object(tasks.send_to_donkit_task, "delay"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.send_to_donkit = tasks.send_to_donkit_task.delay
+
+    def set_recognition(self, code, description):
+        recognition = {"status": {"code": code, "description": description}}
+        if code == 200:
+            recognition["result"] = {"txt": f"{self.server_url}/txt/{self.s2t_request.task_id}"}
+        FakeS2THandler.recognitions[self.s2t_request.task_id] = recognition
+
+    def enable_callbacks(self):
+        patches = [
+            mock.patch.object(speech2text_service, "S2T_CALLBACK_URL", "https://example.com/s2t_callback/"),
+            mock.patch.object(speech2text_service, "S2T_CALLBACK_TOKEN", CALLBACK_TOKEN),
+            mock.patch("zapp.views.S2T_CALLBACK_TOKEN", CALLBACK_TOKEN),
+            # Задачи колбэка выполняются сразу, без брокера
+            mock.patch.object(tasks.complete_transcription, "delay", side_effect=tasks.complete_transcription),
+            mock.patch.object(tasks.check_transcription_status, "delay", side_effect=tasks.check_transcription_status),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def post_callback(self, payload, token=CALLBACK_TOKEN):
+        return self.client.post(
+            f"/s2t_callback/?token={token}", json.dumps(payload), content_type="application/json"
+        )
+
+    def test_callback_disabled_without_token(self):
+        response = self.post_callback({"id": "101", "status": {"code": 500, "description": "Ошибка"}})
+        self.assertEqual(response.status_code, 404)
+        self.s2t_request.refresh_from_db()
+        self.assertEqual(self.s2t_request.status, "В очереди на распознание")
+
+    def test_callback_rejects_wrong_token(self):
+        self.enable_callbacks()
+        response = self.post_callback({"id": "101", "status": {"code": 200}}, token="wrong")
+        self.assertEqual(response.status_code, 403)
+
+    def test_callback_completes_transcription(self):
+        self.enable_callbacks()
+        self.set_recognition(200, "Распознано")
+
+        response = self.post_callback({"id": "101", "status": {"code": 200}, "result": {"txt": "http://evil.example/txt"}})
+
+        self.assertEqual(response.status_code, 200)
+        self.s2t_request.refresh_from_db()
+        self.assertEqual(self.s2t_request.transcribed_text, TRANSCRIPT)
+        self.send_to_donkit.assert_called_once()
+
+        # Повторный колбэк не отправляет звонок в нейросеть второй раз
+        self.post_callback({"id": "101", "status": {"code": 200}})
+        self.send_to_donkit.assert_called_once()
+
+    def test_callback_status_is_checked_with_service(self):
+        self.enable_callbacks()
+        self.set_recognition(201, "В очереди на распознание")
+
+        response = self.post_callback({"id": "101", "status": {"code": 500, "description": "Произвольный статус"}})
+
+        self.assertEqual(response.status_code, 200)
+        self.s2t_request.refresh_from_db()
+        self.assertIn(self.s2t_request.status, speech2text_service.S2T_PENDING_STATUSES)
+
+    def test_polling_completes_transcription(self):
+        self.set_recognition(200, "Распознано")
+
+        with mock.patch.object(tasks.poll_transcription_batch, "delay", side_effect=tasks.poll_transcription_batch):
+            tasks.schedule_transcription_checks()
+
+        self.s2t_request.refresh_from_db()
+        self.assertEqual(self.s2t_request.status, "Распознано")
+        self.assertEqual(self.s2t_request.transcribed_text, TRANSCRIPT)
+        self.send_to_donkit.assert_called_once()
+
+    def test_polling_keeps_pending_task(self):
+        self.set_recognition(201, "Процесс получения файла")
+
+        with mock.patch.object(tasks.poll_transcription_batch, "delay", side_effect=tasks.poll_transcription_batch):
+            tasks.schedule_transcription_checks()
+
+        self.s2t_request.refresh_from_db()
+        self.assertEqual(self.s2t_request.status, "Процесс получения файла")
+        self.send_to_donkit.assert_not_called()
+
+    def test_polling_reclaims_lost_batch(self):
+        self.set_recognition(200, "Распознано")
+        # Строку забрала задача опроса, которая так и не завершилась
+        stale = timezone.now() - timedelta(seconds=speech2text_service.S2T_POLL_LEASE_TIMEOUT + 60)
+        S2TRequest.objects.filter(id=self.s2t_request.id).update(
+            status=speech2text_service.S2T_CHECKING_STATUS, updated_at=stale
+        )
+
+        with mock.patch.object(tasks.poll_transcription_batch, "delay", side_effect=tasks.poll_transcription_batch):
+            tasks.schedule_transcription_checks()
+
+        self.s2t_request.refresh_from_db()
+        self.assertEqual(self.s2t_request.transcribed_text, TRANSCRIPT)
+        self.send_to_donkit.assert_called_once()
+
+
+class AudioDurationTestCase(SimpleTestCase):
+    """
+    Длительность аудио по заголовкам на сгенерированных WAV/MP3 и переход к декодированию pydub.
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+        # get_audio_duration читает локальные файлы вместо HTTP Range, декодер pydub подменён
+        patches = [
+            mock.patch.object(pydub, "HttpRangeReader", pydub.FileRangeReader),
+            mock.patch.object(pydub, "decode_audio_duration", return_value=42.4),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.decode_audio_duration = pydub.decode_audio_duration
+
+    def write_file(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_probe_wav_fixture(self):
+        path = create_wav_fixture(self.tmp_dir, minutes=1)
+        self.assertEqual(pydub.probe_audio_duration(pydub.FileRangeReader(path)), 60)
+        self.assertEqual(pydub.get_audio_duration(path), 60)
+        self.decode_audio_duration.assert_not_called()
+
+    def test_probe_mp3_fixture(self):
+        path = create_mp3_fixture(self.tmp_dir, minutes=1)
+        self.assertAlmostEqual(pydub.probe_audio_duration(pydub.FileRangeReader(path)), 60, places=1)
+        self.assertEqual(pydub.get_audio_duration(path), 60)
+        self.decode_audio_duration.assert_not_called()
+
+    def test_garbage_falls_back_to_decoding(self):
+        path = self.write_file("garbage.mp3", bytes(range(256)) * 64)
+        self.assertIsNone(pydub.probe_audio_duration(pydub.FileRangeReader(path)))
+        self.assertEqual(pydub.get_audio_duration(path), 42)
+        self.decode_audio_duration.assert_called_once_with(path)
+
+    def test_truncated_wav_falls_back_to_decoding(self):
+        with open(create_wav_fixture(self.tmp_dir, minutes=1), "rb") as f:
+            # Заголовок обещает минуту, а данных в файле на секунду
+            path = self.write_file("truncated.wav", f.read(44 + 16000))
+        self.assertIsNone(pydub.probe_audio_duration(pydub.FileRangeReader(path)))
+        self.assertEqual(pydub.get_audio_duration(path), 42)
+        self.decode_audio_duration.assert_called_once_with(path)
+
+
+class CriteriaStreamParserTestCase(TestCase):
+    """
+    Промежуточные оценки потокового ответа и их откат, если ответ оборвался.
+    """
+    ANSWER = "Анализ\n1. Контакт (оценка: 3)\n2. Потребности (оценка: 1)\nИтоговая оценка: 4/14\nСаммари: ok"
+
+    def setUp(self):
+        with mock.patch("zapp.signals.fetch_and_create_managers"):
+            self.organization = Organization.objects.create(name="Тест", donkit_api_key="key")
+        for position in range(1, 8):
+            CriteriaLabel.objects.get_or_create(organization=self.organization, position=position)
+        self.incoming_request = IncomingRequest.objects.create(
+            organization=self.organization, source="other", audio_duration=5, raw_data={}
+        )
+        S2TRequest.objects.create(
+            organization=self.organization, incoming_request=self.incoming_request, transcribed_text="т" * 500
+        )
+
+    def get_scores(self):
+        return CriteriaSteps.objects.filter(incoming_request=self.incoming_request).values_list(
+            "criteria_1", "criteria_2", "overall_score"
+        ).first()
+
+    def test_scores_saved_per_line(self):
+        parser = CriteriaStreamParser(self.incoming_request)
+        parser.feed("Анализ\n1. Контакт (оценка: 3)")
+        self.assertIsNone(self.get_scores())  # строка ещё не дописана
+
+        parser.feed("\n2. Потреб")
+        self.assertEqual(self.get_scores(), (3, None, None))
+
+    def test_rollback_deletes_created_row(self):
+        parser = CriteriaStreamParser(self.incoming_request)
+        parser.feed(self.ANSWER[:60])
+        self.assertIsNotNone(self.get_scores())
+
+        parser.rollback()
+        self.assertFalse(CriteriaSteps.objects.filter(incoming_request=self.incoming_request).exists())
+
+    def test_rollback_restores_existing_row(self):
+        CriteriaSteps.objects.create(incoming_request=self.incoming_request, criteria_1=9, overall_score=11)
+        parser = CriteriaStreamParser(self.incoming_request)
+        parser.feed(self.ANSWER[:60])
+        self.assertEqual(self.get_scores(), (3, 1, 11))
+
+        parser.rollback()
+        self.assertEqual(self.get_scores(), (9, None, 11))
+
+    def test_broken_stream_rolls_back_scores(self):
+        def broken_stream():
+            for start in range(0, 60, 7):
+                delta = SimpleNamespace(content=self.ANSWER[start:start + 7])
+                yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])
+            raise ConnectionError("connection reset")
+
+        CriteriaSteps.objects.create(incoming_request=self.incoming_request, criteria_1=9, overall_score=11)
+        prompt = Prompt.objects.create(organization=self.organization, description="Промпт")
+        client = mock.Mock()
+        client.chat.completions.create.return_value = broken_stream()
+
+        with mock.patch.object(tasks, "init_tmodel_client", return_value=client), \
+                mock.patch.object(tasks, "TMODEL_STREAMING", True):
+            tasks.send_to_donkit_task(self.incoming_request.id, prompt.id, use_cache=False)
+
+        self.assertEqual(self.get_scores(), (9, None, 11))
+        self.assertFalse(DonkitRequest.objects.filter(incoming_request=self.incoming_request).exists())
+
+
+class StructuredScoringTestCase(TestCase):
+    """
+    Оценка звонка в JSON и переход к текстовому ответу с разбором регулярками.
+    """
+    SCORING = {
+        "criteria": [{"position": 1, "score": 2}, {"position": 2, "score": 1}],
+        "overall_score": 3,
+        "objection": "дорого",
+        "analytics": "Аналитика",
+        "summary": "Итог",
+    }
+
+    def setUp(self):
+        with mock.patch("zapp.signals.fetch_and_create_managers"):
+            self.organization = Organization.objects.create(name="Тест", donkit_api_key="key", structured_scoring=True)
+        for position in range(1, 4):
+            CriteriaLabel.objects.get_or_create(organization=self.organization, position=position)
+        self.objection = Objection.objects.create(organization=self.organization, name="Дорого")
+        self.prompt = Prompt.objects.create(organization=self.organization, description="Промпт")
+        self.incoming_request = IncomingRequest.objects.create(
+            organization=self.organization, source="other", audio_duration=5, raw_data={}
+        )
+        S2TRequest.objects.create(
+            organization=self.organization, incoming_request=self.incoming_request, transcribed_text="т" * 500
+        )
+
+    def llm_response(self, content, tokens=1):
+        usage = SimpleNamespace(total_tokens=tokens, prompt_tokens=tokens, completion_tokens=0)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+    def run_task(self, *responses):
+        client = mock.Mock()
+        client.chat.completions.create.side_effect = list(responses)
+        with mock.patch.object(tasks, "init_tmodel_client", return_value=client), \
+                mock.patch.object(tasks, "TMODEL_STREAMING", False):
+            tasks.send_to_donkit_task(self.incoming_request.id, self.prompt.id, use_cache=False)
+        return client
+
+    def test_parse_valid_answer(self):
+        scoring = parse_call_scoring(json.dumps(self.SCORING))
+        self.assertEqual([(item.position, item.score) for item in scoring.criteria], [(1, 2), (2, 1)])
+        self.assertEqual(scoring.overall_score, 3)
+        self.assertEqual(scoring.objection, "дорого")
+
+    def test_parse_invalid_answer(self):
+        out_of_range = dict(self.SCORING, criteria=[{"position": 9, "score": 1}])
+        without_summary = {key: value for key, value in self.SCORING.items() if key != "summary"}
+        for raw_answer in ("", None, "не JSON", json.dumps(out_of_range), json.dumps(without_summary)):
+            with self.subTest(raw_answer=raw_answer):
+                self.assertIsNone(parse_call_scoring(raw_answer))
+
+    def test_json_answer_saved(self):
+        client = self.run_task(self.llm_response(json.dumps(self.SCORING)))
+
+        self.assertEqual(client.chat.completions.create.call_count, 1)
+        criteria = CriteriaSteps.objects.get(incoming_request=self.incoming_request)
+        self.assertEqual((criteria.criteria_1, criteria.criteria_2, criteria.overall_score), (2, 1, 3))
+        self.assertEqual(criteria.objection, self.objection)
+        self.assertIn("Саммари: Итог", DonkitRequest.objects.get(incoming_request=self.incoming_request).answer)
+
+    def test_invalid_json_falls_back_to_text_answer(self):
+        client = self.run_task(
+            self.llm_response("не JSON"),
+            self.llm_response("1. Контакт (оценка: 4)\nИтоговая оценка: 4/14\nСаммари: текст", tokens=5),
+        )
+
+        self.assertEqual(client.chat.completions.create.call_count, 2)
+        criteria = CriteriaSteps.objects.get(incoming_request=self.incoming_request)
+        self.assertEqual((criteria.criteria_1, criteria.overall_score), (4, 4))
+        # Токены неудачной попытки JSON тоже учитываются
+        self.assertEqual(DonkitRequest.objects.get(incoming_request=self.incoming_request).tokens_used, 6)
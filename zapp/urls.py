@@ -15,6 +15,16 @@ urlpatterns = [
     path('get_call', GetCallWebhook.as_view(), name='get_call_no_slash'),  # Без завершающего слэша
     path('get_call_b24/', GetCallBitrixWebhook.as_view(), name='get_call_b24'),
     path('get_call_b24', GetCallBitrixWebhook.as_view(), name='get_call_b24_no_slash'),
+    path('get_call_async/', GetCallAsyncWebhook.as_view(), name='get_call_async'),
+    path('get_call_async', GetCallAsyncWebhook.as_view(), name='get_call_async_no_slash'),
+    path('get_call_b24_async/', GetCallBitrixAsyncWebhook.as_view(), name='get_call_b24_async'),
+    path('get_call_b24_async', GetCallBitrixAsyncWebhook.as_view(), name='get_call_b24_async_no_slash'),
+    path('s2t_callback/', S2TCallbackWebhook.as_view(), name='s2t_callback'),
+    path('s2t_callback', S2TCallbackWebhook.as_view(), name='s2t_callback_no_slash'),
+    path('lead_status/', AmoLeadStatusWebhook.as_view(), name='lead_status'),
+    path('lead_status', AmoLeadStatusWebhook.as_view(), name='lead_status_no_slash'),
+    path('lead_update_b24/', BitrixLeadUpdateWebhook.as_view(), name='lead_update_b24'),
+    path('lead_update_b24', BitrixLeadUpdateWebhook.as_view(), name='lead_update_b24_no_slash'),
     # Другие маршруты
     path('send_to_transcription/<int:request_id>/', views.send_to_transcription, name='send_to_transcription'),
     path('send_to_donkit/<int:incoming_request_id>/', views.send_to_donkit, name='send_to_donkit'),
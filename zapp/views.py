@@ -1,8 +1,12 @@
-import logging, json, urllib.parse, csv, math
+import logging, json, csv, math, hmac
 from .services.context_builders import *
 from .services.t_model import *
 from .services.amocrm_service import *
 from .services.bitrix_service import *
+from .services.organization_cache import get_organization_by_subdomain, get_organization_by_b24_domain
+from .services.webhook_ingest import (
+    SOURCE_AMOCRM, SOURCE_BITRIX24, accept_amocrm_call, accept_bitrix_call, enqueue_webhook, parse_bitrix_payload
+)
 from .tasks import *
 from .models import *
 
@@ -17,7 +21,6 @@ from django.contrib import messages
 from django.http import JsonResponse, HttpResponse
 from django.views import View
 from django.db.models import Q, Prefetch, Count
-from django.utils.timezone import localtime
 
 logger = logging.getLogger(__name__)
 
@@ -308,53 +311,11 @@ class GetCallWebhook(View):
 
     def post(self, request, *args, **kwargs):
         try:
-            # Логируем заголовки запроса
-            logger.warning(f"Заголовки запроса: {dict(request.headers)}")
-
-            # Получаем данные запроса
             data = request.POST.dict()
-            logger.warning(f"Получен запрос: {data}")
-
-            # Проверяем наличие subdomain
-            subdomain = data.get("account[subdomain]")
-            if not subdomain:
-                logger.warning("Запрос без поля 'account[subdomain]'.")
-                return JsonResponse({"status": "error", "message": "Поле 'account[subdomain]' отсутствует."}, status=400)
-
-            # Получаем по subdomain организацию из таблицы Organization
-            organization = Organization.objects.filter(account_amocrm=subdomain).first()
-            if not organization:
-                logger.warning(f"Запрос от неизвестного subdomain: {subdomain}")
-                return JsonResponse({"status": "ignored", "message": f"Subdomain '{subdomain}' не зарегистрирован."}, status=403)
-            
-            
-            if organization.trial_expires_at and localtime().date() > organization.trial_expires_at:
-                return JsonResponse({"status": "error", "message": "Истек срок пробного периода."})
-
-            # Список возможных источников (контакты, сделки, компании)
-            sources = ["contacts", "leads", "companies"]
-
-            found_valid_note = False
-
-            for source in sources:
-                note_prefix = f"{source}[note][0][note]"
-                note_type = data.get(f"{note_prefix}[note_type]")
-
-                if note_type not in ["10", "11"]:
-                    continue  # Пропускаем нерелевантные примечания
+            logger.debug(f"Получен запрос: {data}")
 
-                # Валидное примечание найдено
-                found_valid_note = True
-
-                # Передаём в задачу Celery (вы можете передать ещё element_id, element_type, если нужно)
-                process_amocrm_request.delay(data)
-                break  # обрабатываем только первое подходящее примечание
-
-            if found_valid_note:
-                return JsonResponse({"status": "success", "message": "Запрос передан в обработку."}, status=200)
-            else:
-                logger.warning("Примечание не является аудиозаписью или не найдено. END")
-                return JsonResponse({"status": "ignored", "message": "Примечание не является аудиозаписью."}, status=200)
+            result, status = accept_amocrm_call(data)
+            return JsonResponse(result, status=status)
 
         except Exception as e:
             logger.error(f"Ошибка обработки запроса: {str(e)}. END")
@@ -374,93 +335,186 @@ class GetCallBitrixWebhook(View):
                 logger.error("Bitrix24 отправил пустое тело запроса!")
                 return JsonResponse({"status": "error", "message": "Empty request body. END"}, status=400)
 
-            # Определяем формат входящих данных
-            content_type = request.headers.get('Content-Type', '')
+            try:
+                data = parse_bitrix_payload(request.body, request.headers.get('Content-Type', ''))
+            except ValueError as e:
+                logger.error(f"Ошибка разбора вебхука Bitrix24: {str(e)}. END")
+                return JsonResponse({"status": "error", "message": str(e)}, status=400)
 
-            if "application/json" in content_type:
-                try:
-                    data = json.loads(request.body.decode('utf-8'))
-                except json.JSONDecodeError:
-                    logger.error("Ошибка обработки JSON в вебхуке Bitrix24. END")
-                    return JsonResponse({"status": "error", "message": "Invalid JSON format"}, status=400)
+            result, status = accept_bitrix_call(data)
+            return JsonResponse(result, status=status)
 
-            elif "application/x-www-form-urlencoded" in content_type:
-                data = urllib.parse.parse_qs(request.body.decode('utf-8'))
-                data = {k: v[0] if isinstance(v, list) else v for k, v in data.items()}
+        except Exception as e:
+            logger.error(f"Ошибка обработки вебхука Bitrix24: {str(e)}. END")
+            return JsonResponse({"status": "error", "message": str(e)}, status=500)
+        
 
-            else:
-                logger.error(f"Неподдерживаемый формат данных: {content_type}. END")
-                return JsonResponse({"status": "error", "message": f"Unsupported content type: {content_type}"}, status=400)
+@method_decorator(csrf_exempt, name='dispatch')
+class GetCallAsyncWebhook(View):
+    """
+    Асинхронный приём вебхуков amoCRM (для ASGI).
+    Проверяет только наличие subdomain, кладёт запрос в очередь Redis и сразу отвечает 200.
+    Организацию, сохранение и задачи обрабатывает потребитель consume_webhooks.
+    """
+    async def post(self, request, *args, **kwargs):
+        data = request.POST.dict()
+        if not data.get("account[subdomain]"):
+            return JsonResponse({"status": "error", "message": "Поле 'account[subdomain]' отсутствует."}, status=400)
 
-            # Проверяем наличие CALL_ID
-            call_id = data.get("data[CALL_ID]") or data.get("CALL_ID")
-            if not call_id:
-                logger.error("Вебхук не содержит CALL_ID")
-                return JsonResponse({"status": "error", "message": "CALL_ID отсутствует"}, status=400)
+        try:
+            await enqueue_webhook(SOURCE_AMOCRM, data)
+        except Exception as e:
+            logger.error(f"Не удалось поставить вебхук amoCRM в очередь: {str(e)}. END")
+            return JsonResponse({"status": "error", "message": str(e)}, status=500)
 
-            # Получаем значение CALL_DURATION
-            call_duration_raw = data.get("data[CALL_DURATION]")
+        return JsonResponse({"status": "accepted"}, status=200)
 
-            # Проверяем проблемные сценарии
-            if call_duration_raw is None or call_duration_raw == "" or not call_duration_raw.isdigit():
-                call_duration = 0  # Если нет данных или некорректный формат, ставим 0
-            else:
-                call_duration = int(call_duration_raw)  # Безопасное преобразование
 
-            # Определяем организацию по REST_APP_NAME или auth[domain]
-            full_b24_domain = data.get("auth[domain]")
+@method_decorator(csrf_exempt, name='dispatch')
+class GetCallBitrixAsyncWebhook(View):
+    """
+    Асинхронный приём вебхуков Bitrix24 (для ASGI).
+    Проверяет только наличие CALL_ID, кладёт запрос в очередь Redis и сразу отвечает 200.
+    """
+    async def post(self, request, *args, **kwargs):
+        if not request.body:
+            return JsonResponse({"status": "error", "message": "Empty request body. END"}, status=400)
 
-            if full_b24_domain:
-                b24_domain = full_b24_domain.split('.')[0]
-            else:
-                b24_domain = None
+        try:
+            data = parse_bitrix_payload(request.body, request.headers.get('Content-Type', ''))
+        except ValueError as e:
+            return JsonResponse({"status": "error", "message": str(e)}, status=400)
+
+        if not (data.get("data[CALL_ID]") or data.get("CALL_ID")):
+            return JsonResponse({"status": "error", "message": "CALL_ID отсутствует"}, status=400)
 
-            organization = Organization.objects.filter(b24_domain=b24_domain).first()
+        try:
+            await enqueue_webhook(SOURCE_BITRIX24, data)
+        except Exception as e:
+            logger.error(f"Не удалось поставить вебхук Bitrix24 в очередь: {str(e)}. END")
+            return JsonResponse({"status": "error", "message": str(e)}, status=500)
+
+        return JsonResponse({"status": "accepted"}, status=200)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class S2TCallbackWebhook(View):
+    """
+    Колбэк Speech2Text о смене статуса распознавания.
+    Проверяет секрет и передаёт задачу в Celery, не дожидаясь скачивания результата.
+    Пока колбэки не настроены (нет адреса или токена), эндпоинт отвечает 404.
+    """
+    def post(self, request, *args, **kwargs):
+        try:
+            if not s2t_callbacks_enabled():
+                return JsonResponse({"status": "error", "message": "Колбэки Speech2Text выключены"}, status=404)
 
+            if not hmac.compare_digest(request.GET.get("token", ""), S2T_CALLBACK_TOKEN):
+                logger.warning("Колбэк Speech2Text с неверным токеном. END")
+                return JsonResponse({"status": "error", "message": "Неверный токен"}, status=403)
+
+            try:
+                data = json.loads(request.body.decode('utf-8'))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                data = request.POST.dict()
+
+            task_id = data.get("id")
+            if not task_id:
+                return JsonResponse({"status": "error", "message": "Поле 'id' отсутствует"}, status=400)
+
+            status = data.get("status") or {}
+            description = status.get("description")
+            if status.get("code") == 200:
+                txt_result_link = (data.get("result") or {}).get("txt")
+                complete_transcription.delay(str(task_id), txt_result_link)
+            elif description in S2T_PENDING_STATUSES:
+                # Промежуточный статус сохраняем как есть: задача остаётся в страховочном опросе
+                S2TRequest.objects.filter(task_id=str(task_id)).filter(
+                    Q(transcribed_text__isnull=True) | Q(transcribed_text="")
+                ).update(status=description)
+            elif description:
+                # Итоговый статус (например, ошибку) не берём из тела колбэка, а запрашиваем у Speech2Text
+                check_transcription_status.delay(str(task_id))
+
+            return JsonResponse({"status": "success"}, status=200)
+
+        except Exception as e:
+            logger.error(f"Ошибка обработки колбэка Speech2Text: {str(e)}. END")
+            return JsonResponse({"status": "error", "message": str(e)}, status=500)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AmoLeadStatusWebhook(View):
+    """
+    Вебхук amoCRM о смене статуса сделки (leads[status]).
+    Обновление статусов выполняется в Celery, вебхук только разбирает события.
+    """
+    def post(self, request, *args, **kwargs):
+        try:
+            data = request.POST.dict()
+
+            subdomain = data.get("account[subdomain]")
+            organization = get_organization_by_subdomain(subdomain)
             if not organization:
-                logger.warning(f"Не найдена организация для домена {b24_domain}. END")
-                return JsonResponse({"status": "ignored", "message": "Организация не найдена"}, status=403)
+                logger.warning(f"Смена статуса сделки от неизвестного subdomain: {subdomain}")
+                return JsonResponse({"status": "ignored", "message": f"Subdomain '{subdomain}' не зарегистрирован."}, status=403)
 
-            if organization.trial_expires_at and localtime().date() > organization.trial_expires_at:
-                return JsonResponse({"status": "error", "message": "Истек срок пробного периода. END"})
-            
+            # В одном вебхуке может прийти несколько событий: leads[status][0], leads[status][1], ...
+            lead_statuses = {}
+            index = 0
+            while f"leads[status][{index}][id]" in data:
+                status_id = data.get(f"leads[status][{index}][status_id]")
+                if status_id:
+                    lead_statuses[str(data[f"leads[status][{index}][id]"])] = status_id
+                index += 1
+
+            if not lead_statuses:
+                return JsonResponse({"status": "ignored", "message": "Нет событий leads[status]"})
 
-            minimal_length = organization.minimal_call_length# or MINIMAL_CALL_LENGTH
-            ignored_flag = call_duration < minimal_length
+            apply_amo_lead_statuses.delay(organization.id, lead_statuses)
+            return JsonResponse({"status": "success"}, status=200)
+
+        except Exception as e:
+            logger.error(f"Ошибка обработки вебхука статусов amoCRM: {str(e)}. END")
+            return JsonResponse({"status": "error", "message": str(e)}, status=500)
 
-            # Получаем значение CALL_TYPE
-            call_type = data.get("data[CALL_TYPE]")
 
-            # По умолчанию считаем звонок исходящим, если CALL_TYPE не определён
-            if call_type == "1" or call_type == "3":
-                call_direction = "incoming"
+@method_decorator(csrf_exempt, name='dispatch')
+class BitrixLeadUpdateWebhook(View):
+    """
+    Обработчик события Bitrix24 ONCRMLEADUPDATE.
+    Событие содержит только ID лида, поэтому статус запрашивается в Celery.
+    """
+    def post(self, request, *args, **kwargs):
+        try:
+            if "application/json" in request.headers.get('Content-Type', ''):
+                data = json.loads(request.body.decode('utf-8'))
             else:
-                call_direction = "outgoing"
-
-            # **Сохраняем входящий запрос**
-            incoming_request = IncomingRequest.objects.create(
-                raw_data=data,
-                domain_b24=b24_domain,
-                call_id_b24=call_id,
-                ignored=ignored_flag,
-                organization=organization,
-                source="Bitrix24",
-                call_direction=call_direction 
-            )
-            
-            if ignored_flag:
-                logger.warning(f"Запрос с CALL_ID {call_id} сохранён, но помечен как ignored. Длительность {call_duration} сек < MINIMAL_CALL_LENGTH сек. END")
-                return JsonResponse({"status": "ignored", "message": f"Запрос с CALL_ID {call_id} сохранён, но помечен как ignored. Длительность ({call_duration} сек меньше чем минимальная"}, status=200)
+                data = request.POST.dict()
+
+            event = (data.get("event") or "").upper()
+            if event != "ONCRMLEADUPDATE":
+                return JsonResponse({"status": "ignored", "message": f"Событие {event} не обрабатывается"})
+
+            lead_id = data.get("data[FIELDS][ID]") or (data.get("data") or {}).get("FIELDS", {}).get("ID")
+            full_b24_domain = data.get("auth[domain]") or (data.get("auth") or {}).get("domain")
+            b24_domain = full_b24_domain.split('.')[0] if full_b24_domain else None
+
+            organization = get_organization_by_b24_domain(b24_domain)
+            if not organization:
+                logger.warning(f"Не найдена организация для домена {b24_domain}. END")
+                return JsonResponse({"status": "ignored", "message": "Организация не найдена"}, status=403)
 
-            # **Запускаем Celery-задачу для получения CALL_RECORD_URL**
-            get_bitrix_call_record_task.apply_async(args=[incoming_request.id], countdown=5)
+            if not lead_id:
+                return JsonResponse({"status": "error", "message": "ID лида отсутствует"}, status=400)
 
-            return JsonResponse({"status": "success", "message": "Запрос принят, ожидаем ссылку на запись"}, status=200)
+            sync_bitrix_lead_status.delay(organization.id, str(lead_id))
+            return JsonResponse({"status": "success"}, status=200)
 
         except Exception as e:
-            logger.error(f"Ошибка обработки вебхука Bitrix24: {str(e)}. END")
+            logger.error(f"Ошибка обработки события ONCRMLEADUPDATE: {str(e)}. END")
             return JsonResponse({"status": "error", "message": str(e)}, status=500)
-        
+
 
 @login_required
 def add_crm_note_view(request, incoming_request_id):
@@ -499,9 +553,7 @@ def add_crm_note_view(request, incoming_request_id):
                 if incoming_request.organization.send_comments_to_amocrm and not incoming_request.organization.custom_crm:
                     add_amo_note.delay(incoming_request.organization.id, incoming_request.user_id, text_to_send)
                     if organization.summary_to_lead and summary != "":
-                        active_leads = get_active_leads_with_tag(incoming_request.user_id, organization)
-                        for lead in active_leads:
-                            add_note_to_lead.delay(organization.id, lead["id"], "**Саммари:**\n\n"+summary)
+                        add_summary_to_active_leads.delay(organization.id, incoming_request.user_id, "**Саммари:**\n\n"+summary)
                 elif incoming_request.organization.send_comments_to_amocrm and incoming_request.organization.custom_crm:
                     send_custom_crm_note(organization, incoming_request.user_id, text_to_send)
 
@@ -525,12 +577,20 @@ def send_to_transcription(request, request_id):
     """
     Направляет входящий запрос на транскрибацию.
     Создаёт Celery задачу для отправки запроса в службу Speech2Text.
+    Ручной запуск транскрибирует запись заново; use_cache=true в теле разрешает взять готовый текст из кэша.
     """
     if request.method == 'POST':
         try:
             incoming_request = IncomingRequest.objects.get(id=request_id)  # Получаем входящий запрос
+
+            try:
+                data = json.loads(request.body or b"{}")
+            except json.JSONDecodeError:
+                data = {}
+            use_cache = str(data.get('use_cache', False)).strip().lower() in ("1", "true", "yes", "on")
+
             # Передаем ID входящего запроса в Celery задачу
-            send_to_speech2text.delay(incoming_request.id)
+            send_to_speech2text.delay(incoming_request.id, use_cache=use_cache)
             return JsonResponse({"status": "success", "message": "Запрос отправлен на транскрибацию"})
         except IncomingRequest.DoesNotExist:
             return JsonResponse({"status": "error", "message": "Входящий запрос не найден"})
@@ -571,8 +631,11 @@ def send_to_donkit(request, incoming_request_id):
             if not prompt:
                 return JsonResponse({"status": "error", "message": "Нет доступных промптов для запроса в Deepseek"})
 
+            # use_cache=false — отправить в нейросеть заново, даже если ответ уже есть в кэше
+            use_cache = str(data.get('use_cache', True)).strip().lower() not in ("0", "false", "no", "off")
+
             # Передаем задачу в Celery
-            send_to_donkit_task.delay(incoming_request.id, prompt.id)
+            send_to_donkit_task.delay(incoming_request.id, prompt.id, use_cache=use_cache)
             return JsonResponse({"status": "success", "message": "Запрос отправлен в Deepseek"})
         except Exception as e:
             return JsonResponse({"status": "error", "message": str(e)})